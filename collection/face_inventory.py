@@ -0,0 +1,169 @@
+# Local view of what a Rekognition collection contains.
+#
+#   python face_inventory.py --collection russell --refresh
+#   python face_inventory.py --collection russell --lookup <FaceId>
+#
+# The inventory maps FaceId -> ExternalImageId, ImageId and indexing time and
+# keeps the reverse ExternalImageId -> FaceIds map, both as plain dicts, so
+# lookups never touch the service. refresh() pages list_faces with the
+# largest page size and merges the result: new faces are added, faces that
+# disappeared from the collection are dropped, known faces keep their
+# indexing time.
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def default_path(collectionId):
+    return 'faces-%s.json' % collectionId
+
+
+class FaceInventory(object):
+    PAGE_SIZE = 4096    # list_faces maximum
+
+    def __init__(self, collectionId, path=None):
+        self.collectionId = collectionId
+        self.path = path
+        self.faces = {}
+        self.byExternalId = {}
+        self.faceModelVersion = None
+        self.refreshed = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, collectionId, path=None):
+        inventory = cls(collectionId, path or default_path(collectionId))
+        if os.path.exists(inventory.path):
+            with open(inventory.path) as f:
+                data = json.load(f)
+            if data.get('CollectionId') == collectionId:
+                inventory.faceModelVersion = data.get('FaceModelVersion')
+                inventory.refreshed = data.get('Refreshed')
+                for faceId, face in data['Faces'].items():
+                    inventory._add(faceId, face)
+        return inventory
+
+    def save(self, path=None):
+        path = path or self.path
+        with self.lock:
+            data = {'CollectionId': self.collectionId, 'FaceModelVersion': self.faceModelVersion,
+                    'Refreshed': self.refreshed, 'Faces': self.faces}
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f, sort_keys=True)
+            os.rename(tmp, path)
+
+    def _add(self, faceId, face):
+        self.faces[faceId] = face
+        externalId = face.get('ExternalImageId')
+        if externalId is not None:
+            self.byExternalId.setdefault(externalId, set()).add(faceId)
+
+    def _remove(self, faceId):
+        face = self.faces.pop(faceId)
+        faceIds = self.byExternalId.get(face.get('ExternalImageId'))
+        if faceIds is not None:
+            faceIds.discard(faceId)
+            if not faceIds:
+                del self.byExternalId[face['ExternalImageId']]
+
+    def add(self, faceId, externalId=None, imageId=None, indexed=None):
+        """Record a face we just indexed ourselves."""
+        with self.lock:
+            if faceId not in self.faces:
+                self._add(faceId, {'ExternalImageId': externalId, 'ImageId': imageId,
+                                   'Indexed': indexed or time.time()})
+
+    def refresh(self, rek, call=None):
+        """
+        Page through list_faces and merge the collection into the inventory.
+        call(fn, **kwargs) wraps every request (e.g. to retry throttling).
+        Returns (added, removed) FaceId counts.
+        """
+        call = call or (lambda fn, **kwargs: fn(**kwargs))
+        now = time.time()
+        seen = set()
+        added = 0
+        kwargs = {'CollectionId': self.collectionId, 'MaxResults': self.PAGE_SIZE}
+        while True:
+            response = call(rek.list_faces, **kwargs)
+            with self.lock:
+                for face in response['Faces']:
+                    faceId = face['FaceId']
+                    seen.add(faceId)
+                    if faceId not in self.faces:
+                        self._add(faceId, {'ExternalImageId': face.get('ExternalImageId'),
+                                           'ImageId': face.get('ImageId'), 'Indexed': now})
+                        added += 1
+            self.faceModelVersion = response.get('FaceModelVersion', self.faceModelVersion)
+            if 'NextToken' not in response:
+                break
+            kwargs['NextToken'] = response['NextToken']
+        with self.lock:
+            gone = [faceId for faceId in self.faces if faceId not in seen]
+            for faceId in gone:
+                self._remove(faceId)
+            self.refreshed = now
+        return added, len(gone)
+
+    def version(self):
+        """Digest of the face model version and the FaceIds in the collection."""
+        digest = hashlib.sha1((self.faceModelVersion or '').encode('utf-8'))
+        for faceId in sorted(self.faces):
+            digest.update(b'\n' + faceId.encode('utf-8'))
+        return digest.hexdigest()
+
+    def resolve(self, faceId, default=None):
+        """ExternalImageId of a FaceId."""
+        face = self.faces.get(faceId)
+        if face is None:
+            return default
+        return face.get('ExternalImageId', default)
+
+    def added_since(self, since):
+        """FaceIds indexed (or first seen by refresh) after the given time."""
+        return set(faceId for faceId, face in self.faces.items() if (face.get('Indexed') or 0) > since)
+
+    def has_external_id(self, externalId):
+        return externalId in self.byExternalId
+
+    def face_ids(self, externalId):
+        return self.byExternalId.get(externalId, set())
+
+    def __contains__(self, faceId):
+        return faceId in self.faces
+
+    def __len__(self):
+        return len(self.faces)
+
+
+def main():
+    import boto3
+
+    parser = argparse.ArgumentParser(description='Maintain a local inventory of a collection.')
+    parser.add_argument('--collection', required=True, help='CollectionId')
+    parser.add_argument('--inventory', help='inventory file (default: faces-<collection>.json)')
+    parser.add_argument('--refresh', action='store_true', help='page list_faces and update the inventory')
+    parser.add_argument('--lookup', action='append', default=[], help='FaceId or ExternalImageId to look up')
+    parser.add_argument('--region', default=None)
+    args = parser.parse_args()
+
+    inventory = FaceInventory.load(args.collection, args.inventory)
+    if args.refresh or inventory.refreshed is None:
+        added, removed = inventory.refresh(boto3.client('rekognition', region_name=args.region))
+        inventory.save()
+        print('Refreshed %s: %d added, %d removed' % (args.collection, added, removed))
+    print('%d faces, %d external image ids' % (len(inventory), len(inventory.byExternalId)))
+    for name in args.lookup:
+        if name in inventory:
+            print('%s -> %s' % (name, inventory.resolve(name)))
+        else:
+            print('%s -> %s' % (name, ' '.join(sorted(inventory.face_ids(name))) or '-'))
+
+
+if __name__ == "__main__":
+    main()
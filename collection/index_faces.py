@@ -0,0 +1,252 @@
+# Index many reference images into a Rekognition collection.
+#
+#   python index_faces.py --collection russell --prefix s3://verge.rekognition/russel/
+#   python index_faces.py --collection russell --manifest images.txt
+#
+# A manifest lists one image per line as "s3://bucket/key [ExternalImageId]";
+# the ExternalImageId defaults to the key, '/' written as ':'.
+# Images are indexed concurrently; throttling answers from the service slow
+# every worker down instead of failing the run. Each finished image is
+# appended to a checkpoint file, and images whose ExternalImageId is already
+# in the collection are skipped, so an interrupted run can simply be re-run.
+# What the collection holds is looked up in the local face inventory
+# (face_inventory.py), which is refreshed once per run and updated with every
+# face indexed here.
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from face_inventory import FaceInventory
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'video-analysis'))
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png')
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+                     'LimitExceededException', 'TooManyRequestsException')
+
+
+def error_code(e):
+    return getattr(e, 'response', {}).get('Error', {}).get('Code')
+
+
+def external_image_id(key):
+    """
+    The whole key with '/' turned into ':', so that images of the same name
+    under different prefixes stay apart. Keys with other characters the API
+    refuses, with ':' of their own or too long get a hash of the key instead
+    of the part that does not fit, which keeps them distinct as well.
+    """
+    externalId = key.replace('/', ':')
+    if ':' not in key and len(externalId) <= 255 and re.match(r'^[a-zA-Z0-9_.\-:]+$', externalId):
+        return externalId
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return re.sub(r'[^a-zA-Z0-9_.\-:]', '_', externalId)[-(255 - 17):] + '-' + digest
+
+
+def read_manifest(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 1)
+            if not fields[0].startswith('s3://'):
+                raise ValueError("Manifest lines must start with s3://bucket/key: %r" % line)
+            bucket, _, key = fields[0][5:].partition('/')
+            yield bucket, key, fields[1] if len(fields) > 1 else external_image_id(key)
+
+
+def list_prefix(url):
+    from s3util import get_s3, iter_objects, split_s3_url
+    bucket, prefix = split_s3_url(url)
+    for obj in iter_objects(get_s3(), bucket, prefix, IMAGE_SUFFIXES):
+        yield bucket, obj['Key'], external_image_id(obj['Key'])
+
+
+class Throttle(object):
+    """
+    Shared request pacing for all workers. A throttling error halves the
+    allowed rate, every success raises it a little again, up to maxRate.
+    """
+
+    def __init__(self, maxRate, minRate=0.5):
+        self.maxRate = float(maxRate)
+        self.minRate = minRate
+        self.rate = self.maxRate
+        self.next = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next)
+            self.next = slot + 1.0 / self.rate
+        time.sleep(max(0.0, slot - now))
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.minRate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + 0.1)
+
+
+def call_with_backoff(fn, throttle=None, retries=8, **kwargs):
+    """Call fn(**kwargs), retrying throttling errors with jittered exponential backoff."""
+    for attempt in range(retries + 1):
+        if throttle:
+            throttle.wait()
+        try:
+            response = fn(**kwargs)
+        except Exception as e:
+            if error_code(e) not in THROTTLING_ERRORS or attempt == retries:
+                raise
+            if throttle:
+                throttle.throttled()
+            time.sleep(min(30, 0.2 * 2 ** attempt) * random.uniform(0.5, 1.0))
+            continue
+        if throttle:
+            throttle.succeeded()
+        return response
+
+
+class Checkpoint(object):
+    """Append-only JSON lines file of finished images, safe to share between threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue    # torn last line of an interrupted run
+                    if entry.get('status') == 'indexed':
+                        self.done[(entry['bucket'], entry['key'])] = entry
+
+    def record(self, entry):
+        if not self.path:
+            return
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+                f.flush()
+
+
+class BatchIndexer(object):
+    def __init__(self, rek, collectionId, checkpoint, workers=8, maxRate=20, retries=8,
+                 detectionAttributes=('DEFAULT',), inventory=None):
+        self.rek = rek
+        self.collectionId = collectionId
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.throttle = Throttle(maxRate)
+        self.retries = retries
+        self.detectionAttributes = list(detectionAttributes)
+        self.inventory = inventory
+        self.counts = {'indexed': 0, 'faces': 0, 'skipped': 0, 'failed': 0}
+        self.lock = threading.Lock()
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def index_one(self, bucket, key, externalId):
+        return call_with_backoff(self.rek.index_faces, self.throttle, self.retries,
+                                 CollectionId=self.collectionId,
+                                 Image={'S3Object': {'Bucket': bucket, 'Name': key}},
+                                 ExternalImageId=externalId,
+                                 DetectionAttributes=self.detectionAttributes)
+
+    def _work(self, item):
+        bucket, key, externalId = item
+        try:
+            response = self.index_one(bucket, key, externalId)
+        except Exception as e:
+            self._count('failed')
+            self.checkpoint.record({'bucket': bucket, 'key': key, 'externalImageId': externalId,
+                                    'status': 'failed', 'error': str(e)})
+            print('Failed %s: %s' % (key, e))
+            return
+        faceIds = []
+        for record in response.get('FaceRecords', []):
+            face = record['Face']
+            faceIds.append(face['FaceId'])
+            self.inventory.add(face['FaceId'], externalId, face.get('ImageId'))
+        self._count('indexed')
+        self._count('faces', len(faceIds))
+        self.checkpoint.record({'bucket': bucket, 'key': key, 'externalImageId': externalId,
+                                'status': 'indexed', 'faceIds': faceIds, 'time': time.time()})
+
+    def pending(self, images):
+        if self.inventory is None:
+            self.inventory = FaceInventory(self.collectionId)
+        if self.inventory.refreshed is None:
+            self.inventory.refresh(self.rek, call=call_with_backoff)
+        for bucket, key, externalId in images:
+            if (bucket, key) in self.checkpoint.done or self.inventory.has_external_id(externalId):
+                self._count('skipped')
+                continue
+            yield bucket, key, externalId
+
+    def run(self, images):
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # map() would realise the whole listing up front; keep a bounded window instead
+            window = []
+            for item in self.pending(images):
+                window.append(pool.submit(self._work, item))
+                if len(window) >= self.workers * 4:
+                    window.pop(0).result()
+            for future in window:
+                future.result()
+        return self.counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index reference images into a Rekognition collection.')
+    parser.add_argument('--collection', required=True, help='CollectionId')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', help='file with one "s3://bucket/key [ExternalImageId]" per line')
+    source.add_argument('--prefix', help='s3://bucket/prefix to index every image under')
+    parser.add_argument('--checkpoint', help='progress file (default: index-<collection>.checkpoint)')
+    parser.add_argument('--inventory', help='face inventory file (default: faces-<collection>.json)')
+    parser.add_argument('--no-refresh', action='store_true',
+                        help='trust the local inventory instead of listing the collection first')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--max-rate', type=float, default=20, help='index_faces calls per second')
+    parser.add_argument('--detection-attributes', default='ALL', choices=['ALL', 'DEFAULT'])
+    parser.add_argument('--region', default=None)
+    args = parser.parse_args()
+
+    rek = boto3.client('rekognition', region_name=args.region)
+    checkpoint = Checkpoint(args.checkpoint or 'index-%s.checkpoint' % args.collection)
+    images = read_manifest(args.manifest) if args.manifest else list_prefix(args.prefix)
+    inventory = FaceInventory.load(args.collection, args.inventory)
+    if not args.no_refresh:
+        inventory.refresh(rek, call=call_with_backoff)
+    indexer = BatchIndexer(rek, args.collection, checkpoint, workers=args.workers,
+                           maxRate=args.max_rate, detectionAttributes=[args.detection_attributes],
+                           inventory=inventory)
+    try:
+        counts = indexer.run(images)
+    finally:
+        inventory.save()
+    print('Indexed %(indexed)d images (%(faces)d faces), skipped %(skipped)d, failed %(failed)d' % counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -118,7 +118,8 @@ def subcmd_bucket_usage(s3, uri):
     bucket = uri.bucket()
     prefix = uri.object()
     try:
-        for _, _, objects in s3.bucket_list_streaming(bucket, prefix=prefix, recursive=True):
+        for _, _, objects in s3.bucket_list_streaming(bucket, prefix=prefix, recursive=True,
+                                                      fields=('Key', 'Size')):
             for obj in objects:
                 bucket_size += int(obj["Size"])
                 object_count += 1
@@ -212,18 +213,19 @@ def subcmd_bucket_list(s3, uri, limit):
             "storageclass": "",
             "uri": uri.compose_uri(bucket, prefix["Prefix"])})
 
+    md5s = {}
+    if cfg.list_md5:
+        ## Multipart ETags are no md5: look up s3cmd-attrs of those objects at once
+        md5s = RemoteAttribs(s3).md5s([(uri.compose_uri(bucket, object["Key"]), object.get('ETag', '').strip('"\''),
+                                        object["LastModified"])
+                                       for object in response["list"] if '-' in object.get('ETag', '')])
+
     for object in response["list"]:
         md5 = object.get('ETag', '').strip('"\'')
         storageclass = object.get('StorageClass','')
 
-        if cfg.list_md5:
-            if '-' in md5: # need to get md5 from the object
-                object_uri = uri.compose_uri(bucket, object["Key"])
-                info_response = s3.object_info(S3Uri(object_uri))
-                try:
-                    md5 = info_response['s3cmd-attrs']['md5']
-                except KeyError:
-                    pass
+        if '-' in md5:
+            md5 = md5s.get(uri.compose_uri(bucket, object["Key"])) or md5
 
         size_and_coeff = formatSize(object["Size"],
                                     Config().human_readable_sizes)
@@ -655,13 +657,16 @@ def cmd_object_del(args):
             rc = subcmd_batch_del(uri_str = uri_str)
         else:
             rc = subcmd_batch_del_iterative(uri_str = uri_str)
-        if not rc:
+        if not rc or rc == EX_PARTIAL:
             return rc
     return EX_OK
 
 def subcmd_batch_del_iterative(uri_str = None, bucket = None):
     """ Streaming version of batch deletion (doesn't realize whole list in memory before deleting).
 
+    Listing pages are handed to BatchDelete as they arrive, so deletion runs
+    alongside the listing with several requests in flight.
+
     Differences from subcmd_batch_del:
       - Does not obey --exclude directives or obey cfg.max_delete (use subcmd_batch_del in those cases)
     """
@@ -674,50 +679,46 @@ def subcmd_batch_del_iterative(uri_str = None, bucket = None):
     uri = S3Uri(uri_str)
     bucket = uri.bucket()
 
-    deleted_bytes = deleted_count = 0
-
+    deleter = BatchDelete(s3, on_deleted = _output_deleted)
     for _, _, to_delete in s3.bucket_list_streaming(bucket, prefix=uri.object(), recursive=True):
-        if not to_delete:
-            continue
-        if not cfg.dry_run:
-            response = s3.object_batch_delete_uri_strs([uri.compose_uri(bucket, item['Key']) for item in to_delete])
-        deleted_bytes += sum(int(item["Size"]) for item in to_delete)
-        deleted_count += len(to_delete)
-        output('\n'.join(u"delete: '%s'" % uri.compose_uri(bucket, p['Key']) for p in to_delete))
+        for item in to_delete:
+            deleter.add(uri.compose_uri(bucket, item['Key']), item['Size'])
+    deleter.close()
 
-    if deleted_count:
+    if deleter.deleted_count:
         # display summary data of deleted files
         if cfg.stats:
             stats_info = StatsInfo()
-            stats_info.files_deleted = deleted_count
-            stats_info.size_deleted = deleted_bytes
+            stats_info.files_deleted = deleter.deleted_count
+            stats_info.size_deleted = deleter.deleted_bytes
             output(stats_info.format_output())
         else:
-            total_size, size_coeff = formatSize(deleted_bytes, Config().human_readable_sizes)
+            total_size, size_coeff = formatSize(deleter.deleted_bytes, Config().human_readable_sizes)
             total_size_str = str(total_size) + size_coeff
-            info(u"Deleted %s objects (%s) from %s" % (deleted_count, total_size_str, uri))
-    else:
+            info(u"Deleted %s objects (%s) from %s" % (deleter.deleted_count, total_size_str, uri))
+    elif not deleter.failed:
         warning(u"Remote list is empty.")
 
-    return EX_OK
+    return deleter.failed and EX_PARTIAL or EX_OK
+
+def _output_deleted(uri_strs):
+    output('\n'.join(u"delete: '%s'" % uri_str for uri_str in uri_strs))
 
 def subcmd_batch_del(uri_str = None, bucket = None, remote_list = None):
     """
-    Returns: EX_OK
+    Returns: EX_OK, EX_PARTIAL when some keys could not be deleted
     Raises: ValueError
     """
     cfg = Config()
     s3 = S3(cfg)
     def _batch_del(remote_list):
-        to_delete = remote_list[:1000]
-        remote_list = remote_list[1000:]
-        while len(to_delete):
-            debug(u"Batch delete %d, remaining %d" % (len(to_delete), len(remote_list)))
-            if not cfg.dry_run:
-                response = s3.object_batch_delete(to_delete)
-            output('\n'.join((u"delete: '%s'" % to_delete[p]['object_uri_str']) for p in to_delete))
-            to_delete = remote_list[:1000]
-            remote_list = remote_list[1000:]
+        deleter = BatchDelete(s3, on_deleted = _output_deleted)
+        ## keys() sorts once; slicing or iterating the FileDict would re-sort
+        for key in remote_list.keys():
+            item = remote_list[key]
+            deleter.add(item['object_uri_str'], item.get('size', 0))
+        deleter.close()
+        return deleter.failed and EX_PARTIAL or EX_OK
 
     if remote_list is not None and len(remote_list) == 0:
         return False
@@ -738,11 +739,11 @@ def subcmd_batch_del(uri_str = None, bucket = None, remote_list = None):
         warning(u"delete: maximum requested number of deletes would be exceeded, none performed.")
         return EX_OK
 
-    _batch_del(remote_list)
+    rc = _batch_del(remote_list)
 
     if cfg.dry_run:
         warning(u"Exiting now because of --dry-run")
-    return EX_OK
+    return rc
 
 def subcmd_object_del_uri(uri_str, recursive = None):
     """
@@ -1093,8 +1094,9 @@ def cmd_sync_remote2remote(args):
         cfg.delete_removed = False
 
     # Delete items in destination that are not in source
+    delete_status = EX_OK
     if cfg.delete_removed and not cfg.delete_after:
-        subcmd_batch_del(remote_list = dst_list)
+        delete_status = subcmd_batch_del(remote_list = dst_list) or EX_OK
         deleted_count = len(dst_list)
 
     def _upload(src_list, seq, src_count):
@@ -1126,6 +1128,8 @@ def cmd_sync_remote2remote(args):
     timestamp_start = time.time()
     seq = 0
     ret, seq, nb_files, size = _upload(src_list, seq, src_count + update_count)
+    if ret == EX_OK:
+        ret = delete_status
     total_files_copied = nb_files
     total_size_copied = size
 
@@ -1153,7 +1157,9 @@ def cmd_sync_remote2remote(args):
 
     # Delete items in destination that are not in source
     if cfg.delete_removed and cfg.delete_after:
-        subcmd_batch_del(remote_list = dst_list)
+        status = subcmd_batch_del(remote_list = dst_list) or EX_OK
+        if ret == EX_OK:
+            ret = status
         deleted_count = len(dst_list)
 
     stats_info.files = orig_src_count
@@ -1662,6 +1668,38 @@ def cmd_sync_local2remote(args):
                     for key in local_list:
                         local_list[key]['remote_uri'] = destination_base + key
 
+        def _resume_put(src, uri, extra_headers, seq_label, upload_id):
+            ## Continue the multipart upload an interrupted sync left behind
+            info(u"Resuming multipart upload %s of '%s'" % (upload_id, src))
+            cfg.upload_id, cfg.put_continue = upload_id, True
+            try:
+                return s3.object_put(src, uri, extra_headers, extra_label = seq_label)
+            except S3Error as exc:
+                warning(u"Could not resume upload of '%s' (%s), starting over" % (src, exc))
+            finally:
+                cfg.upload_id, cfg.put_continue = u"", False
+            return s3.object_put(src, uri, extra_headers, extra_label = seq_label)
+
+        def _copy_existing(item, uri):
+            ## Copy content --content-index knows is in S3 already instead of uploading it
+            source = content_index.find(item.get('md5'), item['size'])
+            if not source or source[0] == uri.uri():
+                return False
+            src_uri_str, etag = source
+            extra_headers = copy(cfg.extra_headers)
+            if etag:
+                extra_headers['x-amz-copy-source-if-match'] = '"%s"' % etag
+            try:
+                s3.object_copy(S3Uri(src_uri_str), uri, extra_headers)
+            except S3Error as exc:
+                warning(u"Unable to remote copy '%s' -> '%s' (%s), uploading instead" % (src_uri_str, uri, exc))
+                content_index.discard(item['md5'])
+                return False
+            output(u"remote copy: '%s' -> '%s'" % (src_uri_str, uri))
+            index_copies['files'] += 1
+            index_copies['size'] += item['size']
+            return True
+
         def _upload(local_list, seq, total, total_size):
             file_list = local_list.keys()
             file_list.sort()
@@ -1670,14 +1708,26 @@ def cmd_sync_local2remote(args):
                 seq += 1
                 item = local_list[file]
                 src = item['full_name']
+                if journal and journal.is_done(item['remote_uri'], item):
+                    info(u"Skipping '%s', already uploaded before the sync was interrupted" % src)
+                    continue
                 uri = S3Uri(item['remote_uri'])
                 seq_label = "[%d of %d]" % (seq, total)
+                if content_index and _copy_existing(item, uri):
+                    uploaded_objects_list.append(uri.object())
+                    if journal:
+                        journal.transferred(item['remote_uri'], item)
+                    continue
                 extra_headers = copy(cfg.extra_headers)
                 try:
                     attr_header = _build_attr_header(local_list, file)
                     debug(u"attr_header: %s" % attr_header)
                     extra_headers.update(attr_header)
-                    response = s3.object_put(src, uri, extra_headers, extra_label = seq_label)
+                    upload_id = journal and journal.upload_id(item['remote_uri'])
+                    if upload_id and not cfg.put_continue:
+                        response = _resume_put(src, uri, extra_headers, seq_label, upload_id)
+                    else:
+                        response = s3.object_put(src, uri, extra_headers, extra_label = seq_label)
                 except S3UploadError as exc:
                     error(u"Upload of '%s' failed too many times (Last reason: %s)" % (item['full_name'], exc))
                     if cfg.stop_on_error:
@@ -1701,11 +1751,27 @@ def cmd_sync_local2remote(args):
                         speed_fmt[0], speed_fmt[1], seq_label))
                 total_size += response["size"]
                 uploaded_objects_list.append(uri.object())
+                if journal:
+                    journal.transferred(item['remote_uri'], item)
+                if content_index:
+                    content_index.add(item.get('md5'), uri.uri(),
+                                      response["headers"].get("etag", "").strip('"\'') or None, response["size"])
             return ret, seq, total_size
 
 
         stats_info = StatsInfo()
 
+        journal = None
+        if cfg.sync_journal and not cfg.dry_run:
+            journal = SyncJournal(cfg.sync_journal, {'sources': [os.path.abspath(arg) for arg in source_args],
+                                                     'destination': destination_base})
+            s3.on_multipart_start = journal.multipart_started
+
+        content_index = None
+        index_copies = {'files': 0, 'size': 0}
+        if cfg.content_index:
+            content_index = ContentIndex(cfg.content_index)
+
         local_list, single_file_local, src_exclude_list, local_total_size = fetch_local_list(args[:-1], is_src = True, recursive = True)
 
         # - The source path is either like "/myPath/my_src_folder" and
@@ -1725,7 +1791,9 @@ def cmd_sync_local2remote(args):
             else:
                 destbase_with_source_list.add(destination_base)
 
-        remote_list, dst_exclude_list, remote_total_size = fetch_remote_list(destbase_with_source_list, recursive = True, require_attribs = True)
+        remote_list, dst_exclude_list, remote_total_size = fetch_remote_list(destbase_with_source_list, recursive = True, require_attribs = True, journal = journal)
+        if content_index:
+            content_index.add_remote_list(remote_list)
 
         local_count = len(local_list)
         orig_local_count = local_count
@@ -1779,13 +1847,16 @@ def cmd_sync_local2remote(args):
             warning(u"delete: cowardly refusing to delete because no source files were found.  Use --force to override.")
             cfg.delete_removed = False
 
+        delete_status = EX_OK
         if cfg.delete_removed and not cfg.delete_after and remote_list:
-            subcmd_batch_del(remote_list = remote_list)
+            delete_status = subcmd_batch_del(remote_list = remote_list) or EX_OK
 
         size_transferred = 0
         total_elapsed = 0.0
         timestamp_start = time.time()
         ret, n, size_transferred = _upload(local_list, 0, upload_count, size_transferred)
+        if ret == EX_OK:
+            ret = delete_status
         status, n, size_transferred = _upload(update_list, n, upload_count, size_transferred)
         if ret == EX_OK:
             ret = status
@@ -1805,7 +1876,18 @@ def cmd_sync_local2remote(args):
             ret = status
 
         if cfg.delete_removed and cfg.delete_after and remote_list:
-            subcmd_batch_del(remote_list = remote_list)
+            status = subcmd_batch_del(remote_list = remote_list) or EX_OK
+            if ret == EX_OK:
+                ret = status
+        if journal:
+            if ret == EX_OK:
+                journal.finish()
+            else:
+                journal.close()
+        if content_index:
+            content_index.save()
+            n_copies += index_copies['files']
+            saved_bytes += index_copies['size']
         total_elapsed = max(1.0, time.time() - timestamp_start)
         total_speed = total_elapsed and size_transferred / total_elapsed or 0.0
         speed_fmt = formatSize(total_speed, human_readable = True, floating_point = True)
@@ -1813,7 +1895,7 @@ def cmd_sync_local2remote(args):
 
         stats_info.files = orig_local_count
         stats_info.size = local_total_size
-        stats_info.files_transferred = upload_count + failed_copy_count
+        stats_info.files_transferred = upload_count + failed_copy_count - index_copies['files']
         stats_info.size_transferred = size_transferred
         stats_info.files_copied = n_copies
         stats_info.size_copied = saved_bytes
@@ -1865,6 +1947,11 @@ def cmd_sync_local2remote(args):
     destinations = [args[-1]]
     if cfg.additional_destinations:
         destinations = destinations + cfg.additional_destinations
+        if cfg.sync_journal:
+            warning(u"--sync-journal is not supported with --add-destination, ignoring it.")
+            cfg.sync_journal = u""
+    if cfg.sync_journal and not cfg.cache_file:
+        cfg.cache_file = cfg.sync_journal + u".md5"
 
     if 'fork' not in os.__all__ or len(destinations) < 2:
         ret = _single_process(args[:-1])
@@ -2681,6 +2768,8 @@ def main():
     optparser.add_option(      "--delete-after", dest="delete_after", action="store_true", help="Perform deletes AFTER new uploads when delete-removed is enabled [sync]")
     optparser.add_option(      "--delay-updates", dest="delay_updates", action="store_true", help="*OBSOLETE* Put all updated files into place at end [sync]")  # OBSOLETE
     optparser.add_option(      "--max-delete", dest="max_delete", action="store", help="Do not delete more than NUM files. [del] and [sync]", metavar="NUM")
+    optparser.add_option(      "--delete-workers", dest="delete_workers", type="int", action="store", metavar="NUM", help="Number of batch delete requests kept in flight for recursive [del] and [sync] --delete-removed (default: %d)" % cfg.delete_workers)
+    optparser.add_option(      "--list-v2", dest="list_v2", action="store_true", help="List buckets with the ListObjectsV2 API (continuation tokens, no owner data)")
     optparser.add_option(      "--limit", dest="limit", action="store", help="Limit number of objects returned in the response body (only for [ls] and [la] commands)", metavar="NUM")
     optparser.add_option(      "--add-destination", dest="additional_destinations", action="append", help="Additional destination for parallel uploads, in addition to last arg.  May be repeated.")
     optparser.add_option(      "--delete-after-fetch", dest="delete_after_fetch", action="store_true", help="Delete remote objects after fetching to local file (only for [get] and [sync] commands).")
@@ -2722,7 +2811,10 @@ def main():
     optparser.add_option(      "--verbatim", dest="urlencoding_mode", action="store_const", const="verbatim", help="Use the S3 name as given on the command line. No pre-processing, encoding, etc. Use with caution!")
 
     optparser.add_option(      "--disable-multipart", dest="enable_multipart", action="store_false", help="Disable multipart upload on files bigger than --multipart-chunk-size-mb")
-    optparser.add_option(      "--multipart-chunk-size-mb", dest="multipart_chunk_size_mb", type="int", action="store", metavar="SIZE", help="Size of each chunk of a multipart upload. Files bigger than SIZE are automatically uploaded as multithreaded-multipart, smaller files are uploaded using the traditional method. SIZE is in Mega-Bytes, default chunk size is 15MB, minimum allowed chunk size is 5MB, maximum is 5GB.")
+    optparser.add_option(      "--multipart-adaptive", dest="multipart_adaptive", action="store_true", help="Size the chunks of each multipart upload from the uploads made earlier in the same run: bigger than --multipart-chunk-size-mb when they were fast, as small as the file allows when many of their chunks needed retries. A single upload keeps the size it started with.")
+    optparser.add_option(      "--no-multipart-adaptive", dest="multipart_adaptive", action="store_false", help="Upload every chunk of a multipart upload with --multipart-chunk-size-mb, or the smallest bigger size that keeps a large file within half of the maximum number of chunks. (default)")
+    optparser.add_option(      "--multipart-verify-workers", dest="multipart_verify_workers", type="int", action="store", metavar="NUM", help="Number of threads hashing the parts already uploaded when continuing a multipart upload (default: %d)" % cfg.multipart_verify_workers)
+    optparser.add_option(      "--multipart-chunk-size-mb", dest="multipart_chunk_size_mb", type="int", action="store", metavar="SIZE", help="Size of each chunk of a multipart upload. Files bigger than SIZE are automatically uploaded as multithreaded-multipart, smaller files are uploaded using the traditional method. Files that would need more than half of the maximum number of chunks use bigger chunks. SIZE is in Mega-Bytes, default chunk size is 15MB, minimum allowed chunk size is 5MB, maximum is 5GB.")
 
     optparser.add_option(      "--list-md5", dest="list_md5", action="store_true", help="Include MD5 sums in bucket listings (only for 'ls' command).")
     optparser.add_option("-H", "--human-readable-sizes", dest="human_readable_sizes", action="store_true", help="Print sizes in human readable form (eg 1kB instead of 1234).")
@@ -2753,6 +2845,10 @@ def main():
     optparser.add_option(      "--version", dest="show_version", action="store_true", help="Show s3cmd version (%s) and exit." % (PkgInfo.version))
     optparser.add_option("-F", "--follow-symlinks", dest="follow_symlinks", action="store_true", default=False, help="Follow symbolic links as if they are regular files")
     optparser.add_option(      "--cache-file", dest="cache_file", action="store", default="",  metavar="FILE", help="Cache FILE containing local source MD5 values")
+    optparser.add_option(      "--head-cache-file", dest="head_cache_file", action="store", default="", metavar="FILE", help="Cache FILE of the MD5 values stored with multipart uploads, so that each object is HEADed only once (default: --cache-file with .heads appended, if set)")
+    optparser.add_option(      "--head-workers", dest="head_workers", type="int", action="store", metavar="NUM", help="Number of HEAD requests kept in flight when looking up MD5 values of multipart uploads (default: %d)" % cfg.head_workers)
+    optparser.add_option(      "--content-index", dest="content_index", action="store", default="", metavar="FILE", help="Index FILE of the MD5 values of objects uploaded or listed by [sync], in any bucket. Files whose content is already in S3 are copied there server-side instead of being uploaded again.")
+    optparser.add_option(      "--sync-journal", dest="sync_journal", action="store", default="", metavar="FILE", help="Journal the progress of [sync] from local to S3 in FILE, so that an interrupted sync run again continues where it stopped. MD5 values are kept in --cache-file (default: FILE.md5).")
     optparser.add_option("-q", "--quiet", dest="quiet", action="store_true", default=False, help="Silence output on stdout")
     optparser.add_option(      "--ca-certs", dest="ca_certs_file", action="store", default=None, help="Path to SSL CA certificate FILE (instead of system default)")
     optparser.add_option(      "--check-certificate", dest="check_ssl_certificate", action="store_true", help="Check SSL certificate validity")
@@ -3095,6 +3191,10 @@ if __name__ == '__main__':
         from S3.CloudFront import CloudFront
         from S3.FileLists import *
         from S3.MultiPart import MultiPartUpload
+        from S3.BatchDelete import BatchDelete
+        from S3.SyncJournal import SyncJournal
+        from S3.RemoteAttribs import RemoteAttribs
+        from S3.ContentIndex import ContentIndex
     except Exception as e:
         report_exception(e, "Error loading some components of s3cmd (Import Error)")
         # 1 = EX_GENERAL but be safe in that situation
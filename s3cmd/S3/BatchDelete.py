@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+## Amazon S3 Multi-Object Delete pipeline
+## License: GPL Version 2
+## Copyright: TGRMN Software and contributors
+
+from __future__ import absolute_import
+
+import threading
+import time
+from logging import debug, info, warning, error
+
+try:
+    import Queue as queue
+except ImportError:
+    # python 3 support
+    import queue
+
+from .Config import Config
+from .Utils import getListFromXml
+
+__all__ = [ "BatchDelete" ]
+
+class BatchDelete(object):
+    """
+    Deletes objects with Multi-Object Delete requests while the caller keeps
+    producing them, e.g. straight from a listing. Keys are grouped into
+    batches of up to BATCH_SIZE per bucket and several requests are kept in
+    flight by worker threads. Requests are sent in quiet mode, so responses
+    only carry the <Error> entries; keys failing with a transient error code
+    are retried on their own, the rest are reported in self.failed.
+    """
+    BATCH_SIZE = 1000
+    RETRY_CODES = ('InternalError', 'ServiceUnavailable', 'SlowDown', 'RequestTimeout', 'OperationAborted')
+
+    def __init__(self, s3, workers = None, retries = 3, on_deleted = None):
+        self.s3 = s3
+        self.cfg = Config()
+        self.workers = max(1, workers or self.cfg.delete_workers)
+        self.retries = retries
+        ## on_deleted(uri_strs) is called from the worker threads, one call at a time
+        self.on_deleted = on_deleted
+        self.deleted_count = 0
+        self.deleted_bytes = 0
+        self.failed = []            # [(uri_str, code, message)]
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize = self.workers * 2)
+        self.bucket = None
+        self.batch = []
+        self.exception = None
+        self.threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target = self._worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, uri_str, size = 0):
+        """Queue s3://bucket/key for deletion; blocks while all workers are busy."""
+        bucket = uri_str[5:].split('/', 1)[0]
+        if bucket != self.bucket or len(self.batch) >= self.BATCH_SIZE:
+            self.flush()
+            self.bucket = bucket
+        self.batch.append((uri_str, size))
+
+    def flush(self):
+        if self.exception:
+            raise self.exception
+        if self.batch:
+            self.queue.put((self.bucket, self.batch))
+            self.batch = []
+
+    def close(self):
+        """Wait for every queued delete; re-raises the first request failure."""
+        self.flush()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.exception:
+            raise self.exception
+        for uri_str, code, message in self.failed:
+            error(u"delete: '%s' failed: %s (%s)" % (uri_str, code, message))
+        return self
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.exception:
+                continue
+            try:
+                self._delete(*item)
+            except Exception as e:
+                self.exception = e
+
+    def _done(self, batch):
+        with self.lock:
+            self.deleted_count += len(batch)
+            self.deleted_bytes += sum(int(size) for uri_str, size in batch)
+            if self.on_deleted:
+                self.on_deleted([uri_str for uri_str, size in batch])
+
+    def _delete(self, bucket, batch):
+        attempt = 0
+        while batch:
+            debug(u"Batch delete %d keys from %s (attempt %d)" % (len(batch), bucket, attempt + 1))
+            if self.cfg.dry_run:
+                self._done(batch)
+                return
+            response = self.s3.object_batch_delete_uri_strs([uri_str for uri_str, size in batch], quiet = True)
+            errors = getListFromXml(response['data'], 'Error')
+            if not errors:
+                self._done(batch)
+                return
+
+            skip = len(bucket) + 6      # len("s3://bucket/")
+            by_key = dict((uri_str[skip:], (uri_str, size)) for uri_str, size in batch)
+            retry = []
+            for err in errors:
+                item = by_key.pop(err.get('Key'), None)
+                if item is None:
+                    continue
+                if err.get('Code') in self.RETRY_CODES and attempt < self.retries:
+                    retry.append(item)
+                else:
+                    with self.lock:
+                        self.failed.append((item[0], err.get('Code'), err.get('Message')))
+            self._done(list(by_key.values()))
+
+            batch = retry
+            attempt += 1
+            if batch:
+                warning(u"Batch delete: retrying %d keys in %s" % (len(batch), bucket))
+                time.sleep(self.s3._fail_wait(self.s3._max_retries - attempt + 1))
+
+# vim:et:ts=4:sts=4:ai
@@ -140,7 +140,10 @@ class Config(object):
     delete_after = False
     delete_after_fetch = False
     max_delete = -1
+    delete_workers = 4
+    head_workers = 8
     limit = -1
+    list_v2 = False
     _doc['delete_removed'] = u"[sync] Remove remote S3 objects when local file has been deleted"
     delay_updates = False  # OBSOLETE
     gpg_passphrase = u""
@@ -159,6 +162,8 @@ class Config(object):
     enable_multipart = True
     multipart_chunk_size_mb = 15    # MB
     multipart_max_chunks = 10000    # Maximum chunks on AWS S3, could be different on other S3-compatible APIs
+    multipart_adaptive = False      # Size the chunks of each upload from the speed and retries of earlier ones
+    multipart_verify_workers = 4    # Threads hashing uploaded parts for --continue-put
     # List of checks to be performed for 'sync'
     sync_checks = ['size', 'md5']   # 'weak-timestamp'
     # List of compiled REGEXPs
@@ -186,6 +191,9 @@ class Config(object):
     additional_destinations = []
     files_from = []
     cache_file = u""
+    sync_journal = u""
+    head_cache_file = u""
+    content_index = u""
     add_headers = u""
     remove_headers = []
     expiry_days = u""
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+## Persistent index of content already stored in S3
+## License: GPL Version 2
+## Copyright: TGRMN Software and contributors
+
+from __future__ import absolute_import
+
+import os
+from logging import debug, info, warning, error
+
+try:
+    # python 3 support
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .FileDict import zero_length_md5
+from .Utils import deunicodise
+
+__all__ = [ "ContentIndex" ]
+
+class ContentIndex(object):
+    """
+    md5 -> (uri, ETag, size) of objects uploaded or seen in listings, kept
+    in one file across syncs and buckets. A sync looks new files up here
+    and copies the object server-side instead of uploading the same bytes
+    again. The ETag makes the copy conditional, so an object overwritten
+    since it was indexed is not copied; entries found stale are discarded.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(deunicodise(path)):
+            try:
+                with open(deunicodise(path), 'rb') as fp:
+                    d = pickle.load(fp)
+                if d.get('version') == self.VERSION:
+                    self.entries = d['entries']
+            except Exception as e:
+                warning(u"Ignoring unreadable content index %s: %s" % (path, e))
+        debug(u"Content index %s: %d entries" % (path, len(self.entries)))
+
+    def add(self, md5, uri_str, etag, size):
+        if not md5 or md5 == zero_length_md5 or '-' in md5:
+            return
+        if self.entries.get(md5) != (uri_str, etag, size):
+            self.entries[md5] = (uri_str, etag, size)
+            self.changed = True
+
+    def add_remote_list(self, remote_list):
+        for key in remote_list:
+            item = remote_list[key]
+            if 'md5' in item and 'size' in item:
+                self.add(item['md5'], item['object_uri_str'], item.get('etag'), item['size'])
+
+    def find(self, md5, size):
+        """(uri, etag) of an object holding the content, or None."""
+        entry = self.entries.get(md5)
+        if entry is None or entry[2] != size:
+            return None
+        return entry[0], entry[1]
+
+    def discard(self, md5):
+        if self.entries.pop(md5, None):
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        d = dict(entries = self.entries, version = self.VERSION)
+        tmp = self.path + u".tmp"
+        with open(deunicodise(tmp), 'wb') as fp:
+            pickle.dump(d, fp)
+        os.rename(deunicodise(tmp), deunicodise(self.path))
+        self.changed = False
+
+# vim:et:ts=4:sts=4:ai
@@ -65,7 +65,7 @@ def sign_string_v2(string_to_sign):
     string_to_sign should be utf-8 "bytes".
     """
     secret_key = Config.Config().secret_key
-    signature = base64.encodestring(hmac.new(encode_to_s3(secret_key), string_to_sign, sha1).digest()).strip()
+    signature = base64.b64encode(hmac.new(encode_to_s3(secret_key), string_to_sign, sha1).digest()).strip()
     return signature
 __all__.append("sign_string_v2")
 
@@ -267,7 +267,8 @@ def s3_quote(param, quote_backslashes=True, unicode_output=False):
     return param
 __all__.append("s3_quote")
 
-def checksum_sha256_file(filename, offset=0, size=None):
+def checksum_sha256_file(filename, offset=0, size=None, md5_hash=None):
+    """md5_hash, if given, is fed the same data in the same read."""
     try:
         hash = sha256()
     except:
@@ -277,24 +278,31 @@ def checksum_sha256_file(filename, offset=0, size=None):
         if size is None:
             for chunk in iter(lambda: f.read(8192), b''):
                 hash.update(chunk)
+                if md5_hash:
+                    md5_hash.update(chunk)
         else:
             f.seek(offset)
             size_left = size
             while size_left > 0:
                 chunk = f.read(min(8192, size_left))
+                if not chunk:
+                    break
                 size_left -= len(chunk)
                 hash.update(chunk)
+                if md5_hash:
+                    md5_hash.update(chunk)
 
     return hash
 
-def checksum_sha256_buffer(buffer, offset=0, size=None):
+def checksum_sha256_buffer(buffer, offset=0, size=None, md5_hash=None):
     try:
         hash = sha256()
     except:
         # fallback to Crypto SHA256 module
         hash = sha256.new()
-    if size is None:
-        hash.update(buffer)
-    else:
-        hash.update(buffer[offset:offset+size])
+    if size is not None:
+        buffer = buffer[offset:offset+size]
+    hash.update(buffer)
+    if md5_hash:
+        md5_hash.update(buffer)
     return hash
@@ -21,6 +21,7 @@ class FileDict(SortedDict):
         SortedDict.__init__(self, mapping = mapping or {}, ignore_case = ignore_case, **kwargs)
         self.hardlinks_md5 = dict() # { dev: { inode : {'md5':, 'relative_files':}}}
         self.by_md5 = dict() # {md5: set(relative_files)}
+        self.hash_cache = None # HashCache of local files, for multipart ETags
 
     def record_md5(self, relative_file, md5):
         if not relative_file:
@@ -50,6 +51,43 @@ class FileDict(SortedDict):
         self[relative_file]['md5'] = md5
         return md5
 
+    def get_multipart_etag(self, relative_file, remote_etag):
+        """
+        ETag of the local file uploaded in as many parts as remote_etag has:
+        remote_etag itself if one of the likely part sizes gives it. Another
+        ETag only when the part size is certain, that is when no other part
+        size could split the file into that many parts; None otherwise, as
+        the remote object may just have been sent in parts of a size not
+        tried here. Raises IOError if the file is unreadable.
+        """
+        try:
+            parts = int(remote_etag.rsplit('-', 1)[1])
+        except (IndexError, ValueError):
+            return None
+        item = self[relative_file]
+        chunk_size_mb = Utils.multipart_chunk_size_mb(item['size'], cfg.multipart_chunk_size_mb, cfg.multipart_max_chunks)
+        part_sizes = Utils.multipart_part_sizes(item['size'], parts, chunk_size_mb)
+        if not part_sizes:
+            return None
+        etags = {}
+        if self.hash_cache:
+            for part_size in part_sizes:
+                etag = self.hash_cache.etag(item['dev'], item['inode'], item['mtime'], item['size'], part_size)
+                if etag:
+                    etags[part_size] = etag
+        missing = [part_size for part_size in part_sizes if part_size not in etags]
+        if remote_etag not in etags.values() and missing:
+            logging.debug(u"doing file I/O to compute multipart ETags of %s" % relative_file)
+            for part_size, etag in Utils.hash_file_multipart_etags(item['full_name'], missing).items():
+                etags[part_size] = etag
+                if self.hash_cache:
+                    self.hash_cache.add_etag(item['dev'], item['inode'], item['mtime'], item['size'], part_size, etag)
+        if remote_etag in etags.values():
+            return remote_etag
+        if parts == 1 or -(-item['size'] // parts) == (item['size'] - 1) // (parts - 1):
+            return etags[part_sizes[0]]
+        return None
+
     def record_hardlink(self, relative_file, dev, inode, md5, size):
         if md5 is None:
             return
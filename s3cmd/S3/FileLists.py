@@ -15,6 +15,7 @@ from .FileDict import FileDict
 from .Utils import *
 from .Exceptions import ParameterError
 from .HashCache import HashCache
+from .RemoteAttribs import RemoteAttribs
 
 from logging import debug, info, warning
 
@@ -24,6 +25,7 @@ import glob
 import re
 import errno
 import io
+import time
 
 __all__ = ["fetch_local_list", "fetch_remote_list", "compare_filelists"]
 
@@ -197,6 +199,7 @@ def fetch_local_list(args, is_src = False, recursive = None):
         total_size = 0
         info(u"Running stat() and reading/calculating MD5 values on %d files, this may take some time..." % len_loc_list)
         counter = 0
+        saved = time.time()
         for relative_file in loc_list:
             counter += 1
             if counter % 1000 == 0:
@@ -232,6 +235,10 @@ def fetch_local_list(args, is_src = False, recursive = None):
                         except IOError:
                             continue
                         cache.add(sr.st_dev, sr.st_ino, sr.st_mtime, sr.st_size, md5)
+                        if cfg.sync_journal and cfg.cache_file and time.time() - saved > 30:
+                            ## Keep the hashes done so far should this sync be interrupted
+                            cache.save(cfg.cache_file)
+                            saved = time.time()
                 loc_list.record_hardlink(relative_file, sr.st_dev, sr.st_ino, md5, sr.st_size)
         return total_size
 
@@ -351,9 +358,10 @@ def fetch_local_list(args, is_src = False, recursive = None):
     local_list, exclude_list = filter_exclude_include(local_list)
     total_size = _fetch_local_list_info(local_list)
     _maintain_cache(cache, local_list)
+    local_list.hash_cache = cache
     return local_list, single_file, exclude_list, total_size
 
-def fetch_remote_list(args, require_attribs = False, recursive = None, uri_params = {}):
+def fetch_remote_list(args, require_attribs = False, recursive = None, uri_params = {}, journal = None):
     def _get_remote_attribs(uri, remote_item):
         response = S3(cfg).object_info(uri)
         if not response.get('headers'):
@@ -371,7 +379,7 @@ def fetch_remote_list(args, require_attribs = False, recursive = None, uri_param
         except KeyError:
             pass
 
-    def _get_filelist_remote(remote_uri, recursive = True):
+    def _get_filelist_remote(remote_uri, recursive = True, journal = None):
         ## If remote_uri ends with '/' then all remote files will have
         ## the remote_uri prefix removed in the relative path.
         ## If, on the other hand, the remote_uri ends with something else
@@ -393,8 +401,13 @@ def fetch_remote_list(args, require_attribs = False, recursive = None, uri_param
         total_size = 0
 
         s3 = S3(Config())
-        response = s3.bucket_list(remote_uri.bucket(), prefix = remote_uri.object(),
-                                  recursive = recursive, uri_params = uri_params)
+        fields = ('Key', 'Size', 'LastModified', 'ETag')
+        if journal:
+            ## Listing pages already journaled by an interrupted sync are reused
+            response = {'list': journal.remote_listing(s3, remote_uri, recursive, uri_params, fields)}
+        else:
+            response = s3.bucket_list(remote_uri.bucket(), prefix = remote_uri.object(),
+                                      recursive = recursive, uri_params = uri_params, fields = fields)
 
         rem_base_original = rem_base = remote_uri.object()
         remote_uri_original = remote_uri
@@ -403,6 +416,7 @@ def fetch_remote_list(args, require_attribs = False, recursive = None, uri_param
             remote_uri = S3Uri(u"s3://%s/%s" % (remote_uri.bucket(), rem_base))
         rem_base_len = len(rem_base)
         rem_list = FileDict(ignore_case = False)
+        multipart = []
         break_now = False
         for object in response['list']:
             if object['Key'] == rem_base_original and object['Key'][-1] != "/":
@@ -422,6 +436,7 @@ def fetch_remote_list(args, require_attribs = False, recursive = None, uri_param
                 'size' : int(object['Size']),
                 'timestamp' : dateS3toUnix(object['LastModified']), ## Sadly it's upload time, not our lastmod time :-(
                 'md5' : object['ETag'].strip('"\''),
+                'etag' : object['ETag'].strip('"\''),
                 'object_key' : object['Key'],
                 'object_uri_str' : object_uri_str,
                 'base_uri' : remote_uri,
@@ -429,12 +444,24 @@ def fetch_remote_list(args, require_attribs = False, recursive = None, uri_param
                 'inode' : None,
             }
             if '-' in rem_list[key]['md5']: # always get it for multipart uploads
-                _get_remote_attribs(S3Uri(object_uri_str), rem_list[key])
-            md5 = rem_list[key]['md5']
-            rem_list.record_md5(key, md5)
+                multipart.append((key, object['LastModified']))
+            else:
+                rem_list.record_md5(key, rem_list[key]['md5'])
             total_size += int(object['Size'])
             if break_now:
                 break
+        if multipart:
+            ## HEAD them all at once, skipping those cached by an earlier run
+            attribs = RemoteAttribs(s3)
+            md5s = attribs.md5s([(rem_list[key]['object_uri_str'], rem_list[key]['md5'], last_modified)
+                                 for key, last_modified in multipart if key in rem_list])
+            for key, last_modified in multipart:
+                if key not in rem_list:
+                    continue
+                md5 = md5s.get(rem_list[key]['object_uri_str'])
+                if md5:
+                    rem_list[key]['md5'] = md5
+                rem_list.record_md5(key, rem_list[key]['md5'])
         return rem_list, total_size
 
     cfg = Config()
@@ -457,7 +484,7 @@ def fetch_remote_list(args, require_attribs = False, recursive = None, uri_param
 
     if recursive:
         for uri in remote_uris:
-            objectlist, tmp_total_size = _get_filelist_remote(uri, recursive = True)
+            objectlist, tmp_total_size = _get_filelist_remote(uri, recursive = True, journal = journal)
             total_size += tmp_total_size
             for key in objectlist:
                 remote_list[key] = objectlist[key]
@@ -524,9 +551,22 @@ def compare_filelists(src_list, dst_list, src_remote, dst_remote):
         compare_md5 = 'md5' in cfg.sync_checks
         # Multipart-uploaded files don't have a valid md5 sum - it ends with "...-nn"
         if compare_md5:
-            if (src_remote == True and '-' in src_list[file]['md5']) or (dst_remote == True and '-' in dst_list[file]['md5']):
+            src_multipart = src_remote == True and '-' in src_list[file]['md5']
+            dst_multipart = dst_remote == True and '-' in dst_list[file]['md5']
+            if src_multipart or dst_multipart:
                 compare_md5 = False
-                info(u"disabled md5 check for %s" % file)
+                etag = None
+                if attribs_match and src_remote != dst_remote:
+                    ## Compute the local file's multipart ETag instead
+                    if src_multipart:
+                        remote_etag, etag = src_list[file]['md5'], dst_list.get_multipart_etag(file, src_list[file]['md5'])
+                    else:
+                        remote_etag, etag = dst_list[file]['md5'], src_list.get_multipart_etag(file, dst_list[file]['md5'])
+                    if etag is not None and etag != remote_etag:
+                        attribs_match = False
+                        debug(u"XFER: %s (multipart etag mismatch: remote=%s local=%s)" % (file, remote_etag, etag))
+                if etag is None:
+                    info(u"disabled md5 check for %s" % file)
         if attribs_match and compare_md5:
             try:
                 src_md5 = src_list.get_md5(file)
@@ -628,6 +668,11 @@ def compare_filelists(src_list, dst_list, src_remote, dst_remote):
             # leave only those not on src_list + update_list
             del dst_list[f]
 
+    ## Keep the multipart ETags computed above for the next run
+    for file_list in (src_list, dst_list):
+        if cfg.cache_file and file_list.hash_cache and file_list.hash_cache.changed:
+            file_list.hash_cache.save(cfg.cache_file)
+
     return src_list, dst_list, update_list, copy_pairs
 
 # vim:et:ts=4:sts=4:ai
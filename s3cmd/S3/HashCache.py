@@ -12,6 +12,7 @@ from .Utils import deunicodise
 class HashCache(object):
     def __init__(self):
         self.inodes = dict()
+        self.changed = False
 
     def add(self, dev, inode, mtime, size, md5):
         if dev == 0 or inode == 0: return # Windows
@@ -19,7 +20,11 @@ class HashCache(object):
             self.inodes[dev] = dict()
         if inode not in self.inodes[dev]:
             self.inodes[dev][inode] = dict()
-        self.inodes[dev][inode][mtime] = dict(md5=md5, size=size)
+        ## Keep multipart ETags add_etag() recorded for the same file
+        d = self.inodes[dev][inode].get(mtime)
+        if d is None or d['size'] != size:
+            d = self.inodes[dev][inode][mtime] = dict(size=size)
+        d['md5'] = md5
 
     def md5(self, dev, inode, mtime, size):
         try:
@@ -30,6 +35,24 @@ class HashCache(object):
             return None
         return d['md5']
 
+    def add_etag(self, dev, inode, mtime, size, part_size, etag):
+        """Multipart ETag of the file for the given part size, kept next to its md5."""
+        if dev == 0 or inode == 0: return # Windows
+        d = self.inodes.setdefault(dev, dict()).setdefault(inode, dict()).get(mtime)
+        if d is None or d['size'] != size:
+            d = self.inodes[dev][inode][mtime] = dict(md5=None, size=size)
+        d.setdefault('etags', dict())[part_size] = etag
+        self.changed = True
+
+    def etag(self, dev, inode, mtime, size, part_size):
+        try:
+            d = self.inodes[dev][inode][mtime]
+            if d['size'] != size:
+                return None
+        except KeyError:
+            return None
+        return d.get('etags', {}).get(part_size)
+
     def mark_all_for_purge(self):
         for d in self.inodes.keys():
             for i in self.inodes[d].keys():
@@ -46,7 +69,7 @@ class HashCache(object):
 
     def purge(self):
         for d in self.inodes.keys():
-            for i in self.inodes[d].keys():
+            for i in list(self.inodes[d].keys()):
                 for m in self.inodes[d][i].keys():
                     if 'purge' in self.inodes[d][i][m]:
                         del self.inodes[d][i]
@@ -56,6 +79,7 @@ class HashCache(object):
         d = dict(inodes=self.inodes, version=1)
         with open(deunicodise(f), 'wb') as fp:
             pickle.dump(d, fp)
+        self.changed = False
 
     def load(self, f):
         with open(deunicodise(f), 'rb') as fp:
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+## Amazon S3 bucket listing parser
+## License: GPL Version 2
+## Copyright: TGRMN Software and contributors
+
+from __future__ import absolute_import
+
+import io
+import sys
+import xml.etree.ElementTree as ET
+
+from .Utils import decode_from_s3
+
+if sys.version_info >= (3,0):
+    PY3 = True
+else:
+    PY3 = False
+
+__all__ = [ "ListObject", "parseListing" ]
+
+class ListObject(object):
+    """
+    One <Contents> entry of a bucket listing. Fields are the element names,
+    and the record can be read like the dicts getListFromXml used to return:
+    obj['Key'], obj.get('StorageClass', ''), 'Owner' in obj.
+    """
+    __slots__ = ('Key', 'LastModified', 'ETag', 'Size', 'StorageClass', 'Owner')
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def get(self, name, default = None):
+        return getattr(self, name, default)
+
+    def __contains__(self, name):
+        return hasattr(self, name)
+
+    def keys(self):
+        return [name for name in self.__slots__ if hasattr(self, name)]
+
+    def __repr__(self):
+        return repr(dict((name, getattr(self, name)) for name in self.keys()))
+
+def parseListing(data, fields = None):
+    """
+    Parse a ListBucketResult in a single pass.
+    fields: ListObject fields to fill in (e.g. ('Key', 'Size')), default all.
+    Returns (objects, prefixes, info): ListObject records, [{'Prefix': ...}]
+    for the CommonPrefixes and a dict with the other top-level elements
+    (IsTruncated, NextMarker, NextContinuationToken, ...). Each <Contents> element is released
+    as soon as its record is built.
+    """
+    objects = []
+    prefixes = []
+    info = {}
+    names = {}
+    fields = fields or ListObject.__slots__
+    events = ET.iterparse(io.BytesIO(data), ('end',))
+    for event, elem in events:
+        tag = elem.tag
+        name = names.get(tag)
+        if name is None:
+            name = names[tag] = tag[tag.rfind('}') + 1:]
+        if name == 'Contents':
+            record = ListObject()
+            for child in elem:
+                field = names.get(child.tag)
+                if field == 'Owner' and field in fields:
+                    record.Owner = [dict((names[c.tag], decode_from_s3(c.text or u"")) for c in child)]
+                elif field in fields:
+                    text = child.text or u""
+                    setattr(record, field, text if PY3 else decode_from_s3(text))
+            objects.append(record)
+            elem.clear()
+        elif name == 'CommonPrefixes':
+            for child in elem:
+                prefixes.append({'Prefix': decode_from_s3(child.text or u"")})
+            elem.clear()
+    ## Whatever else sits directly under the root: IsTruncated, NextMarker, KeyCount, ...
+    for elem in events.root:
+        name = names[elem.tag]
+        if name != 'Contents' and name != 'CommonPrefixes':
+            info[name] = decode_from_s3(elem.text or u"")
+    return objects, prefixes, info
+
+# vim:et:ts=4:sts=4:ai
@@ -8,9 +8,95 @@ from __future__ import absolute_import
 
 import os
 import sys
+import time
+import threading
 from stat import ST_SIZE
 from logging import debug, info, warning, error
-from .Utils import getTextFromXml, getTreeFromXml, formatSize, unicodise, deunicodise, calculateChecksum, parseNodes, encode_to_s3
+from .Utils import getTextFromXml, getTreeFromXml, formatSize, unicodise, deunicodise, calculateChecksum, parseNodes, encode_to_s3, composeCompleteMultipartXml, hash_file_md5, multipart_chunk_size_mb
+
+try:
+    import Queue as queue
+except ImportError:
+    # python 3 support
+    import queue
+
+class PartSizer(object):
+    """
+    Part size of a multipart upload from a file: --multipart-chunk-size-mb,
+    raised to keep the file within half of multipart_max_chunks parts.
+    With multipart_adaptive, it is also raised to TARGET_SECONDS of sending
+    at the throughput earlier uploads of this run achieved, or lowered to
+    the smallest size the file allows once more than FLAKY_RATE of their
+    parts needed retries. The size is chosen once per upload: every part
+    but the last has the same size, so the ETag S3 gives the object can be
+    computed again from the file. A resumed upload keeps the size its first
+    part was sent with.
+    """
+    TARGET_SECONDS = 15.0
+    FLAKY_RATE = 0.2
+    MIN_SIZE = 5 * 1024 * 1024
+    MAX_SIZE = 5120 * 1024 * 1024
+
+    speed = None                # bytes/s over the parts sent so far, all uploads
+    retry_rate = 0.0            # share of those parts that needed retries
+
+    def __init__(self, config, file_size):
+        self.adaptive = config.multipart_adaptive
+        self.max_parts = config.multipart_max_chunks
+        self.size = multipart_chunk_size_mb(file_size, config.multipart_chunk_size_mb, self.max_parts) * 1024 * 1024
+        self.sent = []          # [(size, seconds, retried)]
+        if self.adaptive:
+            if PartSizer.retry_rate > self.FLAKY_RATE:
+                ## A retry resends a whole part: keep them small
+                self.size = multipart_chunk_size_mb(file_size, self.MIN_SIZE // (1024 * 1024), self.max_parts) * 1024 * 1024
+            elif PartSizer.speed:
+                self.size = max(self.size, self._round(min(PartSizer.speed * self.TARGET_SECONDS, file_size)))
+            debug("MultiPart: %d%sB parts for %d%sB"
+                  % (formatSize(self.size, True) + formatSize(file_size, True)))
+
+    def _round(self, size):
+        mb = 1024 * 1024
+        return int(min(self.MAX_SIZE, max(self.MIN_SIZE, -(-int(size) // mb) * mb)))
+
+    def follow(self, remote_statuses):
+        """Continue with the part size of the parts an interrupted upload left behind."""
+        first = remote_statuses.get(1)
+        if first and int(first['size']) >= self.MIN_SIZE:
+            self.size = int(first['size'])
+
+    def next_size(self, size_left, seq, remote_status = None):
+        if remote_status is not None:
+            remote_size = int(remote_status['size'])
+            if remote_size == size_left or self.MIN_SIZE <= remote_size < size_left:
+                return remote_size
+        return min(self.size, size_left)
+
+    def parts_left(self, size_left):
+        return -(-size_left // self.size)
+
+    def part_sent(self, size, seconds, response):
+        """Account for a part that took 'seconds' to upload, retries included."""
+        if response is None:
+            return      # skipped, already uploaded
+        elapsed = response.get('elapsed') or seconds
+        ## send_file() waits at least 3 seconds before each retry
+        retried = seconds - elapsed > 1.0
+        self.sent.append((size, elapsed, retried))
+        if not self.adaptive:
+            return
+        ## Retries count in the throughput, to keep later parts small enough
+        speed = size / max(seconds, 0.001)
+        PartSizer.speed = PartSizer.speed is None and speed or 0.7 * PartSizer.speed + 0.3 * speed
+        PartSizer.retry_rate = 0.7 * PartSizer.retry_rate + 0.3 * (retried and 1.0 or 0.0)
+
+    def log_stats(self):
+        if not self.sent:
+            return
+        elapsed = sum(elapsed for size, elapsed, retried in self.sent)
+        debug("MultiPart: sent %d parts of %d%sB at %d%sB/s, %d retried"
+              % ((len(self.sent),) + formatSize(self.size, True)
+                 + formatSize(sum(size for size, elapsed, retried in self.sent) / max(elapsed, 0.001), True)
+                 + (len([1 for size, elapsed, retried in self.sent if retried]),)))
 
 class MultiPartUpload(object):
 
@@ -93,35 +179,45 @@ class MultiPartUpload(object):
 
         if filename != u"<stdin>":
                 size_left = file_size = os.stat(deunicodise(filename))[ST_SIZE]
-                nr_parts = file_size // self.chunk_size + (file_size % self.chunk_size and 1)
-                debug("MultiPart: Uploading %s in %d parts" % (filename, nr_parts))
+                sizer = PartSizer(self.s3.config, file_size)
+                debug("MultiPart: Uploading %s in about %d parts" % (filename, sizer.parts_left(file_size)))
         else:
             debug("MultiPart: Uploading from %s" % filename)
 
         remote_statuses = dict()
+        checksums = dict()
         if self.s3.config.put_continue:
             remote_statuses = self.get_parts_information(self.uri, self.upload_id)
+            if filename != u"<stdin>" and remote_statuses:
+                sizer.follow(remote_statuses)
+                checksums = self.checksum_remote_parts(filename, file_size, sizer, remote_statuses)
 
         if extra_label:
             extra_label = u' ' + extra_label
         seq = 1
         if filename != u"<stdin>":
+            offset = 0
             while size_left > 0:
-                offset = self.chunk_size * (seq - 1)
-                current_chunk_size = min(file_size - offset, self.chunk_size)
+                current_chunk_size = sizer.next_size(size_left, seq, remote_statuses.get(seq))
                 size_left -= current_chunk_size
+                nr_parts = seq + sizer.parts_left(size_left)
                 labels = {
                     'source' : filename,
                     'destination' : self.uri.uri(),
                     'extra' : "[part %d of %d, %s]%s" % (seq, nr_parts, "%d%sB" % formatSize(current_chunk_size, human_readable = True), extra_label)
                 }
+                timestamp_start = time.time()
                 try:
-                    self.upload_part(seq, offset, current_chunk_size, labels, remote_status = remote_statuses.get(seq))
+                    response = self.upload_part(seq, offset, current_chunk_size, labels, remote_status = remote_statuses.get(seq),
+                                                checksum = checksums.get(seq))
                 except:
                     error(u"\nUpload of '%s' part %d failed. Use\n  %s abortmp %s %s\nto abort the upload, or\n  %s --upload-id %s put ...\nto continue the upload."
                           % (filename, seq, sys.argv[0], self.uri, self.upload_id, sys.argv[0], self.upload_id))
                     raise
+                sizer.part_sent(current_chunk_size, time.time() - timestamp_start, response)
+                offset += current_chunk_size
                 seq += 1
+            sizer.log_stats()
         else:
             while True:
                 buffer = self.file_stream.read(self.chunk_size)
@@ -144,17 +240,67 @@ class MultiPartUpload(object):
 
         debug("MultiPart: Upload finished: %d parts", seq - 1)
 
-    def upload_part(self, seq, offset, chunk_size, labels, buffer = '', remote_status = None):
+    def checksum_remote_parts(self, filename, file_size, sizer, remote_statuses):
+        """
+        md5 of the local data of every part an interrupted upload left behind,
+        hashed by up to multipart_verify_workers threads at once.
+        Returns {seq: md5}.
+        """
+        ranges = []
+        seq, offset = 1, 0
+        while seq in remote_statuses and offset < file_size:
+            size = sizer.next_size(file_size - offset, seq, remote_statuses[seq])
+            if size != int(remote_statuses[seq]['size']):
+                break
+            ranges.append((seq, offset, size))
+            offset += size
+            seq += 1
+        if not ranges:
+            return {}
+
+        checksums = {}
+        work = queue.Queue()
+        for item in ranges:
+            work.put(item)
+        errors = []
+
+        def _worker():
+            while not errors:
+                try:
+                    seq, offset, size = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    checksums[seq] = hash_file_md5(filename, offset, size)
+                except Exception as e:
+                    errors.append(e)
+
+        timestamp_start = time.time()
+        workers = max(1, min(self.s3.config.multipart_verify_workers, len(ranges)))
+        threads = [threading.Thread(target = _worker) for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        debug("MultiPart: hashed %d uploaded parts (%d%sB) in %.1fs with %d threads"
+              % ((len(ranges),) + formatSize(offset, True) + (time.time() - timestamp_start, workers)))
+        return checksums
+
+    def upload_part(self, seq, offset, chunk_size, labels, buffer = '', remote_status = None, checksum = None):
         """
         Upload a file chunk
         http://docs.amazonwebservices.com/AmazonS3/latest/API/index.html?mpUploadUploadPart.html
+        The part is sent with Content-MD5, hashed in the same read as its signature.
+        checksum: md5 of the part if already known, to compare with remote_status.
         """
-        # TODO implement Content-MD5
         debug("Uploading part %i of %r (%s bytes)" % (seq, self.upload_id, chunk_size))
 
         if remote_status is not None:
             if int(remote_status['size']) == chunk_size:
-                checksum = calculateChecksum(buffer, self.file_stream, offset, chunk_size, self.s3.config.send_chunk)
+                checksum = checksum or calculateChecksum(buffer, self.file_stream, offset, chunk_size, self.s3.config.send_chunk)
                 remote_checksum = remote_status['checksum'].strip('"\'')
                 if remote_checksum == checksum:
                     warning("MultiPart: size and md5sum match for %s part %d, skipping." % (self.uri, seq))
@@ -173,7 +319,8 @@ class MultiPartUpload(object):
         request = self.s3.create_request("OBJECT_PUT", uri = self.uri,
                                          headers = headers,
                                          uri_params = query_string_params)
-        response = self.s3.send_file(request, self.file_stream, labels, buffer, offset = offset, chunk_size = chunk_size)
+        response = self.s3.send_file(request, self.file_stream, labels, buffer, offset = offset, chunk_size = chunk_size,
+                                     content_md5 = True)
         self.parts[seq] = response["headers"].get('etag', '').strip('"\'')
         return response
 
@@ -184,13 +331,9 @@ class MultiPartUpload(object):
         """
         debug("MultiPart: Completing upload: %s" % self.upload_id)
 
-        parts_xml = []
-        part_xml = "<Part><PartNumber>%i</PartNumber><ETag>%s</ETag></Part>"
-        for seq, etag in self.parts.items():
-            parts_xml.append(part_xml % (seq, etag))
-        body = "<CompleteMultipartUpload>%s</CompleteMultipartUpload>" % ("".join(parts_xml))
+        body, body_md5 = composeCompleteMultipartXml(self.parts)
 
-        headers = { "content-length": str(len(body)) }
+        headers = { "content-length": str(len(body)), "content-md5": body_md5 }
         request = self.s3.create_request("OBJECT_POST", uri = self.uri,
                                          headers = headers, body = body,
                                          uri_params = {'uploadId': self.upload_id})
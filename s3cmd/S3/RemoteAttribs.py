@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+## Concurrent HEAD lookups of s3cmd-attrs, cached on disk
+## License: GPL Version 2
+## Copyright: TGRMN Software and contributors
+
+from __future__ import absolute_import
+
+import os
+import threading
+from logging import debug, info, warning, error
+
+try:
+    import Queue as queue
+except ImportError:
+    # python 3 support
+    import queue
+
+try:
+    # python 3 support
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .Config import Config
+from .S3Uri import S3Uri
+from .Utils import deunicodise
+
+__all__ = [ "RemoteAttribs" ]
+
+class RemoteAttribs(object):
+    """
+    The md5 s3cmd stored in x-amz-meta-s3cmd-attrs, for objects whose ETag
+    is not one (multipart uploads). Objects are HEADed by a pool of worker
+    threads, and the answers are kept in --head-cache-file keyed by
+    (uri, ETag, LastModified): an object that has not been rewritten since
+    is not HEADed again. Objects without the attribute are cached as None.
+    The file is read once per run and shared by all its listings; only the
+    entries they looked up or added are saved, so those of objects since
+    rewritten or deleted are dropped.
+    """
+    VERSION = 1
+
+    ## cache_file -> (entries, keys used this run, keys in the file)
+    loaded = {}
+
+    def __init__(self, s3, workers = None, cache_file = None):
+        self.s3 = s3
+        self.cfg = Config()
+        self.workers = max(1, workers or self.cfg.head_workers)
+        ## Next to the local MD5 cache unless given a file of its own
+        self.cache_file = cache_file or self.cfg.head_cache_file or \
+                          (self.cfg.cache_file and self.cfg.cache_file + u".heads")
+        self.lock = threading.Lock()
+        if self.cache_file in RemoteAttribs.loaded:
+            self.entries, self.used, self.saved = RemoteAttribs.loaded[self.cache_file]
+            return
+        self.entries, self.used, self.saved = {}, set(), set()
+        if self.cache_file and os.path.exists(deunicodise(self.cache_file)):
+            try:
+                with open(deunicodise(self.cache_file), 'rb') as fp:
+                    d = pickle.load(fp)
+                if d.get('version') == self.VERSION:
+                    self.entries = d['entries']
+                    self.saved.update(self.entries)
+            except Exception as e:
+                warning(u"Ignoring unreadable HEAD cache %s: %s" % (self.cache_file, e))
+        if self.cache_file:
+            RemoteAttribs.loaded[self.cache_file] = (self.entries, self.used, self.saved)
+
+    def md5s(self, objects):
+        """
+        objects: [(uri_str, etag, last_modified)]
+        Returns {uri_str: md5 or None}, HEADing only the objects not in the cache.
+        """
+        result = {}
+        pending = []
+        for uri_str, etag, last_modified in objects:
+            entry = (uri_str, etag, last_modified)
+            if entry in self.entries:
+                result[uri_str] = self.entries[entry]
+                self.used.add(entry)
+            else:
+                pending.append(entry)
+        if pending:
+            debug(u"HEAD %d objects (%d cached) with %d workers" % (len(pending), len(result), self.workers))
+            self._head_all(pending, result)
+        else:
+            self.save()
+        return result
+
+    def _head_all(self, pending, result):
+        work = queue.Queue()
+        for entry in pending:
+            work.put(entry)
+        exceptions = []
+
+        def _worker():
+            while not exceptions:
+                try:
+                    entry = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    md5 = self._head(entry[0])
+                except Exception as e:
+                    exceptions.append(e)
+                    return
+                with self.lock:
+                    self.entries[entry] = result[entry[0]] = md5
+                    self.used.add(entry)
+
+        threads = [threading.Thread(target = _worker) for i in range(min(self.workers, len(pending)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ## Keep what was learnt even if one of the requests failed
+        self.save()
+        if exceptions:
+            raise exceptions[0]
+
+    def _head(self, uri_str):
+        response = self.s3.object_info(S3Uri(uri_str))
+        md5 = response.get('s3cmd-attrs', {}).get('md5')
+        if md5:
+            debug(u"retreived md5=%s from headers" % md5)
+        return md5
+
+    def save(self):
+        """Write the entries used so far this run, unless the file holds just those."""
+        if not self.cache_file or self.used == self.saved:
+            return
+        ## The others stay in memory for the later listings of this run
+        entries = dict((entry, self.entries[entry]) for entry in self.used)
+        d = dict(entries = entries, version = self.VERSION)
+        with open(deunicodise(self.cache_file), 'wb') as fp:
+            pickle.dump(d, fp)
+        self.saved.clear()
+        self.saved.update(self.used)
+
+# vim:et:ts=4:sts=4:ai
@@ -16,7 +16,6 @@ import base64
 import mimetypes
 import io
 import pprint
-from xml.sax import saxutils
 from socket import timeout as SocketTimeoutException
 from logging import debug, info, warning, error
 from stat import ST_SIZE
@@ -41,6 +40,7 @@ from .BidirMap import BidirMap
 from .Config import Config
 from .Exceptions import *
 from .MultiPart import MultiPartUpload
+from .Listing import parseListing
 from .S3Uri import S3Uri
 from .ConnMan import ConnMan
 from .Crypto import (sign_request_v2, sign_request_v4, checksum_sha256_file,
@@ -254,6 +254,8 @@ class S3(object):
         self.fallback_to_signature_v2 = False
         self.endpoint_requires_signature_v4 = False
         self.expect_continue_not_supported = False
+        ## Called with (uri, upload_id) whenever a multipart upload starts
+        self.on_multipart_start = None
 
     def storage_class(self):
         # Note - you cannot specify GLACIER here
@@ -303,10 +305,12 @@ class S3(object):
         response["list"] = getListFromXml(response["data"], "Bucket")
         return response
 
-    def bucket_list(self, bucket, prefix = None, recursive = None, uri_params = None, limit = -1):
+    def bucket_list(self, bucket, prefix = None, recursive = None, uri_params = None, limit = -1,
+                    start_after = None, fields = None):
         item_list = []
         prefixes = []
-        for truncated, dirs, objects in self.bucket_list_streaming(bucket, prefix, recursive, uri_params, limit):
+        for truncated, dirs, objects in self.bucket_list_streaming(bucket, prefix, recursive, uri_params, limit,
+                                                                   start_after, fields):
             item_list.extend(objects)
             prefixes.extend(dirs)
 
@@ -316,23 +320,31 @@ class S3(object):
         response['truncated'] = truncated
         return response
 
-    def bucket_list_streaming(self, bucket, prefix = None, recursive = None, uri_params = None, limit = -1):
-        """ Generator that produces <dir_list>, <object_list> pairs of groups of content of a specified bucket. """
-        def _list_truncated(data):
+    def bucket_list_streaming(self, bucket, prefix = None, recursive = None, uri_params = None, limit = -1,
+                              start_after = None, fields = None):
+        """ Generator that produces <dir_list>, <object_list> pairs of groups of content of a specified bucket.
+            start_after: only list keys after this one, e.g. the last key of an interrupted listing
+            fields: object fields to parse, e.g. ('Key', 'Size'); default all
+            With list_v2 set, ListObjectsV2 is used: pages are chained with continuation
+            tokens and owners are only requested when 'Owner' is among the fields. """
+        def _list_truncated(info):
             ## <IsTruncated> can either be "true" or "false" or be missing completely
-            is_truncated = getTextFromXml(data, ".//IsTruncated") or "false"
+            is_truncated = info.get("IsTruncated") or "false"
             return is_truncated.lower() != "false"
 
-        def _get_contents(data):
-            return getListFromXml(data, "Contents")
-
-        def _get_common_prefixes(data):
-            return getListFromXml(data, "CommonPrefixes")
-
-        def _get_next_marker(data, current_list):
-            return getTextFromXml(response["data"], "NextMarker") or current_list[-1]["Key"]
+        def _get_next_marker(info, current_list):
+            return info.get("NextMarker") or current_list[-1]["Key"]
 
         uri_params = uri_params and uri_params.copy() or {}
+        list_v2 = self.config.list_v2
+        if list_v2:
+            uri_params['list-type'] = '2'
+            if fields and 'Owner' in fields:
+                uri_params['fetch-owner'] = 'true'
+            if start_after:
+                uri_params['start-after'] = start_after
+        elif start_after:
+            uri_params['marker'] = start_after
         truncated = True
         prefixes = []
 
@@ -341,20 +353,25 @@ class S3(object):
         max_keys = limit
         while truncated:
             response = self.bucket_list_noparse(bucket, prefix, recursive, uri_params, max_keys)
-            current_list = _get_contents(response["data"])
-            current_prefixes = _get_common_prefixes(response["data"])
+            current_list, current_prefixes, info = parseListing(response["data"], fields)
             num_objects += len(current_list)
             num_prefixes += len(current_prefixes)
             if limit > num_objects + num_prefixes:
                 max_keys = limit - (num_objects + num_prefixes)
-            truncated = _list_truncated(response["data"])
+            truncated = _list_truncated(info)
             if truncated:
                 if limit == -1 or num_objects + num_prefixes < limit:
-                    if current_list:
-                        uri_params['marker'] = _get_next_marker(response["data"], current_list)
+                    if list_v2 and info.get("NextContinuationToken"):
+                        uri_params['continuation-token'] = info["NextContinuationToken"]
+                        debug("Listing continues with token '%s'" % uri_params['continuation-token'])
                     else:
-                        uri_params['marker'] = current_prefixes[-1]["Prefix"]
-                    debug("Listing continues after '%s'" % uri_params['marker'])
+                        marker = list_v2 and 'start-after' or 'marker'
+                        uri_params.pop('continuation-token', None)
+                        if current_list:
+                            uri_params[marker] = _get_next_marker(info, current_list)
+                        else:
+                            uri_params[marker] = current_prefixes[-1]["Prefix"]
+                        debug("Listing continues after '%s'" % uri_params[marker])
                 else:
                     yield truncated, current_prefixes, current_list
                     break
@@ -669,9 +686,10 @@ class S3(object):
         if self.config.enable_multipart:
             if size > self.config.multipart_chunk_size_mb * 1024 * 1024 or filename == "-":
                 multipart = True
-                if size > self.config.multipart_max_chunks * self.config.multipart_chunk_size_mb * 1024 * 1024:
-                    raise ParameterError("Chunk size %d MB results in more than %d chunks. Please increase --multipart-chunk-size-mb" % \
-                          (self.config.multipart_chunk_size_mb, self.config.multipart_max_chunks))
+                ## Chunks grow with the file up to 5 GB, see PartSizer
+                if size > self.config.multipart_max_chunks * MultiPartUpload.MAX_CHUNK_SIZE_MB * 1024 * 1024:
+                    raise ParameterError("File of %d MB needs more than %d chunks of the maximum chunk size, %d MB" % \
+                          (size // (1024 * 1024), self.config.multipart_max_chunks, MultiPartUpload.MAX_CHUNK_SIZE_MB))
         if multipart:
             # Multipart requests are quite different... drop here
             return self.send_file_multipart(src_stream, headers, uri, size, extra_label)
@@ -721,11 +739,19 @@ class S3(object):
         uris = [remote_list[item]['object_uri_str'] for item in remote_list]
         self.object_batch_delete_uri_strs(uris)
 
-    def object_batch_delete_uri_strs(self, uris):
-        """ Batch delete given a list of object uris """
-        def compose_batch_del_xml(bucket, key_list):
-            body = u"<?xml version=\"1.0\" encoding=\"UTF-8\"?><Delete>"
-            for key in key_list:
+    def object_batch_delete_uri_strs(self, uris, quiet = False):
+        """ Batch delete given a list of object uris
+            quiet: only failed keys are reported in the response """
+        def batch_keys(bucket, uri_list):
+            ## Plain s3://bucket/key strings are split without parsing them;
+            ## anything else goes through S3Uri for validation.
+            prefix = u"s3://%s/" % bucket
+            skip = len(prefix)
+            keys = [uri[skip:] for uri in uri_list if uri.startswith(prefix)]
+            if len(keys) == len(uri_list) and all(keys):
+                return keys
+            keys = []
+            for key in uri_list:
                 uri = S3Uri(key)
                 if uri.type != "s3":
                     raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
@@ -733,18 +759,15 @@ class S3(object):
                     raise ValueError("URI '%s' has no object" % key)
                 if uri.bucket() != bucket:
                     raise ValueError("The batch should contain keys from the same bucket")
-                object = saxutils.escape(uri.object())
-                body += u"<Object><Key>%s</Key></Object>" % object
-            body += u"</Delete>"
-            body = encode_to_s3(body)
-            return body
+                keys.append(uri.object())
+            return keys
 
         batch = uris
         if len(batch) == 0:
             raise ValueError("Key list is empty")
         bucket = S3Uri(batch[0]).bucket()
-        request_body = compose_batch_del_xml(bucket, batch)
-        headers = SortedDict({'content-md5': compute_content_md5(request_body),
+        request_body, body_md5 = composeBatchDeleteXml(batch_keys(bucket, batch), quiet)
+        headers = SortedDict({'content-md5': body_md5,
                    'content-type': 'application/xml'}, ignore_case=True)
         request = self.create_request("BATCH_DELETE", bucket = bucket,
                                       headers = headers, body = request_body,
@@ -1344,7 +1367,7 @@ class S3(object):
 
     def send_file(self, request, stream, labels, buffer = '', throttle = 0,
                   retries = _max_retries, offset = 0, chunk_size = -1,
-                  use_expect_continue = None):
+                  use_expect_continue = None, content_md5 = False):
         if request.resource.get('bucket') \
            and not request.use_signature_v2() \
            and S3Request.region_map.get(request.resource['bucket'],
@@ -1380,11 +1403,16 @@ class S3(object):
             info("Sending file '%s', please wait..." % filename)
         timestamp_start = time.time()
 
+        ## With content_md5 the md5 is computed in the same read as the
+        ## payload signature and sent for S3 to check what it receives
+        sent_md5 = content_md5 and md5() or None
         if buffer:
-            sha256_hash = checksum_sha256_buffer(buffer, offset, size_total)
+            sha256_hash = checksum_sha256_buffer(buffer, offset, size_total, sent_md5)
         else:
-            sha256_hash = checksum_sha256_file(filename, offset, size_total)
+            sha256_hash = checksum_sha256_file(filename, offset, size_total, sent_md5)
         request.body = sha256_hash
+        if sent_md5:
+            headers['content-md5'] = decode_from_s3(base64.b64encode(sent_md5.digest()))
 
         if use_expect_continue:
             if not size_total:
@@ -1414,7 +1442,7 @@ class S3(object):
                 raise S3UploadError("Upload failed for: %s" % resource['uri'])
         if buffer == '':
             stream.seek(offset)
-        md5_hash = md5()
+        md5_hash = sent_md5 or md5()
 
         try:
             http_response = None
@@ -1446,7 +1474,8 @@ class S3(object):
                     if self.config.limitrate > 0:
                         start_time = time.time()
 
-                    md5_hash.update(data)
+                    if not sent_md5:
+                        md5_hash.update(data)
 
                     conn.c.wrapper_send_body(data)
                     if self.config.progress_meter:
@@ -1600,6 +1629,8 @@ class S3(object):
     def send_file_multipart(self, stream, headers, uri, size, extra_label = ""):
         timestamp_start = time.time()
         upload = MultiPartUpload(self, stream, uri, headers)
+        if self.on_multipart_start:
+            self.on_multipart_start(uri, upload.upload_id)
         upload.upload_all_parts(extra_label)
         response = upload.complete_multipart_upload()
         timestamp_end = time.time()
@@ -1838,7 +1869,7 @@ def parse_attrs_header(attrs_header):
 
 def compute_content_md5(body):
     m = md5(encode_to_s3(body))
-    base64md5 = base64.encodestring(m.digest())
+    base64md5 = base64.b64encode(m.digest())
     base64md5 = decode_from_s3(base64md5)
     if base64md5[-1] == '\n':
         base64md5 = base64md5[0:-1]
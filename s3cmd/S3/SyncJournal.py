@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+## Amazon S3 sync session journal
+## License: GPL Version 2
+## Copyright: TGRMN Software and contributors
+
+from __future__ import absolute_import
+
+import json
+import os
+from logging import debug, info, warning, error
+
+from .Utils import deunicodise
+
+__all__ = [ "SyncJournal" ]
+
+class SyncJournal(object):
+    """
+    Append-only record of a local->remote sync, so that an interrupted sync
+    run again with the same arguments continues where it stopped:
+      - remote listing pages, with the key to continue after
+      - multipart UploadIds of large files still being sent
+      - every completed upload, with the size, mtime and md5 it was sent with
+    One JSON object per line; a line cut short by a crash is ignored.
+    A journal written for other sources or destination is started afresh,
+    and finish() removes it once a sync completes.
+    """
+    VERSION = 1
+
+    def __init__(self, path, session):
+        self.path = path
+        self.session = session
+        self.pages = {}         # listing base uri -> [[Key, Size, LastModified, ETag], ...]
+        self.after = {}         # listing base uri -> last key listed
+        self.complete = set()   # listing base uris listed to the end
+        self.upload_ids = {}    # remote uri -> multipart UploadId
+        self.done = {}          # remote uri -> (size, mtime, md5)
+        self.resumed = self._load()
+        self.fp = open(deunicodise(path), self.resumed and 'a' or 'w')
+        if not self.resumed:
+            self._write({'version': self.VERSION, 'session': session})
+
+    def _load(self):
+        if not os.path.exists(deunicodise(self.path)):
+            return False
+        with open(deunicodise(self.path)) as fp:
+            lines = fp.readlines()
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                debug(u"Sync journal: skipping unreadable line")
+        if not records or records[0].get('version') != self.VERSION or records[0].get('session') != self.session:
+            info(u"Sync journal %s belongs to another sync, starting a new one" % self.path)
+            return False
+        for record in records[1:]:
+            if 'listed' in record:
+                base = record['listed']
+                self.pages.setdefault(base, []).extend(record['objects'])
+                if record['objects']:
+                    self.after[base] = record['objects'][-1][0]
+                if record.get('complete'):
+                    self.complete.add(base)
+            elif 'multipart' in record:
+                self.upload_ids[record['multipart']] = record['upload_id']
+            elif 'done' in record:
+                self.done[record['done']] = (record['size'], record['mtime'], record['md5'])
+                self.upload_ids.pop(record['done'], None)
+        info(u"Resuming sync from journal %s: %d files already transferred" % (self.path, len(self.done)))
+        return True
+
+    def _write(self, record):
+        self.fp.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.fp.flush()
+
+    def remote_listing(self, s3, remote_uri, recursive, uri_params, fields):
+        """
+        Objects under remote_uri: the pages journaled by an earlier run, then
+        a listing continued after the last journaled key, journaled page by page.
+        """
+        base = remote_uri.uri()
+        objects = [dict(zip(('Key', 'Size', 'LastModified', 'ETag'), item)) for item in self.pages.get(base, [])]
+        if base in self.complete:
+            return objects
+        if objects:
+            info(u"Continuing listing of %s after '%s'" % (base, self.after[base]))
+        for truncated, dirs, page in s3.bucket_list_streaming(remote_uri.bucket(), prefix = remote_uri.object(),
+                                                              recursive = recursive, uri_params = uri_params,
+                                                              start_after = self.after.get(base), fields = fields):
+            self._write({'listed': base, 'complete': not truncated,
+                         'objects': [[obj['Key'], obj['Size'], obj['LastModified'], obj['ETag']] for obj in page]})
+            objects.extend(page)
+        return objects
+
+    def multipart_started(self, uri, upload_id):
+        self._write({'multipart': uri.uri(), 'upload_id': upload_id})
+
+    def upload_id(self, remote_uri):
+        return self.upload_ids.get(remote_uri)
+
+    def is_done(self, remote_uri, item):
+        return self.done.get(remote_uri) == (item.get('size'), item.get('mtime'), item.get('md5'))
+
+    def transferred(self, remote_uri, item):
+        self._write({'done': remote_uri, 'size': item.get('size'), 'mtime': item.get('mtime'),
+                     'md5': item.get('md5')})
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+    def finish(self):
+        """The sync completed: nothing left to resume."""
+        self.close()
+        os.remove(deunicodise(self.path))
+
+# vim:et:ts=4:sts=4:ai
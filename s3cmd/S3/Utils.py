@@ -11,6 +11,7 @@ from __future__ import absolute_import, division
 import os
 import sys
 import time
+import base64
 import re
 import string
 import random
@@ -51,6 +52,7 @@ except NameError:
 import S3.Config
 import S3.Exceptions
 import xml.dom.minidom
+from xml.sax import saxutils
 
 from hashlib import md5
 
@@ -64,9 +66,9 @@ def parseNodes(nodes):
     retval = []
     for node in nodes:
         retval_item = {}
-        for child in node.getchildren():
+        for child in node:
             name = decode_from_s3(child.tag)
-            if child.getchildren():
+            if len(child):
                 retval_item[name] = parseNodes([child])
             else:
                 found_text = node.findtext(".//%s" % child.tag)
@@ -122,8 +124,8 @@ __all__.append("getListFromXml")
 
 def getDictFromTree(tree):
     ret_dict = {}
-    for child in tree.getchildren():
-        if child.getchildren():
+    for child in tree:
+        if len(child):
             ## Complex-type child. Recurse
             content = getDictFromTree(child)
         else:
@@ -170,6 +172,36 @@ def appendXmlTextNode(tag_name, text, parent):
     return el
 __all__.append("appendXmlTextNode")
 
+def xmlBodyWithMd5(body):
+    """
+    Encode a request body the way send_request would and return it
+    together with its base64 Content-MD5, computed on the same bytes.
+    """
+    body = encode_to_s3(body)
+    return body, decode_from_s3(base64.b64encode(md5(body).digest()))
+__all__.append("xmlBodyWithMd5")
+
+def composeBatchDeleteXml(keys, quiet = False):
+    """
+    Multi-Object Delete request body for a list of keys, as (body, Content-MD5).
+    All keys are escaped in a single pass over their NUL-joined text
+    (NUL can't appear in an XML document, hence not in a deletable key)
+    and the separators are then turned into the element boundaries.
+    """
+    head = u'<?xml version="1.0" encoding="UTF-8"?><Delete>'
+    if quiet:
+        head += u"<Quiet>true</Quiet>"
+    escaped = saxutils.escape(u"\0".join(keys)).replace(u"\0", u"</Key></Object><Object><Key>")
+    return xmlBodyWithMd5(u"".join((head, u"<Object><Key>", escaped, u"</Key></Object></Delete>")))
+__all__.append("composeBatchDeleteXml")
+
+def composeCompleteMultipartXml(parts):
+    """CompleteMultipartUpload request body for {part number: etag}, as (body, Content-MD5)."""
+    body = u"".join([u"<Part><PartNumber>%i</PartNumber><ETag>%s</ETag></Part>" % (seq, parts[seq])
+                     for seq in sorted(parts)])
+    return xmlBodyWithMd5(u"<CompleteMultipartUpload>%s</CompleteMultipartUpload>" % body)
+__all__.append("composeCompleteMultipartXml")
+
 RE_S3_DATESTRING = re.compile('\.[0-9]*(?:[Z\\-\\+]*?)')
 
 def dateS3toPython(date):
@@ -256,18 +288,84 @@ def mktmpfile(prefix = os.getenv('TMP','/tmp') + "/tmpfile-", randchars = 20):
     return mktmpsomething(prefix, randchars, createfunc)
 __all__.append("mktmpfile")
 
-def hash_file_md5(filename):
+def hash_file_md5(filename, offset = 0, size = -1):
     h = md5()
     with open(deunicodise(filename), "rb") as fp:
-        while True:
+        fp.seek(offset)
+        while size:
             # Hash 32kB chunks
-            data = fp.read(32*1024)
+            data = fp.read(size < 0 and 32*1024 or min(32*1024, size))
             if not data:
                 break
             h.update(data)
+            size -= len(data)
     return h.hexdigest()
 __all__.append("hash_file_md5")
 
+def multipart_chunk_size_mb(size, chunk_size_mb = 15, max_chunks = 10000):
+    """
+    Chunk size in MB a file of 'size' bytes is uploaded with: chunk_size_mb,
+    raised to the whole MB that keeps the file within half of max_chunks
+    parts, at most 5 GB.
+    """
+    floor_mb = -(-size // (max(max_chunks // 2, 1) * 1024 * 1024))
+    return min(5120, max(chunk_size_mb, floor_mb))
+__all__.append("multipart_chunk_size_mb")
+
+def multipart_part_sizes(size, parts, chunk_size_mb = 15):
+    """
+    Part sizes a multipart upload of 'size' bytes in 'parts' parts may have
+    been sent with: the configured chunk size and those of common clients
+    first, then the smallest whole MB that fits.
+    """
+    if parts < 1 or size < 1:
+        return []
+    if parts == 1:
+        return [size]
+    part_sizes = []
+    for mb in [chunk_size_mb, 5, 8, 15, 16, 10, 25, 32, 50, 64, 100, 128, 256, 512, 1024]:
+        part_size = mb * 1024 * 1024
+        if (parts - 1) * part_size < size <= parts * part_size and part_size not in part_sizes:
+            part_sizes.append(part_size)
+    mb = -(-size // (parts * 1024 * 1024))
+    part_size = mb * 1024 * 1024
+    if (parts - 1) * part_size < size and part_size not in part_sizes:
+        part_sizes.append(part_size)
+    return part_sizes
+__all__.append("multipart_part_sizes")
+
+def hash_file_multipart_etags(filename, part_sizes):
+    """
+    ETags S3 gives 'filename' uploaded in parts of each of 'part_sizes':
+    md5 of the concatenated part md5s, then '-' and the part count.
+    Returns {part_size: etag}, reading the file only once.
+    """
+    parts = dict((part_size, [md5(), 0, []]) for part_size in part_sizes)
+    with open(deunicodise(filename), "rb") as fp:
+        while True:
+            data = fp.read(1024*1024)
+            if not data:
+                break
+            data = memoryview(data)
+            for part_size, part in parts.items():
+                offset = 0
+                while offset < len(data):
+                    ## part: [md5 of the current part, its length, digests of the parts before]
+                    count = min(part_size - part[1], len(data) - offset)
+                    part[0].update(data[offset:offset + count])
+                    part[1] += count
+                    offset += count
+                    if part[1] == part_size:
+                        part[2].append(part[0].digest())
+                        part[0], part[1] = md5(), 0
+    etags = {}
+    for part_size, (h, length, digests) in parts.items():
+        if length:
+            digests.append(h.digest())
+        etags[part_size] = "%s-%d" % (md5(b"".join(digests)).hexdigest(), len(digests))
+    return etags
+__all__.append("hash_file_multipart_etags")
+
 def mkdir_with_parents(dir_name):
     """
     mkdir_with_parents(dst_dir)
@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+# -*- coding=utf-8 -*-
+
+## Amazon S3cmd - regression tests against a local S3 stand-in
+## License: GPL Version 2
+## Copyright: TGRMN Software and contributors
+##
+## Runs s3cmd against StubS3Server from ../video-analysis/bench/stub_service.py
+## instead of a real account, so the tests need no credentials or network.
+## The stub records what it was sent, which lets tests check the requests
+## themselves (part sizes, Content-MD5 headers) as well as s3cmd's output.
+##
+##   python run-tests-stub.py [-v] [A B K..O -N]
+
+from __future__ import absolute_import, print_function
+
+import sys
+import os
+import hashlib
+import pickle
+import re
+import shutil
+import tempfile
+import time
+from subprocess import Popen, PIPE, STDOUT
+from S3.ExitCodes import *
+from S3.HashCache import HashCache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'video-analysis', 'bench'))
+from stub_service import StubS3Server
+
+count_pass = 0
+count_fail = 0
+count_skip = 0
+
+test_counter = 0
+run_tests = []
+exclude_tests = []
+
+verbose = False
+
+argv = sys.argv[1:]
+while argv:
+    arg = argv.pop(0)
+    if arg in ("-h", "--help"):
+        print("%s [-v] A B K..O -N" % sys.argv[0])
+        print("Run tests number A, B and K through to O, except for N")
+        sys.exit(0)
+    if arg in ("-v", "--verbose"):
+        verbose = True
+        continue
+    if ".." in arg:
+        range_idx = arg.find("..")
+        range_start = arg[:range_idx] or 0
+        range_end = arg[range_idx+2:] or 999
+        run_tests.extend(range(int(range_start), int(range_end) + 1))
+    elif arg.startswith("-"):
+        exclude_tests.append(int(arg[1:]))
+    else:
+        run_tests.append(int(arg))
+
+if not run_tests:
+    run_tests = range(0, 999)
+
+server = StubS3Server().start()
+store = server.store
+workdir = tempfile.mkdtemp(prefix = "s3cmd-stub-tests-")
+config_file = os.path.join(workdir, "s3cfg")
+with open(config_file, "w") as fp:
+    fp.write("[default]\n")
+    for option, value in sorted(server.s3_options().items()):
+        fp.write("%s = %s\n" % (option, value))
+
+env = dict(os.environ, LANG = "C.UTF-8", LC_ALL = "C.UTF-8")
+
+def test(label, cmd_args = [], retcode = 0, must_find = [], must_not_find = [], must_find_re = [], must_not_find_re = [],
+         check = None, interrupt = None):
+    """
+    Run cmd_args and match its output like run-tests.py does. check, when
+    given, is called afterwards with the output and returns a failure
+    message or None. With interrupt, the command is killed as soon as
+    interrupt() returns True, and must not have finished by then.
+    """
+    def command_output():
+        print("----")
+        print(" ".join([" " in arg and "'%s'" % arg or arg for arg in cmd_args]))
+        print("----")
+        print(stdout)
+        print("----")
+
+    def failure(message = ""):
+        global count_fail
+        if message:
+            message = u"  (%r)" % message
+        print(u"\x1b[31;1mFAIL%s\x1b[0m" % (message))
+        count_fail += 1
+        command_output()
+        return 1
+    def success(message = ""):
+        global count_pass
+        if message:
+            message = "  (%r)" % message
+        print("\x1b[32;1mOK\x1b[0m%s" % (message))
+        count_pass += 1
+        if verbose:
+            command_output()
+        return 0
+    def skip(message = ""):
+        global count_skip
+        if message:
+            message = "  (%r)" % message
+        print("\x1b[33;1mSKIP\x1b[0m%s" % (message))
+        count_skip += 1
+        return 0
+
+    global test_counter
+    test_counter += 1
+    print(("%3d  %s " % (test_counter, label)).ljust(45, "."), end=' ')
+    sys.stdout.flush()
+
+    if run_tests.count(test_counter) == 0 or exclude_tests.count(test_counter) > 0:
+        return skip()
+
+    stdout = ""
+    if cmd_args:
+        p = Popen(cmd_args, stdout = PIPE, stderr = STDOUT, universal_newlines = True, close_fds = True, env = env)
+        if interrupt:
+            while p.poll() is None and not interrupt():
+                time.sleep(0.02)
+            if p.poll() is None:
+                p.kill()
+            else:
+                stdout, stderr = p.communicate()
+                return failure("finished before it was interrupted")
+        stdout, stderr = p.communicate()
+        if type(retcode) not in [list, tuple]: retcode = [retcode]
+        if not interrupt and p.returncode not in retcode:
+            return failure("retcode: %d, expected one of: %s" % (p.returncode, retcode))
+
+    if type(must_find) not in [ list, tuple ]: must_find = [must_find]
+    if type(must_find_re) not in [ list, tuple ]: must_find_re = [must_find_re]
+    if type(must_not_find) not in [ list, tuple ]: must_not_find = [must_not_find]
+    if type(must_not_find_re) not in [ list, tuple ]: must_not_find_re = [must_not_find_re]
+    for pattern in [re.escape(item) for item in must_find] + must_find_re:
+        if not re.search(pattern, stdout, re.MULTILINE):
+            return failure("pattern not found: %s" % pattern)
+    for pattern in [re.escape(item) for item in must_not_find] + must_not_find_re:
+        match = re.search(pattern, stdout, re.MULTILINE)
+        if match:
+            return failure("pattern found: %s (match: %s)" % (pattern, match.group(0)))
+    if check:
+        message = check(stdout)
+        if message:
+            return failure(message)
+
+    return success()
+
+def test_s3cmd(label, cmd_args = [], **kwargs):
+    cmd_args = [sys.executable, "s3cmd", "-c", config_file] + cmd_args
+    return test(label, cmd_args, **kwargs)
+
+def test_check(label, check):
+    """A test that only looks at the stub's or the local state"""
+    return test(label, check = lambda output: check())
+
+def make_file(name, size, seed = 0):
+    """A file of size pseudo random bytes under workdir; returns its path"""
+    path = os.path.join(workdir, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    block = bytes(bytearray((i * 7 + seed) % 251 for i in range(1024 * 1024)))
+    with open(path, "wb") as fp:
+        while size > 0:
+            fp.write(block[:size])
+            size -= len(block)
+    return path
+
+def local(name):
+    return os.path.join(workdir, name)
+
+def remote(bucket, key = ""):
+    return "s3://%s/%s" % (bucket, key)
+
+def keys(bucket, prefix = ""):
+    return sorted(key for key in store.buckets.get(bucket, {}) if key.startswith(prefix))
+
+def expect(condition, message):
+    return None if condition else message
+
+def same_content(bucket, key, filename):
+    with open(filename, "rb") as fp:
+        data = fp.read()
+    obj = store.buckets.get(bucket, {}).get(key)
+    return expect(obj is not None and obj["data"] == data, "%s differs from %s" % (remote(bucket, key), filename))
+
+def multipart_etag(filename, part_size):
+    """The ETag S3 gives filename uploaded in parts of part_size bytes"""
+    digests = []
+    with open(filename, "rb") as fp:
+        for data in iter(lambda: fp.read(part_size), b""):
+            digests.append(hashlib.md5(data).digest())
+    return "%s-%d" % (hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
+
+def put_file(bucket, key, filename, etag = None):
+    """Store filename in the stub directly, as another client would have"""
+    with open(filename, "rb") as fp:
+        store.put(bucket, key, fp.read(), etag = etag)
+
+def parts_sent(minimum):
+    """True once some multipart upload in progress holds minimum parts"""
+    return any(len(upload["parts"]) >= minimum for upload in list(store.uploads.values()))
+
+## ====== Batch delete
+test_s3cmd("Create bucket", ["mb", remote("delete")],
+           must_find = "Bucket 's3://delete/' created")
+
+for i in range(5):
+    make_file("delete/file-%d" % i, 1000, i)
+
+test_s3cmd("Sync files to delete", ["sync", "--acl-private", local("delete/"), remote("delete", "dir/")],
+           must_find = "upload: '%s' -> '%s'" % (local("delete/file-4"), remote("delete", "dir/file-4")))
+
+os.unlink(local("delete/file-1"))
+os.unlink(local("delete/file-2"))
+store.deleteErrors["dir/file-2"] = ["AccessDenied"]
+test_s3cmd("Sync --delete-removed, one refused", ["sync", "--acl-private", "--delete-removed",
+                                                  local("delete/"), remote("delete", "dir/")],
+           retcode = EX_PARTIAL,
+           must_find = "delete: '%s'" % remote("delete", "dir/file-1"),
+           must_not_find_re = "^delete: '%s'" % re.escape(remote("delete", "dir/file-2")),
+           check = lambda output: expect(keys("delete") == ["dir/file-0", "dir/file-2", "dir/file-3", "dir/file-4"],
+                                  "left: %s" % keys("delete")))
+
+store.deleteErrors["dir/file-2"] = ["AccessDenied"]
+test_s3cmd("Sync --delete-after, one refused", ["sync", "--acl-private", "--delete-removed", "--delete-after",
+                                                local("delete/"), remote("delete", "dir/")],
+           retcode = EX_PARTIAL,
+           check = lambda output: expect("dir/file-2" in keys("delete"), "refused key deleted"))
+
+test_s3cmd("Sync --delete-removed, all deleted", ["sync", "--acl-private", "--delete-removed",
+                                                  local("delete/"), remote("delete", "dir/")],
+           must_find = "delete: '%s'" % remote("delete", "dir/file-2"),
+           check = lambda output: expect(keys("delete") == ["dir/file-0", "dir/file-3", "dir/file-4"],
+                                  "left: %s" % keys("delete")))
+
+store.put("delete", "copy/stale", b"stale")
+store.deleteErrors["copy/stale"] = ["AccessDenied"]
+test_s3cmd("Remote sync --delete-removed, refused", ["sync", "--acl-private", "--delete-removed",
+                                                     remote("delete", "dir/"), remote("delete", "copy/")],
+           retcode = EX_PARTIAL,
+           check = lambda output: expect(keys("delete", "copy/") == ["copy/file-0", "copy/file-3", "copy/file-4", "copy/stale"],
+                                  "left: %s" % keys("delete", "copy/")))
+
+store.deleteErrors["dir/file-3"] = ["InternalError"]
+store.deleteErrors["dir/file-4"] = ["AccessDenied"]
+test_s3cmd("Delete recursive, retried and refused", ["del", "--recursive", remote("delete", "dir/")],
+           retcode = EX_PARTIAL,
+           must_find = ["delete: '%s'" % remote("delete", "dir/file-0"),
+                        "delete: '%s'" % remote("delete", "dir/file-3")],
+           check = lambda output: expect(keys("delete", "dir/") == ["dir/file-4"], "left: %s" % keys("delete", "dir/")))
+
+## ====== ListObjectsV2
+for i in range(2500):
+    store.put("listing", "key-%04d" % i, b"")
+requests = {}
+
+def count_requests(method):
+    requests[method] = store.requests[method]
+
+def pages(method, expected):
+    return expect(store.requests[method] - requests[method] == expected,
+                  "%d %s requests, expected %d" % (store.requests[method] - requests[method], method, expected))
+
+def listed(output, expected):
+    found = [line.split()[-1] for line in output.splitlines() if line.startswith("20")]
+    return expect(found == [remote("listing", key) for key in expected],
+                  "%d keys listed, %s..." % (len(found), found[:3]))
+
+count_requests("ListObjects")
+test_s3cmd("List V1", ["ls", remote("listing")],
+           check = lambda output: listed(output, keys("listing")) or pages("ListObjects", 3))
+
+count_requests("ListObjectsV2")
+test_s3cmd("List V2", ["ls", "--list-v2", remote("listing")],
+           check = lambda output: listed(output, keys("listing")) or pages("ListObjectsV2", 3))
+
+count_requests("ListObjectsV2")
+test_s3cmd("List V2 with prefix", ["ls", "--list-v2", remote("listing", "key-1")],
+           check = lambda output: listed(output, keys("listing", "key-1")) or pages("ListObjectsV2", 1))
+
+test_s3cmd("Du V2", ["du", "--list-v2", remote("listing")],
+           must_find_re = r"^ *0 +2500 objects s3://listing/$")
+
+## ====== Sync journal
+journal = local("journal.log")
+for i in range(3):
+    make_file("journal/a-%d" % i, 1000, i)
+big = make_file("journal/z-big", 40 * 1024 * 1024 + 1234, 7)
+journal_sync = ["sync", "--acl-private", "--sync-journal", journal, "--multipart-chunk-size-mb=5",
+                "--no-multipart-adaptive", local("journal/"), remote("journal")]
+test_s3cmd("Create bucket", ["mb", remote("journal")])
+
+server.latency = 0.2
+test_s3cmd("Sync interrupted during multipart", journal_sync,
+           interrupt = lambda: parts_sent(2),
+           check = lambda output: expect(keys("journal") == ["a-0", "a-1", "a-2"], "stored: %s" % keys("journal")) or
+                                  expect(os.path.exists(journal), "no journal left"))
+server.latency = 0.0
+
+count_requests("PUT")
+test_s3cmd("Sync resumed from journal", journal_sync,
+           must_find = "upload: '%s'" % big,
+           must_not_find = "upload: '%s'" % local("journal/a-0"),
+           check = lambda output: same_content("journal", "z-big", big) or
+                                  expect(store.buckets["journal"]["z-big"]["etag"].endswith("-9"), "not 9 parts") or
+                                  expect(store.requests["PUT"] - requests["PUT"] <= 7, "%d parts sent again" % (store.requests["PUT"] - requests["PUT"])) or
+                                  expect(not os.path.exists(journal), "journal not removed"))
+
+test_s3cmd("Sync after resume is a no-op", journal_sync,
+           must_not_find = "upload:")
+
+## ====== Multipart ETags
+MB = 1024 * 1024
+etags_sync = ["sync", "--acl-private", "--cache-file", local("etags.md5"), local("etags/"), remote("etags")]
+test_s3cmd("Create bucket", ["mb", remote("etags")])
+
+six = make_file("etags/six", 13 * MB, 1)
+put_file("etags", "six", six, multipart_etag(six, 6 * MB))
+five = make_file("etags/five", 13 * MB, 2)
+put_file("etags", "five", five, multipart_etag(five, 5 * MB))
+one = make_file("etags/one", 3 * MB, 3)
+put_file("etags", "one", make_file("other/one", 3 * MB, 4), multipart_etag(local("other/one"), 3 * MB))
+changed = make_file("etags/changed", 13 * MB, 5)
+put_file("etags", "changed", make_file("other/changed", 13 * MB, 6), multipart_etag(local("other/changed"), 6 * MB))
+
+test_s3cmd("Multipart ETags compared", etags_sync,
+           must_find = "upload: '%s'" % one,
+           must_not_find = ["upload: '%s'" % six, "upload: '%s'" % five, "upload: '%s'" % changed])
+
+test_s3cmd("Multipart ETags from cache", etags_sync,
+           must_not_find = "upload:")
+
+def cached_etags():
+    cache = HashCache()
+    cache.load(local("etags.md5"))
+    entries = [entry for inodes in cache.inodes.values() for mtimes in inodes.values() for entry in mtimes.values()]
+    return expect(len([entry for entry in entries if entry.get("md5") and entry.get("etags")]) == 4,
+                  "cached: %s" % entries)
+
+test_check("Multipart ETags kept in cache", cached_etags)
+
+def add_keeps_etags():
+    cache = HashCache()
+    cache.add_etag(1, 2, 3, 4, 5 * MB, "etag-1")
+    cache.add(1, 2, 3, 4, "md5")
+    return expect(cache.etag(1, 2, 3, 4, 5 * MB) == "etag-1" and cache.md5(1, 2, 3, 4) == "md5",
+                  "entry: %s" % cache.inodes)
+
+test_check("Hash cache add keeps ETags", add_keeps_etags)
+
+## ====== Content index
+index = local("content.index")
+test_s3cmd("Create bucket", ["mb", remote("index")])
+
+original = make_file("index-a/x", 2 * MB, 8)
+test_s3cmd("Sync indexes uploads", ["sync", "--acl-private", "--content-index", index, local("index-a/"), remote("index", "a/")],
+           must_find = "upload: '%s'" % original,
+           check = lambda output: expect(os.path.exists(index), "no content index written"))
+
+shutil.copy(original, make_file("index-b/y", 0))
+test_s3cmd("Sync copies indexed content", ["sync", "--acl-private", "--content-index", index, local("index-b/"), remote("index", "b/")],
+           must_find = "remote copy: '%s' -> '%s'" % (remote("index", "a/x"), remote("index", "b/y")),
+           must_not_find = "upload:",
+           check = lambda output: same_content("index", "b/y", original))
+
+put_file("index", "a/x", make_file("index-other/x", 2 * MB, 9))
+shutil.copy(original, make_file("index-c/z", 0))
+test_s3cmd("Sync uploads when source changed", ["sync", "--acl-private", "--content-index", index, local("index-c/"), remote("index", "c/")],
+           must_find = ["uploading instead", "upload: '%s'" % local("index-c/z")],
+           check = lambda output: same_content("index", "c/z", original))
+
+## ====== Adaptive multipart chunks
+def uniform_parts(bucket, key, filename):
+    """The object's ETag is that of filename sent in parts of one size"""
+    etag = store.buckets[bucket][key]["etag"]
+    size = os.path.getsize(filename)
+    for part_size in range(MB, size + MB, MB):
+        if multipart_etag(filename, part_size) == etag:
+            return None
+    return "%s: no single part size gives ETag %s" % (remote(bucket, key), etag)
+
+few_chunks = local("s3cfg-few-chunks")
+with open(config_file) as src:
+    with open(few_chunks, "w") as dst:
+        dst.write(src.read() + "multipart_max_chunks = 4\n")
+
+adaptive_sync = ["sync", "--acl-private", "--multipart-chunk-size-mb=5", "--multipart-adaptive",
+                 local("adaptive/"), remote("adaptive")]
+test_s3cmd("Create bucket", ["mb", remote("adaptive")])
+
+wide = make_file("adaptive/a-wide", 30 * MB, 10)
+test_s3cmd("Adaptive chunks within the limit", ["-c", few_chunks] + adaptive_sync,
+           must_find = "upload: '%s'" % wide,
+           check = lambda output: expect(store.buckets["adaptive"]["a-wide"]["etag"].endswith("-2"), "not 2 parts") or
+                                  same_content("adaptive", "a-wide", wide))
+
+test_s3cmd("Large file within the chunk limit by default", ["-c", few_chunks, "put", "--acl-private", "--multipart-chunk-size-mb=5", wide, remote("adaptive", "default")],
+           must_find = "upload: '%s'" % wide,
+           check = lambda output: expect(store.buckets["adaptive"]["default"]["etag"] == multipart_etag(wide, 15 * MB), "not 2 parts of 15MB") or
+                                  same_content("adaptive", "default", wide))
+
+first = make_file("adaptive/b-first", 12 * MB, 11)
+second = make_file("adaptive/c-second", 40 * MB + 5, 12)
+test_s3cmd("Adaptive chunks, one size per upload", adaptive_sync,
+           must_find = ["upload: '%s'" % first, "upload: '%s'" % second],
+           check = lambda output: uniform_parts("adaptive", "b-first", first) or
+                                  uniform_parts("adaptive", "c-second", second) or
+                                  same_content("adaptive", "c-second", second))
+
+def drop_attrs():
+    for obj in store.buckets["adaptive"].values():
+        obj["headers"].pop("x-amz-meta-s3cmd-attrs", None)
+    return None
+
+test_check("Forget the stored md5s", drop_attrs)
+
+test_s3cmd("Adaptive uploads compared by ETag", adaptive_sync + ["--cache-file", local("adaptive.md5"), "-v"],
+           must_not_find = ["upload:", "disabled md5 check"])
+
+resumed = make_file("resume/big", 23 * MB, 13)
+resume_sync = ["sync", "--acl-private", "--sync-journal", local("resume.log"), local("resume/"), remote("adaptive", "resume/")]
+server.latency = 0.2
+test_s3cmd("Upload interrupted", resume_sync + ["--multipart-chunk-size-mb=5"],
+           interrupt = lambda: parts_sent(2))
+server.latency = 0.0
+test_s3cmd("Resumed with another chunk size", resume_sync + ["--multipart-chunk-size-mb=6"],
+           must_find = "upload: '%s'" % resumed,
+           check = lambda output: same_content("adaptive", "resume/big", resumed) or
+                                  expect(store.buckets["adaptive"]["resume/big"]["etag"] == multipart_etag(resumed, 5 * MB),
+                                         "parts not all of 5MB"))
+
+## ====== Content-MD5 on parts
+verified = make_file("verify/big", 23 * MB, 14)
+verify_sync = ["sync", "--acl-private", "--sync-journal", local("verify.log"), "--multipart-chunk-size-mb=5",
+               "--multipart-verify-workers=3", local("verify/"), remote("verify")]
+test_s3cmd("Create bucket", ["mb", remote("verify")])
+
+def parts_with_md5(reused):
+    parts = store.requests["UploadPart"] - requests["UploadPart"]
+    return expect(parts < 5 - reused + 1, "%d parts sent" % parts) or \
+           expect(store.requests["Content-MD5"] - requests["Content-MD5"] == parts,
+                  "%d of %d parts sent with Content-MD5" % (store.requests["Content-MD5"] - requests["Content-MD5"], parts))
+
+count_requests("UploadPart")
+count_requests("Content-MD5")
+server.latency = 0.2
+test_s3cmd("Upload interrupted", verify_sync,
+           interrupt = lambda: parts_sent(2),
+           check = lambda output: parts_with_md5(0))
+server.latency = 0.0
+
+with open(verified, "r+b") as fp:
+    fp.write(b"changed since the upload started")
+count_requests("UploadPart")
+count_requests("Content-MD5")
+test_s3cmd("Resumed parts checked and resent", verify_sync,
+           must_find = "upload: '%s'" % verified,
+           check = lambda output: same_content("verify", "big", verified) or parts_with_md5(1))
+
+## ====== HEAD cache of multipart md5s
+heads_sync = ["sync", "--acl-private", "--multipart-chunk-size-mb=5", "--cache-file", local("heads.md5"),
+              local("heads/"), remote("heads")]
+test_s3cmd("Create bucket", ["mb", remote("heads")])
+make_file("heads/one", 6 * MB, 15)
+rewritten = make_file("heads/two", 6 * MB, 16)
+test_s3cmd("Multipart uploads", heads_sync, must_find = "upload: '%s'" % rewritten)
+
+def head_entries(expected):
+    with open(local("heads.md5.heads"), "rb") as fp:
+        entries = pickle.load(fp)["entries"]
+    return expect(sorted(uri for uri, etag, last_modified in entries) == expected, "cached: %s" % sorted(entries))
+
+test_s3cmd("HEADs cached", heads_sync,
+           must_not_find = "upload:",
+           check = lambda output: head_entries([remote("heads", "one"), remote("heads", "two")]))
+
+make_file("heads/two", 6 * MB, 17)
+test_s3cmd("Rewrite one object", heads_sync, must_find = "upload: '%s'" % rewritten)
+
+count_requests("HEAD")
+test_s3cmd("Rewritten object's entry replaced", heads_sync,
+           must_not_find = "upload:",
+           check = lambda output: pages("HEAD", 1) or
+                                  head_entries([remote("heads", "one"), remote("heads", "two")]))
+
+server.shutdown()
+shutil.rmtree(workdir)
+
+print()
+print("Passed: %d, failed: %d, skipped: %d" % (count_pass, count_fail, count_skip))
+sys.exit(count_fail and EX_GENERAL or EX_OK)
+
+# vim:et:ts=4:sts=4:ai
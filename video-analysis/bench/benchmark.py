@@ -0,0 +1,150 @@
+# End-to-end timing of the video pipeline against the local stand-ins in
+# stub_service.py, so that nothing needs AWS:
+#
+#   python bench/benchmark.py [--jobs 4] [--latency 0.002] [--page-size 100] [--repeat 10]
+#
+# Stages: synthesise a video, upload it through the S3 class, start the face
+# search jobs and wait for their notifications, page through the results,
+# then extract annotated frames with extract.py. Throughput is reported per
+# stage so a regression in any one of them stands out.
+
+import argparse
+import functools
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# The pipeline modules live one directory up
+VIDEO_ANALYSIS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if VIDEO_ANALYSIS_DIR not in sys.path:
+    sys.path.insert(0, VIDEO_ANALYSIS_DIR)
+
+import cv2
+import numpy as np
+
+import extract
+from compact_results import from_data
+from orchestrator import JobOrchestrator
+from rekognition_analysis import VideoDetect
+from s3util import get_s3, S3Uri
+from stub_service import StubRekognition, StubS3Server, StubSQS, persons_from_results
+
+QUEUE_URL = 'https://sqs.local/benchmark'
+BUCKET = 'benchmark'
+
+
+def synthesize_video(path, durationMs, fps=24, size=(640, 360)):
+    """Write a video with a moving block so every frame differs; returns the frame count."""
+    width, height = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    frames = int(durationMs * fps / 1000.0) + 1
+    image = np.zeros((height, width, 3), np.uint8)
+    for i in range(frames):
+        image[:] = (i * 3) % 256
+        x = (i * 7) % (width - 60)
+        image[height // 3:height // 3 + 60, x:x + 60] = (0, 255, 0)
+        writer.write(image)
+    writer.release()
+    return frames
+
+
+class Report(object):
+    def __init__(self):
+        self.rows = []
+
+    def add(self, stage, seconds, count, unit, extra=''):
+        self.rows.append((stage, seconds, count, unit, extra))
+
+    def show(self):
+        print('%-20s %10s %10s %14s  %s' % ('stage', 'seconds', 'count', 'throughput', ''))
+        for stage, seconds, count, unit, extra in self.rows:
+            rate = seconds and count / seconds or float('inf')
+            print('%-20s %10.3f %10g %10.1f %s/s  %s' % (stage, seconds, count, rate, unit, extra))
+
+
+def run(args):
+    report = Report()
+    results = extract.load_results(args.results)
+    persons = persons_from_results(results, args.repeat)
+    durationMs = (persons[-1]['Timestamp'] if persons else 0) + 500
+    workdir = tempfile.mkdtemp(prefix='rekognition-bench-')
+    server = None
+    try:
+        video = os.path.join(workdir, 'synthetic.mp4')
+        t0 = time.time()
+        frames = synthesize_video(video, durationMs, args.fps, (args.width, args.height))
+        report.add('synthesize', time.time() - t0, frames, 'frames')
+
+        server = StubS3Server(latency=args.latency).start()
+        s3 = get_s3('', **server.s3_options())
+        size = os.path.getsize(video)
+        t0 = time.time()
+        keys = []
+        for i in range(args.jobs):
+            key = 'videos/synthetic-%d.mp4' % i
+            s3.object_put(video, S3Uri('s3://%s/%s' % (BUCKET, key)))
+            keys.append(key)
+        report.add('upload', time.time() - t0, args.jobs * size / 1048576.0, 'MB',
+                   '%d objects, %d requests' % (len(keys), sum(server.store.requests.values())))
+
+        sqs = StubSQS(latency=args.latency)
+        rek = StubRekognition(results, sqs, QUEUE_URL, latency=args.latency, jobDuration=args.job_duration,
+                              pageSize=args.page_size, repeat=args.repeat)
+        detect = VideoDetect(rek=rek, sqs=sqs)
+        orchestrator = JobOrchestrator(rek, sqs, QUEUE_URL, detect.roleArn, detect.topicArn, detect.collectionId,
+                                       functools.partial(detect.GetResultsFaceSearchCollection,
+                                                         compact=args.compact),
+                                       maxJobs=args.max_jobs,
+                                       waitSeconds=1)
+        t0 = time.time()
+        jobs = orchestrator.run([(BUCKET, key) for key in keys])
+        elapsed = time.time() - t0
+        waits = [job.completed - job.submitted for job in jobs]
+        report.add('start+notify', elapsed, len(jobs), 'jobs',
+                   'mean wait %.3fs, %d receives' % (sum(waits) / len(waits), orchestrator.stats['receives']))
+        fetchTime = sum(job.fetched - job.completed for job in jobs)
+        records = sum(len(from_data(job.results or [])) for job in jobs)
+        report.add('result paging', fetchTime, records, 'records',
+                   '%d pages' % rek.calls['get_face_search'])
+
+        outDir = os.path.join(workdir, 'frames')
+        os.makedirs(outDir)
+        vidcap = cv2.VideoCapture(video)
+        t0 = time.time()
+        detections = from_data(jobs[0].results)
+        written = extract.extract_frames(vidcap, detections, outDir)
+        report.add('frame extraction', time.time() - t0, written, 'frames',
+                   '%d detections' % len(detections))
+    finally:
+        if server is not None:
+            server.stop()
+        if args.keep:
+            print('Working files kept in %s' % workdir)
+        else:
+            shutil.rmtree(workdir)
+    report.show()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the video pipeline against local stub services.')
+    parser.add_argument('--results', default=os.path.join(VIDEO_ANALYSIS_DIR, 'data', 'r-rekognition.json'),
+                        help='recorded face search results to replay')
+    parser.add_argument('--jobs', type=int, default=4, help='videos to upload and analyse')
+    parser.add_argument('--max-jobs', type=int, default=20, help='concurrent jobs')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every service call')
+    parser.add_argument('--job-duration', type=float, default=0.1, help='seconds before a job reports completion')
+    parser.add_argument('--page-size', type=int, default=None, help='cap on results per page')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the recording this many times back to back')
+    parser.add_argument('--compact', action='store_true', help='fetch results in the compact schema')
+    parser.add_argument('--fps', type=int, default=24)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=360)
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
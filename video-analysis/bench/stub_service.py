@@ -0,0 +1,650 @@
+# Local stand-ins for the AWS services used by the video pipeline, for
+# benchmarks and tests only; nothing in the pipeline itself imports them.
+#
+# StubRekognition replays recorded face search results (the JSON printed by
+# rekognition_analysis.py, e.g. ../data/r-rekognition.json) and announces job
+# completion through StubSQS using the same SNS envelope as the real topic;
+# label detection jobs return a synthetic stream of `labels` label hits.
+# StubS3Server speaks enough of the S3 REST API over HTTP for the S3 class in
+# ../../s3cmd to upload, list, fetch and delete objects against it.
+# Every stand-in takes a per-call latency so pipelines can be timed offline.
+
+import binascii
+import base64
+import collections
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from xml.sax import saxutils
+from xml.etree import ElementTree as ET
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+
+def sns_envelope(rekMessage):
+    """Body of the SQS message SNS delivers for a Rekognition notification."""
+    return json.dumps({'Type': 'Notification', 'Message': json.dumps(rekMessage)})
+
+
+def persons_from_results(results, repeat=1, period=None):
+    """
+    Rebuild get_face_search 'Persons' entries from recorded results.
+    Face match records are attached to the person seen just before them at
+    the same timestamp. With repeat > 1 the recording is replayed
+    back to back, shifted by period milliseconds each time.
+    """
+    persons = []
+    for record in results:
+        if 'personInfo' in record:
+            persons.append({'Timestamp': record['TS'], 'Person': record['personInfo']})
+        elif 'faceInfo' in record:
+            if not persons or persons[-1]['Timestamp'] != record['TS']:
+                persons.append({'Timestamp': record['TS'], 'Person': {'Index': -1}})
+            persons[-1].setdefault('FaceMatches', []).append({'Face': record['faceInfo']})
+    if repeat <= 1 or not persons:
+        return persons
+    if period is None:
+        period = persons[-1]['Timestamp'] + 1
+    replayed = []
+    for i in range(repeat):
+        for person in persons:
+            person = dict(person, Timestamp=person['Timestamp'] + i * period)
+            replayed.append(person)
+    return replayed
+
+
+class StubSQS(object):
+    """In-memory SQS with visibility timeouts and long polling."""
+
+    def __init__(self, latency=0.0, visibilityTimeout=30):
+        self.latency = latency
+        self.visibilityTimeout = visibilityTimeout
+        self.cond = threading.Condition()
+        self.queues = collections.defaultdict(collections.OrderedDict)
+        self.handles = itertools.count(1)
+        self.calls = collections.Counter()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        with self.cond:
+            messageId = str(uuid.uuid4())
+            self.queues[QueueUrl][messageId] = {'MessageId': messageId, 'Body': MessageBody,
+                                                'visibleAt': 0.0, 'handle': None}
+            self.cond.notify_all()
+        return {'MessageId': messageId}
+
+    def _visible(self, queue, now):
+        return [m for m in queue.values() if m['visibleAt'] <= now]
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0,
+                        VisibilityTimeout=None, **kwargs):
+        self.calls['receive_message'] += 1
+        time.sleep(self.latency)
+        if VisibilityTimeout is None:
+            VisibilityTimeout = self.visibilityTimeout
+        deadline = time.time() + WaitTimeSeconds
+        with self.cond:
+            while True:
+                now = time.time()
+                queue = self.queues[QueueUrl]
+                visible = self._visible(queue, now)
+                if visible or now >= deadline:
+                    break
+                hidden = [m['visibleAt'] for m in queue.values()]
+                self.cond.wait(min([deadline] + hidden) - now)
+            messages = []
+            for m in visible[:MaxNumberOfMessages]:
+                m['visibleAt'] = now + VisibilityTimeout
+                m['handle'] = '%s#%d' % (m['MessageId'], next(self.handles))
+                messages.append({'MessageId': m['MessageId'], 'Body': m['Body'],
+                                 'ReceiptHandle': m['handle']})
+        if not messages:
+            return {}
+        return {'Messages': messages}
+
+    def _find(self, QueueUrl, ReceiptHandle):
+        messageId = ReceiptHandle.split('#')[0]
+        message = self.queues[QueueUrl].get(messageId)
+        if message is None or message['handle'] != ReceiptHandle:
+            raise KeyError('ReceiptHandleIsInvalid: %s' % ReceiptHandle)
+        return message
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.calls['delete_message'] += 1
+        time.sleep(self.latency)
+        with self.cond:
+            message = self._find(QueueUrl, ReceiptHandle)
+            del self.queues[QueueUrl][message['MessageId']]
+        return {}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        self.calls['change_message_visibility'] += 1
+        time.sleep(self.latency)
+        with self.cond:
+            self._find(QueueUrl, ReceiptHandle)['visibleAt'] = time.time() + VisibilityTimeout
+            self.cond.notify_all()
+        return {}
+
+
+class StubClientError(Exception):
+    """Raised like botocore's ClientError, with the error code under response['Error']['Code']."""
+
+    def __init__(self, code, message=''):
+        Exception.__init__(self, '%s: %s' % (code, message))
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+class StubRekognition(object):
+    """
+    Replays recorded face search results for every job it starts, and keeps
+    in-memory collections for the face indexing calls.
+    latency: seconds added to every API call
+    jobDuration: seconds between start_face_search and the notification
+    pageSize: upper bound on results per page, whatever MaxResults asks for
+    throttleRate: fraction of calls answered with a throttling error
+    """
+
+    def __init__(self, results=(), sqs=None, queueUrl=None, latency=0.0, jobDuration=0.0,
+                 pageSize=None, repeat=1, period=None, throttleRate=0.0, labels=0):
+        self.persons = persons_from_results(results, repeat, period)
+        self.labels = labels
+        self.throttleRate = throttleRate
+        self.random = random.Random(0)
+        self.collections = collections.defaultdict(collections.OrderedDict)
+        self.sqs = sqs
+        self.queueUrl = queueUrl
+        self.latency = latency
+        self.jobDuration = jobDuration
+        self.pageSize = pageSize
+        self.jobs = {}
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def _call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+            throttled = self.throttleRate and self.random.random() < self.throttleRate
+        time.sleep(self.latency)
+        if throttled:
+            with self.lock:
+                self.calls['throttled'] += 1
+            raise StubClientError('ProvisionedThroughputExceededException', name)
+
+    def _complete(self, jobId):
+        job = self.jobs[jobId]
+        job['JobStatus'] = 'SUCCEEDED'
+        if self.sqs is not None:
+            video = job['Video']['S3Object']
+            self.sqs.send_message(QueueUrl=self.queueUrl, MessageBody=sns_envelope({
+                'JobId': jobId, 'Status': 'SUCCEEDED', 'API': job['API'],
+                'Timestamp': int(time.time() * 1000),
+                'Video': {'S3Bucket': video['Bucket'], 'S3ObjectName': video['Name']}}))
+
+    def _start(self, api, Video, **kwargs):
+        jobId = uuid.uuid4().hex * 2
+        self.jobs[jobId] = {'API': api, 'Video': Video, 'JobStatus': 'IN_PROGRESS', 'params': kwargs}
+        timer = threading.Timer(self.jobDuration, self._complete, (jobId,))
+        timer.daemon = True
+        timer.start()
+        return {'JobId': jobId}
+
+    def start_face_search(self, Video, CollectionId, NotificationChannel=None, **kwargs):
+        self._call('start_face_search')
+        return self._start('StartFaceSearch', Video, CollectionId=CollectionId, **kwargs)
+
+    def _page(self, items, MaxResults, NextToken):
+        offset = int(NextToken or 0)
+        count = MaxResults
+        if self.pageSize:
+            count = min(count, self.pageSize)
+        page = items[offset:offset + count]
+        nextToken = str(offset + count) if offset + count < len(items) else None
+        return page, nextToken
+
+    def get_face_search(self, JobId, MaxResults=1000, NextToken='', SortBy='TIMESTAMP'):
+        self._call('get_face_search')
+        job = self.jobs[JobId]
+        page, nextToken = self._page(self.persons, MaxResults, NextToken)
+        response = {'JobStatus': job['JobStatus'], 'Persons': page,
+                    'VideoMetadata': {'Codec': 'h264', 'Format': 'QuickTime / MOV',
+                                      'DurationMillis': self.persons[-1]['Timestamp'] if self.persons else 0,
+                                      'FrameRate': 24.0}}
+        if nextToken:
+            response['NextToken'] = nextToken
+        return response
+
+
+    def start_label_detection(self, Video, NotificationChannel=None, **kwargs):
+        self._call('start_label_detection')
+        return self._start('StartLabelDetection', Video, **kwargs)
+
+    LABEL_NAMES = ('Person', 'Human', 'Face', 'Clothing', 'Indoors', 'Furniture', 'Screen', 'Text')
+
+    def label_hit(self, i):
+        """The i-th of self.labels synthetic label hits: four per 200 ms, labels fading in and out."""
+        ts = (i // 4) * 200
+        name = self.LABEL_NAMES[(i % 4 + ts // 5000) % len(self.LABEL_NAMES)]
+        return {'Timestamp': ts, 'Label': {'Name': name, 'Confidence': 50.0 + (i * 37) % 50,
+                                           'Instances': [], 'Parents': []}}
+
+    def get_label_detection(self, JobId, MaxResults=1000, NextToken='', SortBy='TIMESTAMP'):
+        self._call('get_label_detection')
+        job = self.jobs[JobId]
+        offset = int(NextToken or 0)
+        count = min(MaxResults, self.pageSize or MaxResults, self.labels - offset)
+        response = {'JobStatus': job['JobStatus'],
+                    'Labels': [self.label_hit(i) for i in range(offset, offset + count)],
+                    'VideoMetadata': {'Codec': 'h264', 'Format': 'QuickTime / MOV',
+                                      'DurationMillis': (self.labels // 4) * 200, 'FrameRate': 24.0}}
+        if offset + count < self.labels:
+            response['NextToken'] = str(offset + count)
+        return response
+
+    def index_faces(self, CollectionId, Image, ExternalImageId=None, DetectionAttributes=None, **kwargs):
+        self._call('index_faces')
+        face = {'FaceId': str(uuid.uuid4()), 'ImageId': str(uuid.uuid4()), 'Confidence': 99.9,
+                'BoundingBox': {'Width': 0.25, 'Height': 0.4, 'Left': 0.375, 'Top': 0.3}}
+        if ExternalImageId:
+            face['ExternalImageId'] = ExternalImageId
+        with self.lock:
+            self.collections[CollectionId][face['FaceId']] = face
+        return {'FaceRecords': [{'Face': dict(face)}], 'FaceModelVersion': '4.0', 'UnindexedFaces': []}
+
+    def search_faces_by_image(self, CollectionId, Image, MaxFaces=80, FaceMatchThreshold=80.0, **kwargs):
+        """Every collection face 'matches' with a similarity derived from the image bytes."""
+        self._call('search_faces_by_image')
+        data = Image.get('Bytes', b'')
+        with self.lock:
+            faces = list(self.collections[CollectionId].values())
+        matches = []
+        for face in faces:
+            digest = hashlib.md5(data + face['FaceId'].encode('ascii')).digest()
+            similarity = 70.0 + digest[0] % 30 + digest[1] / 256.0
+            if similarity >= FaceMatchThreshold:
+                matches.append({'Similarity': similarity, 'Face': dict(face)})
+        matches.sort(key=lambda match: -match['Similarity'])
+        return {'SearchedFaceBoundingBox': {'Width': 0.5, 'Height': 0.5, 'Left': 0.25, 'Top': 0.25},
+                'SearchedFaceConfidence': 99.9, 'FaceMatches': matches[:MaxFaces], 'FaceModelVersion': '4.0'}
+
+    def list_faces(self, CollectionId, MaxResults=1000, NextToken=''):
+        self._call('list_faces')
+        with self.lock:
+            faces = [dict(face) for face in self.collections[CollectionId].values()]
+        page, nextToken = self._page(faces, MaxResults, NextToken)
+        response = {'Faces': page, 'FaceModelVersion': '4.0'}
+        if nextToken:
+            response['NextToken'] = nextToken
+        return response
+
+
+class StubS3Store(object):
+    """Objects and multipart uploads held by StubS3Server, keyed by bucket then key."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = collections.defaultdict(dict)
+        self.uploads = {}
+        self.requests = collections.Counter()
+        # key -> error codes answered by successive Multi-Object Deletes of it
+        self.deleteErrors = {}
+
+    def put(self, bucket, key, data, headers=None, etag=None):
+        obj = {'data': data, 'etag': etag or hashlib.md5(data).hexdigest(),
+               'mtime': time.time(), 'headers': dict(headers or {})}
+        with self.lock:
+            self.buckets[bucket][key] = obj
+        return obj
+
+
+STUB_OWNER = '<Owner><ID>%s</ID><DisplayName>stub</DisplayName></Owner>' % ('0' * 64)
+
+
+def _xml(tag, body):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<%s xmlns="http://s3.amazonaws.com/doc/2006-03-01/">%s</%s>'
+            % (tag, body, tag)).encode('utf-8')
+
+
+def _s3_timestamp(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(t))
+
+
+def _http_timestamp(t):
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(t))
+
+
+class StubS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _parse(self):
+        url = urlparse(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        bucket = unquote(parts[0]) or None
+        key = unquote(parts[1]) if len(parts) > 1 and parts[1] else None
+        params = dict((k, v[0]) for k, v in parse_qs(url.query, keep_blank_values=True).items())
+        return bucket, key, params
+
+    def _body(self):
+        length = int(self.headers.get('content-length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, body=b'', headers=None, head=False):
+        self.send_response(status)
+        headers = headers or {}
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(headers.get('Content-Length', len(body))))
+        self.end_headers()
+        if body and not head:
+            self.wfile.write(body)
+
+    def _error(self, status, code, message=''):
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>%s</Code><Message>%s</Message></Error>'
+                % (code, saxutils.escape(message))).encode('utf-8')
+        self._send(status, body, {'Content-Type': 'application/xml'})
+
+    def _dispatch(self, method):
+        store = self.server.store
+        time.sleep(self.server.latency)
+        bucket, key, params = self._parse()
+        with store.lock:
+            store.requests[method] += 1
+        target = key and 'object' or bucket and 'bucket' or 'service'
+        handler = getattr(self, '%s_%s' % (method.lower(), target), None)
+        if handler is None:
+            self._body()
+            self._error(501, 'NotImplemented', '%s on %s' % (method, target))
+            return
+        handler(store, bucket, key, params)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    ## Service / bucket level
+    def get_service(self, store, bucket, key, params):
+        buckets = ''.join('<Bucket><Name>%s</Name><CreationDate>%s</CreationDate></Bucket>'
+                          % (saxutils.escape(name), _s3_timestamp(0)) for name in sorted(store.buckets))
+        self._send(200, _xml('ListAllMyBucketsResult', '<Buckets>%s</Buckets>' % buckets))
+
+    def put_bucket(self, store, bucket, key, params):
+        self._body()
+        with store.lock:
+            store.buckets[bucket]
+        self._send(200)
+
+    def delete_bucket(self, store, bucket, key, params):
+        with store.lock:
+            store.buckets.pop(bucket, None)
+        self._send(204)
+
+    def get_bucket(self, store, bucket, key, params):
+        if 'location' in params:
+            self._send(200, _xml('LocationConstraint', ''))
+            return
+        if 'uploads' in params:
+            uploads = ''.join('<Upload><Key>%s</Key><UploadId>%s</UploadId></Upload>'
+                              % (saxutils.escape(u['key']), uploadId)
+                              for uploadId, u in sorted(store.uploads.items()) if u['bucket'] == bucket)
+            self._send(200, _xml('ListMultipartUploadsResult', '<Bucket>%s</Bucket>%s' % (bucket, uploads)))
+            return
+        if bucket not in store.buckets:
+            self._error(404, 'NoSuchBucket', bucket)
+            return
+        self._send(200, self.list_bucket(store, bucket, params))
+
+    def list_bucket(self, store, bucket, params):
+        """ListObjects (V1) or, with list-type=2, ListObjectsV2; owners only where S3 would send them."""
+        prefix = params.get('prefix', '')
+        delimiter = params.get('delimiter', '')
+        v2 = params.get('list-type') == '2'
+        if v2:
+            token = params.get('continuation-token')
+            marker = binascii.unhexlify(token).decode('utf-8') if token else params.get('start-after', '')
+            owner = params.get('fetch-owner') == 'true'
+        else:
+            marker = params.get('marker', '')
+            owner = True
+        maxKeys = int(params.get('max-keys', 1000))
+        with store.lock:
+            store.requests[v2 and 'ListObjectsV2' or 'ListObjects'] += 1
+            keys = sorted(k for k in store.buckets[bucket] if k.startswith(prefix) and k > marker)
+            objects = store.buckets[bucket]
+            contents, prefixes = [], []
+            truncated = False
+            last = None
+            for k in keys:
+                if delimiter:
+                    pos = k.find(delimiter, len(prefix))
+                    if pos >= 0:
+                        common = k[:pos + len(delimiter)]
+                        if prefixes and prefixes[-1] == common:
+                            continue
+                        if len(contents) + len(prefixes) >= maxKeys:
+                            truncated = True
+                            break
+                        prefixes.append(common)
+                        last = common
+                        continue
+                if len(contents) + len(prefixes) >= maxKeys:
+                    truncated = True
+                    break
+                obj = objects[k]
+                contents.append('<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>"%s"</ETag>'
+                                '<Size>%d</Size>%s<StorageClass>STANDARD</StorageClass></Contents>'
+                                % (saxutils.escape(k), _s3_timestamp(obj['mtime']), obj['etag'], len(obj['data']),
+                                   owner and STUB_OWNER or ''))
+                last = k
+        body = '<Name>%s</Name><Prefix>%s</Prefix><MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>' % (
+            bucket, saxutils.escape(prefix), maxKeys, truncated and 'true' or 'false')
+        if v2:
+            body += '<KeyCount>%d</KeyCount>' % (len(contents) + len(prefixes))
+            if truncated and last is not None:
+                body += '<NextContinuationToken>%s</NextContinuationToken>' % (
+                    binascii.hexlify(last.encode('utf-8')).decode('ascii'))
+        else:
+            body += '<Marker>%s</Marker>' % saxutils.escape(marker)
+            if truncated and delimiter and last is not None:
+                body += '<NextMarker>%s</NextMarker>' % saxutils.escape(last)
+        body += ''.join(contents)
+        body += ''.join('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' % saxutils.escape(p) for p in prefixes)
+        return _xml('ListBucketResult', body)
+
+    def post_bucket(self, store, bucket, key, params):
+        body = self._body()
+        if 'delete' not in params:
+            self._error(400, 'InvalidRequest', 'Unsupported bucket POST')
+            return
+        tree = ET.fromstring(body)
+        quiet = any(node.tag.endswith('Quiet') and node.text == 'true' for node in tree.iter())
+        deleted, errors = [], []
+        with store.lock:
+            for node in tree.iter():
+                if node.tag.endswith('Key'):
+                    codes = store.deleteErrors.get(node.text)
+                    if codes:
+                        errors.append((node.text, codes.pop(0)))
+                        continue
+                    store.buckets[bucket].pop(node.text, None)
+                    deleted.append(node.text)
+        result = '' if quiet else ''.join('<Deleted><Key>%s</Key></Deleted>' % saxutils.escape(k) for k in deleted)
+        result += ''.join('<Error><Key>%s</Key><Code>%s</Code><Message>stub</Message></Error>'
+                          % (saxutils.escape(k), code) for k, code in errors)
+        self._send(200, _xml('DeleteResult', result), {'Content-Type': 'application/xml'})
+
+    ## Object level
+    def _object_headers(self, obj):
+        headers = {'ETag': '"%s"' % obj['etag'], 'Last-Modified': _http_timestamp(obj['mtime']),
+                   'Content-Type': obj['headers'].get('content-type', 'binary/octet-stream'),
+                   'Content-Length': len(obj['data'])}
+        for name, value in obj['headers'].items():
+            if name.startswith('x-amz-meta-'):
+                headers[name] = value
+        return headers
+
+    def _get_object(self, store, bucket, key, head):
+        obj = store.buckets.get(bucket, {}).get(key)
+        if obj is None:
+            if head:
+                self._send(404, head=True)
+            else:
+                self._error(404, 'NoSuchKey', key)
+            return
+        data = obj['data']
+        headers = self._object_headers(obj)
+        status = 200
+        rng = self.headers.get('range')
+        if rng and rng.startswith('bytes='):
+            start = int(rng[6:].split('-')[0])
+            data = data[start:]
+            headers['Content-Length'] = len(data)
+            status = 206
+        self._send(status, data, headers, head=head)
+
+    def head_object(self, store, bucket, key, params):
+        self._get_object(store, bucket, key, head=True)
+
+    def get_object(self, store, bucket, key, params):
+        if 'uploadId' in params:
+            upload = store.uploads.get(params['uploadId'])
+            if upload is None:
+                self._error(404, 'NoSuchUpload', params['uploadId'])
+                return
+            parts = ''.join('<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag><Size>%d</Size></Part>'
+                            % (n, hashlib.md5(d).hexdigest(), len(d)) for n, d in sorted(upload['parts'].items()))
+            self._send(200, _xml('ListPartsResult', parts))
+            return
+        self._get_object(store, bucket, key, head=False)
+
+    def put_object(self, store, bucket, key, params):
+        data = self._body()
+        headers = dict((k.lower(), v) for k, v in self.headers.items())
+        with store.lock:
+            if 'uploadId' in params:
+                store.requests['UploadPart'] += 1
+            if 'content-md5' in headers:
+                store.requests['Content-MD5'] += 1
+        if 'content-md5' in headers:
+            if headers['content-md5'] != base64.b64encode(hashlib.md5(data).digest()).decode():
+                self._error(400, 'BadDigest', 'The Content-MD5 you specified did not match what we received.')
+                return
+        if 'uploadId' in params:
+            upload = store.uploads.get(params['uploadId'])
+            if upload is None:
+                self._error(404, 'NoSuchUpload', params['uploadId'])
+                return
+            with store.lock:
+                upload['parts'][int(params['partNumber'])] = data
+            self._send(200, headers={'ETag': '"%s"' % hashlib.md5(data).hexdigest()})
+            return
+        source = headers.get('x-amz-copy-source')
+        if source:
+            srcBucket, srcKey = unquote(source).lstrip('/').split('/', 1)
+            src = store.buckets.get(srcBucket, {}).get(srcKey)
+            if src is None:
+                self._error(404, 'NoSuchKey', srcKey)
+                return
+            match = headers.get('x-amz-copy-source-if-match')
+            if match and match.strip('"') != src['etag']:
+                self._error(412, 'PreconditionFailed', 'x-amz-copy-source-if-match')
+                return
+            if headers.get('x-amz-metadata-directive') != 'REPLACE':
+                headers = src['headers']
+            obj = store.put(bucket, key, src['data'], headers, src['etag'])
+            self._send(200, _xml('CopyObjectResult', '<LastModified>%s</LastModified><ETag>"%s"</ETag>'
+                                 % (_s3_timestamp(obj['mtime']), obj['etag'])))
+            return
+        obj = store.put(bucket, key, data, headers)
+        self._send(200, headers={'ETag': '"%s"' % obj['etag']})
+
+    def post_object(self, store, bucket, key, params):
+        body = self._body()
+        if 'uploads' in params:
+            uploadId = uuid.uuid4().hex
+            headers = dict((k.lower(), v) for k, v in self.headers.items())
+            with store.lock:
+                store.uploads[uploadId] = {'bucket': bucket, 'key': key, 'parts': {}, 'headers': headers}
+            self._send(200, _xml('InitiateMultipartUploadResult',
+                                 '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                                 % (bucket, saxutils.escape(key), uploadId)))
+            return
+        if 'uploadId' in params:
+            upload = store.uploads.pop(params['uploadId'], None)
+            if upload is None:
+                self._error(404, 'NoSuchUpload', params['uploadId'])
+                return
+            numbers = [int(node.text) for node in ET.fromstring(body).iter() if node.tag.endswith('PartNumber')]
+            data = b''.join(upload['parts'][n] for n in numbers)
+            digests = b''.join(hashlib.md5(upload['parts'][n]).digest() for n in numbers)
+            etag = '%s-%d' % (hashlib.md5(digests).hexdigest(), len(numbers))
+            store.put(bucket, key, data, upload['headers'], etag)
+            self._send(200, _xml('CompleteMultipartUploadResult',
+                                 '<Bucket>%s</Bucket><Key>%s</Key><ETag>"%s"</ETag>'
+                                 % (bucket, saxutils.escape(key), etag)))
+            return
+        self._error(400, 'InvalidRequest', 'Unsupported object POST')
+
+    def delete_object(self, store, bucket, key, params):
+        with store.lock:
+            if 'uploadId' in params:
+                store.uploads.pop(params['uploadId'], None)
+            else:
+                store.buckets.get(bucket, {}).pop(key, None)
+        self._send(204)
+
+
+class StubS3Server(ThreadingMixIn, HTTPServer):
+    """
+    Threaded local S3 endpoint. Path-style requests only; signatures are
+    not checked. Use s3_options() to point the S3 class at it.
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, store=None):
+        HTTPServer.__init__(self, (host, port), StubS3Handler)
+        self.latency = latency
+        self.store = store or StubS3Store()
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        return '%s:%d' % self.server_address[:2]
+
+    def s3_options(self):
+        return {'host_base': self.endpoint, 'host_bucket': self.endpoint,
+                'use_https': False, 'signature_v2': True, 'progress_meter': False,
+                'access_key': 'stub', 'secret_key': 'stub'}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,324 @@
+# Compact form of face search results.
+#
+#   python compact_results.py data/r-rekognition.json r-rekognition.compact.json
+#
+# The legacy results are one dict per detection: person detections repeat
+# their bounding box inside personInfo and every face match repeats the full
+# faceInfo block of the collection face. The compact form stores
+#
+#   Faces    each matched collection face once (FaceId, ExternalImageId,
+#            ImageId, Confidence, BoundingBox); records refer to it by position
+#   Persons  one row per person detection: Box, landmarks as flat x/y lists
+#            in LandmarkTypes order, Pose/Quality as fixed-order lists
+#   Records  parallel columns TS, Person, Face (-1 where not applicable) and
+#            Similarity
+#
+# Boxes are flattened to Left, Top, Width, Height. The service reports single
+# precision values, so when every number is exactly a float32 (Float32 is
+# true) it is written with the fewest digits that still identify it.
+#
+# CompactResults reads that back as a sequence of legacy records, built on
+# demand, so existing consumers keep working unchanged.
+
+import json
+import struct
+import sys
+
+SCHEMA = 'face-search-compact/1'
+BOX = ('Left', 'Top', 'Width', 'Height')
+POSE = ('Pitch', 'Roll', 'Yaw')
+QUALITY = ('Brightness', 'Sharpness')
+FACE_KEYS = ('BoundingBox', 'Confidence', 'Landmarks', 'Pose', 'Quality')
+
+
+def _flat_box(box):
+    return [box[k] for k in BOX]
+
+
+def _box(values):
+    return dict(zip(BOX, values))
+
+
+def _values(d, keys):
+    return None if d is None else [d[k] for k in keys]
+
+
+def _to32(x):
+    return struct.unpack('f', struct.pack('f', x))[0]
+
+
+def _short32(x):
+    """Shortest decimal that reads back as the same float32."""
+    for digits in range(6, 10):
+        y = float('%.*g' % (digits, x))
+        if _to32(y) == x:
+            return y
+    return x
+
+
+def _map_floats(value, fn):
+    if isinstance(value, float):
+        return fn(value)
+    if isinstance(value, list):
+        return [_map_floats(v, fn) for v in value]
+    return value
+
+
+def _all_float32(value):
+    if isinstance(value, float):
+        return _to32(value) == value
+    if isinstance(value, list):
+        return all(_all_float32(v) for v in value)
+    return True
+
+
+class CompactBuilder(object):
+    """Accumulates get_face_search pages or legacy records into the compact form."""
+
+    def __init__(self):
+        self.faceIndex = {}
+        self.faces = []
+        self.landmarkTypes = []
+        self.persons = {'Index': [], 'Box': [], 'Confidence': [], 'Landmarks': [], 'Pose': [],
+                        'Quality': [], 'BoundingBox': [], 'Extra': []}
+        self.records = {'TS': [], 'Person': [], 'Face': [], 'Similarity': []}
+
+    def _record(self, ts, person, face, similarity=None):
+        self.records['TS'].append(ts)
+        self.records['Person'].append(person)
+        self.records['Face'].append(face)
+        self.records['Similarity'].append(similarity)
+
+    def add_person(self, ts, person):
+        face = person['Face']
+        landmarks = [None] * len(self.landmarkTypes)
+        for landmark in face.get('Landmarks', ()):
+            if landmark['Type'] not in self.landmarkTypes:
+                self.landmarkTypes.append(landmark['Type'])
+                landmarks.append(None)
+            landmarks[self.landmarkTypes.index(landmark['Type'])] = [landmark['X'], landmark['Y']]
+        extra = dict((k, v) for k, v in face.items() if k not in FACE_KEYS)
+        rows = self.persons
+        rows['Index'].append(person.get('Index'))
+        rows['Box'].extend(_flat_box(face['BoundingBox']))
+        rows['Confidence'].append(face.get('Confidence'))
+        rows['Landmarks'].append([xy for point in landmarks for xy in (point or (None, None))]
+                                 if 'Landmarks' in face else None)
+        rows['Pose'].append(_values(face.get('Pose'), POSE))
+        rows['Quality'].append(_values(face.get('Quality'), QUALITY))
+        rows['BoundingBox'].append(_flat_box(person['BoundingBox']) if 'BoundingBox' in person else None)
+        rows['Extra'].append(extra or None)
+        self._record(ts, len(rows['Index']) - 1, -1)
+
+    def add_match(self, ts, face, similarity=None):
+        ref = self.faceIndex.get(face['FaceId'])
+        if ref is None:
+            ref = self.faceIndex[face['FaceId']] = len(self.faces)
+            self.faces.append(dict(face, BoundingBox=_flat_box(face['BoundingBox'])))
+        self._record(ts, -1, ref, similarity)
+
+    def add_response(self, response):
+        """Add the Persons of one get_face_search page, in the legacy record order."""
+        for personMatch in response['Persons']:
+            if 'Face' in personMatch.get('Person', ()):
+                self.add_person(personMatch['Timestamp'], personMatch['Person'])
+            for faceMatch in personMatch.get('FaceMatches', ()):
+                self.add_match(personMatch['Timestamp'], faceMatch['Face'], faceMatch.get('Similarity'))
+
+    def add_legacy(self, records):
+        for record in records:
+            if 'personInfo' in record:
+                self.add_person(record['TS'], record['personInfo'])
+            else:
+                self.add_match(record['TS'], record['faceInfo'])
+        return self
+
+    def to_dict(self):
+        persons = dict(self.persons)
+        # rows written before a new landmark type appeared are shorter; pad them
+        width = 2 * len(self.landmarkTypes)
+        persons['Landmarks'] = [row if row is None or len(row) == width else row + [None] * (width - len(row))
+                                for row in persons['Landmarks']]
+        faces = self.faces
+        records = dict(self.records)
+        columns = [v for k, v in sorted(persons.items()) if k != 'Extra'] + [records['Similarity']]
+        float32 = all(_all_float32(column) for column in columns) and \
+            all(_all_float32([face.get('Confidence'), face['BoundingBox']]) for face in faces)
+        if float32:
+            for k in persons:
+                if k != 'Extra':
+                    persons[k] = _map_floats(persons[k], _short32)
+            records['Similarity'] = _map_floats(records['Similarity'], _short32)
+            faces = [dict(face, Confidence=_map_floats(face.get('Confidence'), _short32),
+                          BoundingBox=_map_floats(face['BoundingBox'], _short32)) for face in faces]
+        return {'Schema': SCHEMA, 'Float32': float32, 'Faces': faces, 'LandmarkTypes': self.landmarkTypes,
+                'Persons': persons, 'Records': records}
+
+
+def compact(records):
+    """Legacy result list -> compact dict."""
+    return CompactBuilder().add_legacy(records).to_dict()
+
+
+class CompactResults(object):
+    """Read-only sequence of legacy-shaped records over a compact dict."""
+
+    def __init__(self, data):
+        if data.get('Schema') != SCHEMA:
+            raise ValueError('Unsupported results schema %r' % data.get('Schema'))
+        self.data = data
+        self.records = data['Records']
+        self.persons = data['Persons']
+        self.faces = dict((face['FaceId'], face) for face in data['Faces'])
+        self.landmarkTypes = data['LandmarkTypes']
+        self.float = _to32 if data.get('Float32') else float
+
+    def __len__(self):
+        return len(self.records['TS'])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        records = self.records
+        face = records['Face'][i]
+        if face >= 0:
+            info = self.face(face)
+            return {'TS': records['TS'][i], 'boundingBox': dict(info['BoundingBox']), 'faceInfo': info}
+        person = self.person(records['Person'][i])
+        return {'TS': records['TS'][i], 'boundingBox': dict(person['Face']['BoundingBox']), 'personInfo': person}
+
+    def _box(self, values):
+        return _box([self.float(v) for v in values])
+
+    def face(self, ref):
+        face = dict(self.data['Faces'][ref])
+        face['BoundingBox'] = self._box(face['BoundingBox'])
+        if face.get('Confidence') is not None:
+            face['Confidence'] = self.float(face['Confidence'])
+        return face
+
+    def person(self, row):
+        rows = self.persons
+        f = self.float
+        face = {'BoundingBox': self._box(rows['Box'][4 * row:4 * row + 4])}
+        if rows['Confidence'][row] is not None:
+            face['Confidence'] = f(rows['Confidence'][row])
+        if rows['Landmarks'][row] is not None:
+            xy = rows['Landmarks'][row]
+            face['Landmarks'] = [{'Type': t, 'X': f(xy[2 * k]), 'Y': f(xy[2 * k + 1])}
+                                 for k, t in enumerate(self.landmarkTypes) if xy[2 * k] is not None]
+        if rows['Pose'][row] is not None:
+            face['Pose'] = dict(zip(POSE, map(f, rows['Pose'][row])))
+        if rows['Quality'][row] is not None:
+            face['Quality'] = dict(zip(QUALITY, map(f, rows['Quality'][row])))
+        if rows['Extra'][row]:
+            face.update(rows['Extra'][row])
+        person = {'Face': face}
+        if rows['Index'][row] is not None:
+            person['Index'] = rows['Index'][row]
+        if rows['BoundingBox'][row] is not None:
+            person['BoundingBox'] = self._box(rows['BoundingBox'][row])
+        return person
+
+
+def detection_arrays(data):
+    """
+    (ts, boxes) as NumPy arrays for legacy or compact results: ts has one
+    timestamp per record, boxes one Left, Top, Width, Height row per record.
+    """
+    import numpy as np
+    if isinstance(data, CompactResults):
+        records = data.records
+        face = np.asarray(records['Face'], np.int64)
+        person = np.asarray(records['Person'], np.int64)
+        boxes = np.empty((len(face), 4))
+        isPerson = face < 0
+        if isPerson.any():
+            boxes[isPerson] = np.asarray(data.persons['Box'], float).reshape(-1, 4)[person[isPerson]]
+        if not isPerson.all():
+            faceBoxes = np.array([f['BoundingBox'] for f in data.data['Faces']], float).reshape(-1, 4)
+            boxes[~isPerson] = faceBoxes[face[~isPerson]]
+        return np.asarray(records['TS'], np.int64), boxes
+    ts = np.array([d['TS'] for d in data], np.int64)
+    boxes = np.array([_flat_box(d['boundingBox']) for d in data], float).reshape(-1, 4)
+    return ts, boxes
+
+
+def detection_columns(data):
+    """
+    Per-record NumPy columns for legacy or compact results:
+
+        TS, Box      as detection_arrays()
+        Index        personInfo Index, -1 for face matches or when absent
+        Face         position in FaceIds for face matches, -1 for persons
+        Score        Similarity of a face match (the face Confidence when
+                     the results carry none), face Confidence for persons
+        FaceIds      matched collection FaceIds
+        Names        their ExternalImageIds (None when unknown)
+    """
+    import numpy as np
+    ts, boxes = detection_arrays(data)
+    if isinstance(data, CompactResults):
+        records = data.records
+        faces = data.data['Faces']
+        face = np.asarray(records['Face'], np.int64)
+        person = np.asarray(records['Person'], np.int64)
+        personIndex = np.array([-1 if i is None else i for i in data.persons['Index']], np.int64)
+        personScore = np.array([np.nan if c is None else c for c in data.persons['Confidence']], float)
+        faceScore = np.array([np.nan if f.get('Confidence') is None else f['Confidence'] for f in faces], float)
+        isPerson = face < 0
+        index = np.full(len(face), -1, np.int64)
+        index[isPerson] = personIndex[person[isPerson]]
+        score = np.array([np.nan if v is None else v for v in records['Similarity']], float)
+        missing = ~isPerson & np.isnan(score)
+        score[missing] = faceScore[face[missing]]
+        score[isPerson] = personScore[person[isPerson]]
+        return {'TS': ts, 'Box': boxes, 'Index': index, 'Face': face, 'Score': score,
+                'FaceIds': [f['FaceId'] for f in faces], 'Names': [f.get('ExternalImageId') for f in faces]}
+    faceIndex = {}
+    faceIds = []
+    names = []
+    index = np.empty(len(ts), np.int64)
+    face = np.empty(len(ts), np.int64)
+    score = np.empty(len(ts))
+    for i, d in enumerate(data):
+        if 'personInfo' in d:
+            index[i] = d['personInfo'].get('Index', -1)
+            face[i] = -1
+            score[i] = d['personInfo']['Face'].get('Confidence', np.nan)
+            continue
+        info = d['faceInfo']
+        ref = faceIndex.get(info['FaceId'])
+        if ref is None:
+            ref = faceIndex[info['FaceId']] = len(faceIds)
+            faceIds.append(info['FaceId'])
+            names.append(info.get('ExternalImageId'))
+        index[i] = -1
+        face[i] = ref
+        score[i] = info.get('Confidence', np.nan)
+    return {'TS': ts, 'Box': boxes, 'Index': index, 'Face': face, 'Score': score,
+            'FaceIds': faceIds, 'Names': names}
+
+
+def from_data(data):
+    """Wrap parsed results: legacy lists are returned as they are."""
+    if isinstance(data, dict):
+        return CompactResults(data)
+    return data
+
+
+def main():
+    with open(sys.argv[1]) as f:
+        legacy = json.load(f)
+    with open(sys.argv[2], 'w') as f:
+        json.dump(compact(legacy), f, separators=(',', ':'))
+
+
+if __name__ == "__main__":
+    main()
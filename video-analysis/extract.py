@@ -1,39 +1,196 @@
+import argparse
 import cv2
 import sys
 import numpy as np
 import json
+import os
 
-vidcap = cv2.VideoCapture(sys.argv[1])
-json_data=open(sys.argv[2]).read()
-data = json.loads(json_data)
-for d in data:
+import frame_store
+import overlay
+from compact_results import from_data
+from result_index import ResultIndex, parse_time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'collection'))
+
+PERSON_COLOR = (0, 255, 0)
+MATCH_COLOR = (0, 200, 255)
+
+
+def load_results(path):
+    """Legacy result list, or a lazy view of it for compact_results files."""
+    json_data=open(path).read()
+    return from_data(json.loads(json_data))
+
+
+def load_inventory(collectionId, path=None):
+    from face_inventory import FaceInventory
+    return FaceInventory.load(collectionId, path)
+
+
+def face_name(face, inventory=None):
+    """ExternalImageId of a matched face, from the local inventory when the result lacks it."""
+    name = face.get('ExternalImageId')
+    if name is None and inventory is not None:
+        name = inventory.resolve(face.get('FaceId'))
+    return name or face.get('FaceId', '?')
+
+
+def detection_info(d, inventory=None):
     if 'personInfo' in d:
-        info = "confidence: "+ str(d['personInfo']['Face']['Confidence'])
-    else:
-        info= "confidence: "+ str(d['faceInfo']['Confidence']) + "( "+ d['faceInfo']['ExternalImageId'] + " )"
+        return "confidence: "+ str(d['personInfo']['Face']['Confidence'])
+    return "confidence: "+ str(d['faceInfo']['Confidence']) + "( "+ face_name(d['faceInfo'], inventory) + " )"
 
-    ts = d["TS"]
-    awidth=d['boundingBox']['Width']
-    atop=d['boundingBox']['Top']
-    aleft=d['boundingBox']['Left']
-    aheight=d['boundingBox']['Height']
 
-    vidcap.set(cv2.CAP_PROP_POS_MSEC,int(ts))
-    hasFrames,image = vidcap.read()
-    
-    if hasFrames:
+class FrameSeeker(object):
+    """
+    Reads frames by timestamp. Seeking makes the decoder restart at the
+    previous keyframe, so when the next timestamp is only a few frames
+    ahead the frames in between are decoded and dropped instead.
+    """
 
-        height = image.shape[0]
-        width = image.shape[1]
-        tx=int(aleft*width)
-        ty = int(atop*height)
-        bx= int(tx + (awidth*width))
-        by = int(ty + (aheight*height))
-        cv2.rectangle(image,(tx,ty),(bx,by),(0,255,0),3)
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        cv2.putText(image,info,(10,100), font, 1,(255,255,255),2,cv2.LINE_AA)
+    def __init__(self, vidcap, maxSkip=48):
+        self.vidcap = vidcap
+        self.maxSkip = maxSkip
+        self.fps = vidcap.get(cv2.CAP_PROP_FPS) or 0
 
-        cv2.imwrite("frames/russell/"+str(ts)+".jpg", image)     
+    def read(self, ts):
+        if self.fps > 0:
+            ahead = int(round(ts * self.fps / 1000.0)) - int(self.vidcap.get(cv2.CAP_PROP_POS_FRAMES))
+            if 0 <= ahead <= self.maxSkip:
+                for _ in range(ahead):
+                    self.vidcap.grab()
+                return self.vidcap.read()
+        self.vidcap.set(cv2.CAP_PROP_POS_MSEC,ts)
+        return self.vidcap.read()
 
 
+def crops(image, pixels, margin=overlay.BAND_HEIGHT):
+    """Regions around each box, including its label band."""
+    height, width = image.shape[:2]
+    for x0, y0, x1, y1 in pixels.tolist():
+        yield image[max(0, y0 - margin):min(height, y1 + margin), max(0, x0 - margin):min(width, x1 + margin)]
 
+
+def extract_frames(vidcap, data, out_dir="frames/russell", inventory=None, start=None, end=None,
+                   sink=None, scale=1.0, crop=False):
+    """
+    Write one annotated image per timestamp, with every detection at that
+    timestamp drawn on it; start/end (milliseconds, inclusive) restrict the
+    frames to a window. data may also be a ResultIndex.
+
+    Images go to sink (a frame_store sink, default: JPEG files in out_dir)
+    keyed by timestamp. scale downsizes them; with crop, only the region
+    around each box is kept, keyed "<TS>-<n>". Returns the number of images
+    written.
+    """
+    index = data if isinstance(data, ResultIndex) else ResultIndex(data)
+    lo, hi = index.window(start, end)
+    data = index.data
+    ts = index.ts[lo:hi]
+    order = index.offsets[lo:hi]
+    own = sink is None
+    if own:
+        sink = frame_store.FrameFiles(out_dir)
+    seeker = FrameSeeker(vidcap)
+    pixels = None
+    written = 0
+    for t, first, stop in overlay.frame_groups(ts):
+        hasFrames,image = seeker.read(t)
+
+        if hasFrames:
+            if pixels is None:
+                # all frames of a video share one size: convert every box at once
+                pixels = overlay.boxes_to_pixels(index.boxes[lo:hi], image.shape[1], image.shape[0])
+            rows = [data[int(i)] for i in order[first:stop]]
+            overlay.render(image, pixels[first:stop],
+                           labels=[detection_info(d, inventory) for d in rows],
+                           colors=[PERSON_COLOR if 'personInfo' in d else MATCH_COLOR for d in rows])
+
+            images = list(crops(image, pixels[first:stop])) if crop else [image]
+            for n, image in enumerate(images):
+                if scale != 1.0:
+                    image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                sink.add('%d-%d' % (t, n) if crop else str(t), image)
+                written += 1
+    if own:
+        sink.close()
+    return written
+
+
+def extract_video(vidcap, data, out_path, inventory=None, start=None, end=None, hold=1000, encoder='opencv'):
+    """
+    Write one annotated video covering start..end (milliseconds, default
+    the whole video) in a single sequential decode. The boxes of a detection
+    timestamp stay on screen until the next one, for at most hold ms.
+    encoder is 'opencv' (cv2.VideoWriter) or 'ffmpeg' (piped to ffmpeg).
+    Returns the number of frames written.
+    """
+    index = data if isinstance(data, ResultIndex) else ResultIndex(data)
+    data = index.data
+    fps = vidcap.get(cv2.CAP_PROP_FPS) or 25.0
+    if start:
+        vidcap.set(cv2.CAP_PROP_POS_MSEC,start)
+    frameNo = int(vidcap.get(cv2.CAP_PROP_POS_FRAMES))
+    groups = list(overlay.frame_groups(index.ts))
+    g = -1
+    video = None
+    pixels = None
+    labels = colors = None
+    try:
+        while True:
+            t = frameNo * 1000.0 / fps
+            if end is not None and t > end:
+                break
+            hasFrames,image = vidcap.read()
+            if not hasFrames:
+                break
+            frameNo += 1
+            if video is None:
+                video = frame_store.open_video(encoder, out_path, fps, (image.shape[1], image.shape[0]))
+                pixels = overlay.boxes_to_pixels(index.boxes, image.shape[1], image.shape[0])
+
+            while g + 1 < len(groups) and groups[g + 1][0] <= t:
+                g += 1
+                labels = None
+            if g >= 0 and t - groups[g][0] <= hold:
+                _, first, stop = groups[g]
+                if labels is None:
+                    rows = [data[int(i)] for i in index.offsets[first:stop]]
+                    labels = [detection_info(d, inventory) for d in rows]
+                    colors = [PERSON_COLOR if 'personInfo' in d else MATCH_COLOR for d in rows]
+                overlay.render(image, pixels[first:stop], labels=labels, colors=colors)
+            video.write(image)
+    finally:
+        written = video.close() if video is not None else 0
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write annotated frames for face search results.')
+    parser.add_argument('video')
+    parser.add_argument('results')
+    parser.add_argument('--out', default="frames/russell", help='output directory, or file for --mode archive')
+    parser.add_argument('--mode', default='frames', choices=['frames', 'sheet', 'archive', 'video'],
+                        help='one JPEG per frame, tiled contact sheets, a single indexed archive, '
+                             'or one annotated video written to --out')
+    parser.add_argument('--crop', action='store_true', help='keep only the region around each box')
+    parser.add_argument('--scale', type=float, default=1.0, help='downscale factor for written images')
+    parser.add_argument('--quality', type=int, default=None, help='JPEG quality')
+    parser.add_argument('--hold', type=int, default=1000, help='video mode: ms to keep boxes on screen')
+    parser.add_argument('--encoder', default='opencv', choices=['opencv', 'ffmpeg'], help='video mode encoder')
+    parser.add_argument('--collection', default='russell', help='collection the faces were matched against')
+    parser.add_argument('--inventory', help='face inventory file (default: faces-<collection>.json)')
+    parser.add_argument('--start', help='first timestamp to render, [[hh:]mm:]ss[.fff]')
+    parser.add_argument('--end', help='last timestamp to render, [[hh:]mm:]ss[.fff]')
+    args = parser.parse_args()
+    vidcap = cv2.VideoCapture(args.video)
+    data = load_results(args.results)
+    inventory = load_inventory(args.collection, args.inventory)
+    if args.mode == 'video':
+        extract_video(vidcap, data, args.out, inventory, parse_time(args.start), parse_time(args.end),
+                      args.hold, args.encoder)
+    else:
+        sink = frame_store.open_sink(args.mode, args.out, args.quality)
+        extract_frames(vidcap, data, args.out, inventory,
+                       parse_time(args.start), parse_time(args.end), sink, args.scale, args.crop)
+        sink.close()
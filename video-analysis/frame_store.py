@@ -0,0 +1,205 @@
+# Where extract.py puts annotated images.
+#
+#   FrameFiles    one JPEG per key in a directory (the original layout)
+#   ContactSheet  tiles images into sheet-NNNNN.jpg grids plus sheet.json,
+#                 which maps every key to its sheet and tile rectangle
+#   FrameArchive  a single file of JPEGs back to back with an offset table
+#                 at the end; read it back with open_archive()
+#   VideoFile / FFmpegPipe
+#                 one annotated video, encoded as frames arrive
+#
+# Keys are the detection timestamp ("1376"), or "<TS>-<n>" for the n-th crop
+# of a frame, so everything stays addressable by TS.
+
+import json
+import os
+import struct
+import subprocess
+
+import cv2
+import numpy as np
+
+ARCHIVE_MAGIC = b'RKFA0001'
+FOOTER = struct.Struct('<Q8s')
+
+
+def encode(image, quality):
+    ok, data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError('Could not encode image')
+    return data.tobytes()
+
+
+def fit(image, width, height):
+    """Downscale image to fit width x height, keeping its aspect ratio."""
+    scale = min(float(width) / image.shape[1], float(height) / image.shape[0], 1.0)
+    if scale >= 1.0:
+        return image
+    size = (max(1, int(image.shape[1] * scale)), max(1, int(image.shape[0] * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+class FrameFiles(object):
+    def __init__(self, out_dir, quality=95):
+        self.out_dir = out_dir
+        self.quality = quality
+        self.count = 0
+
+    def add(self, key, image):
+        cv2.imwrite(os.path.join(self.out_dir, key + '.jpg'), image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        self.count += 1
+
+    def close(self):
+        return self.count
+
+
+class ContactSheet(object):
+    def __init__(self, out_dir, tile=(320, 180), columns=8, rows=8, quality=85, prefix='sheet'):
+        self.out_dir = out_dir
+        self.tileWidth, self.tileHeight = tile
+        self.columns = columns
+        self.rows = rows
+        self.quality = quality
+        self.prefix = prefix
+        self.index = {}
+        self.sheets = 0
+        self.sheet = None
+        self.used = 0
+        self.count = 0
+
+    def _flush(self):
+        if self.sheet is not None:
+            name = '%s-%05d.jpg' % (self.prefix, self.sheets)
+            with open(os.path.join(self.out_dir, name), 'wb') as f:
+                f.write(encode(self.sheet, self.quality))
+            self.sheets += 1
+            self.sheet = None
+            self.used = 0
+
+    def add(self, key, image):
+        if self.sheet is None:
+            self.sheet = np.zeros((self.rows * self.tileHeight, self.columns * self.tileWidth, 3), np.uint8)
+        image = fit(image, self.tileWidth, self.tileHeight)
+        row, column = divmod(self.used, self.columns)
+        x, y = column * self.tileWidth, row * self.tileHeight
+        self.sheet[y:y + image.shape[0], x:x + image.shape[1]] = image
+        self.index[key] = {'Sheet': '%s-%05d.jpg' % (self.prefix, self.sheets),
+                           'X': x, 'Y': y, 'Width': image.shape[1], 'Height': image.shape[0]}
+        self.used += 1
+        self.count += 1
+        if self.used == self.columns * self.rows:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        with open(os.path.join(self.out_dir, self.prefix + '.json'), 'w') as f:
+            json.dump(self.index, f, sort_keys=True)
+        return self.count
+
+
+class FrameArchive(object):
+    def __init__(self, path, quality=90):
+        self.path = path
+        self.quality = quality
+        self.table = {}
+        self.f = open(path, 'wb')
+        self.f.write(ARCHIVE_MAGIC)
+
+    def add(self, key, image):
+        data = encode(image, self.quality)
+        self.table[key] = [self.f.tell(), len(data)]
+        self.f.write(data)
+
+    def close(self):
+        offset = self.f.tell()
+        self.f.write(json.dumps(self.table, sort_keys=True).encode('utf-8'))
+        self.f.write(FOOTER.pack(offset, ARCHIVE_MAGIC))
+        self.f.close()
+        return len(self.table)
+
+
+class ArchiveReader(object):
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        self.f.seek(-FOOTER.size, os.SEEK_END)
+        end = self.f.tell()
+        offset, magic = FOOTER.unpack(self.f.read(FOOTER.size))
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError('%s is not a frame archive' % path)
+        self.f.seek(offset)
+        self.table = json.loads(self.f.read(end - offset).decode('utf-8'))
+
+    def keys(self):
+        return sorted(self.table, key=lambda key: [int(part) for part in key.split('-')])
+
+    def read(self, key):
+        """JPEG bytes stored under key."""
+        offset, length = self.table[key]
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def image(self, key):
+        return cv2.imdecode(np.frombuffer(self.read(key), np.uint8), cv2.IMREAD_COLOR)
+
+    def close(self):
+        self.f.close()
+
+
+def open_archive(path):
+    return ArchiveReader(path)
+
+
+class VideoFile(object):
+    """Encodes frames with cv2.VideoWriter."""
+
+    def __init__(self, path, fps, size, fourcc='mp4v'):
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+        if not self.writer.isOpened():
+            raise IOError('Could not open %s for writing' % path)
+        self.count = 0
+
+    def write(self, image):
+        self.writer.write(image)
+        self.count += 1
+
+    def close(self):
+        self.writer.release()
+        return self.count
+
+
+class FFmpegPipe(object):
+    """Streams raw frames to an ffmpeg process over its stdin."""
+
+    def __init__(self, path, fps, size, codec='libx264', ffmpeg='ffmpeg'):
+        command = [ffmpeg, '-loglevel', 'error', '-y', '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                   '-s', '%dx%d' % size, '-r', str(fps), '-i', '-',
+                   '-c:v', codec, '-pix_fmt', 'yuv420p', path]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.count = 0
+
+    def write(self, image):
+        self.process.stdin.write(image.tobytes())
+        self.count += 1
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise IOError('ffmpeg exited with status %d' % self.process.returncode)
+        return self.count
+
+
+def open_video(encoder, path, fps, size):
+    if encoder == 'ffmpeg':
+        return FFmpegPipe(path, fps, size)
+    return VideoFile(path, fps, size)
+
+
+def open_sink(mode, out, quality=None):
+    """Sink for extract.py's --mode: 'frames' or 'sheet' write into directory out, 'archive' to file out."""
+    if mode == 'frames':
+        return FrameFiles(out, quality or 95)
+    if mode == 'sheet':
+        return ContactSheet(out, quality=quality or 85)
+    if mode == 'archive':
+        return FrameArchive(out, quality or 90)
+    raise ValueError('Unknown output mode %r' % mode)
@@ -0,0 +1,145 @@
+# Label detection results as a columnar timeline plus merged intervals.
+#
+# LabelTimeline consumes get_label_detection pages (sorted by timestamp) and
+# writes JSON lines as it goes:
+#
+#   {"Schema": "label-timeline/1", "VideoMetadata": {...}, "Gap": ms}   header
+#   {"Names": [...], "TS": [...], "Label": [...], "Confidence": [...]}
+#                 a chunk of label hits; Label indexes the label names in
+#                 order of first appearance, Names lists those new in the chunk
+#   {"Intervals": {"Label": [...], "Start": [...], "End": [...],
+#                  "Count": [...], "MaxConfidence": [...]}}
+#                 closed occurrence intervals: hits of one label no more than
+#                 gap ms apart are merged while the pages stream in
+#
+# Only the current chunk and one open interval per label are kept in memory,
+# so jobs with millions of label hits are fine. A timeline written to a path
+# only appears there once close() has run; abort() drops it instead, and on a
+# file object passed in marks it with an {"Incomplete": true} line that
+# read_timeline() refuses. read_timeline() loads a file back as NumPy columns.
+
+import json
+import os
+
+import numpy as np
+
+SCHEMA = 'label-timeline/1'
+
+
+class LabelTimeline(object):
+    def __init__(self, out, gap=1000, chunk=10000):
+        self.path = out if isinstance(out, str) else None
+        self.f = open(self.path + '.tmp', 'w') if self.path else out
+        self.gap = gap
+        self.chunk = chunk
+        self.names = {}
+        self.newNames = []
+        self.hits = {'TS': [], 'Label': [], 'Confidence': []}
+        self.open = {}          # label id -> [start, end, count, max confidence]
+        self.closed = {'Label': [], 'Start': [], 'End': [], 'Count': [], 'MaxConfidence': []}
+        self.started = False
+        self.counts = {'hits': 0, 'intervals': 0, 'pages': 0}
+
+    def _write(self, line):
+        self.f.write(json.dumps(line, separators=(',', ':')) + '\n')
+
+    def _flush_hits(self):
+        if self.hits['TS']:
+            self._write(dict(self.hits, Names=self.newNames))
+            self.newNames = []
+            self.hits = {'TS': [], 'Label': [], 'Confidence': []}
+
+    def _flush_intervals(self):
+        if self.closed['Label']:
+            self._write({'Intervals': self.closed})
+            self.closed = {'Label': [], 'Start': [], 'End': [], 'Count': [], 'MaxConfidence': []}
+
+    def _close_interval(self, label, interval):
+        start, end, count, confidence = interval
+        closed = self.closed
+        closed['Label'].append(label)
+        closed['Start'].append(start)
+        closed['End'].append(end)
+        closed['Count'].append(count)
+        closed['MaxConfidence'].append(confidence)
+        self.counts['intervals'] += 1
+        if len(closed['Label']) >= self.chunk:
+            self._flush_intervals()
+
+    def add(self, ts, name, confidence):
+        label = self.names.get(name)
+        if label is None:
+            label = self.names[name] = len(self.names)
+            self.newNames.append(name)
+        self.hits['TS'].append(ts)
+        self.hits['Label'].append(label)
+        self.hits['Confidence'].append(confidence)
+        self.counts['hits'] += 1
+        if len(self.hits['TS']) >= self.chunk:
+            self._flush_hits()
+
+        interval = self.open.get(label)
+        if interval is not None and ts - interval[1] <= self.gap:
+            interval[1] = ts
+            interval[2] += 1
+            interval[3] = max(interval[3], confidence)
+            return
+        if interval is not None:
+            self._close_interval(label, interval)
+        self.open[label] = [ts, ts, 1, confidence]
+
+    def add_response(self, response):
+        if not self.started:
+            self._write({'Schema': SCHEMA, 'VideoMetadata': response.get('VideoMetadata'), 'Gap': self.gap})
+            self.started = True
+        self.counts['pages'] += 1
+        for labelDetection in response['Labels']:
+            self.add(labelDetection['Timestamp'], labelDetection['Label']['Name'],
+                     labelDetection['Label']['Confidence'])
+
+    def close(self):
+        """Flush everything and move the file into place; returns the hit, interval and page counts."""
+        self._flush_hits()
+        for label, interval in sorted(self.open.items(), key=lambda item: item[1][0]):
+            self._close_interval(label, interval)
+        self.open = {}
+        self._flush_intervals()
+        if self.path:
+            self.f.close()
+            os.rename(self.path + '.tmp', self.path)
+        return self.counts
+
+    def abort(self):
+        """Give up on a timeline that cannot be completed."""
+        if self.path:
+            self.f.close()
+            os.remove(self.path + '.tmp')
+        else:
+            self._write({'Incomplete': True})
+
+
+def read_timeline(path):
+    """(header, hits, intervals, names): hits and intervals are dicts of NumPy columns."""
+    header = None
+    names = []
+    hits = {'TS': [], 'Label': [], 'Confidence': []}
+    intervals = {'Label': [], 'Start': [], 'End': [], 'Count': [], 'MaxConfidence': []}
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if 'Schema' in entry:
+                if entry['Schema'] != SCHEMA:
+                    raise ValueError('Unsupported timeline schema %r' % entry['Schema'])
+                header = entry
+            elif 'Incomplete' in entry:
+                raise ValueError('Incomplete timeline %s' % path)
+            elif 'Intervals' in entry:
+                for k in intervals:
+                    intervals[k].extend(entry['Intervals'][k])
+            else:
+                names.extend(entry['Names'])
+                for k in hits:
+                    hits[k].extend(entry[k])
+    hits = dict((k, np.asarray(v)) for k, v in hits.items())
+    intervals = dict((k, np.asarray(v)) for k, v in intervals.items())
+    return header, hits, intervals, names
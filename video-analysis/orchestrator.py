@@ -0,0 +1,237 @@
+# Drive many Rekognition video jobs that report completion through one
+# SNS topic / SQS queue.
+#
+# Jobs are started up to a concurrency limit, the queue is long-polled in
+# batches and every notification is routed to the job that owns it.
+# Notifications for jobs this orchestrator did not start are handed back to
+# the queue untouched so that whoever owns them can still pick them up.
+# Result pages for finished jobs are fetched on a thread pool while the
+# polling loop keeps going; while fetches are outstanding the queue is
+# polled for at most fetchWaitSeconds so that they are reported promptly. A job that fails to start is marked
+# SUBMIT_FAILED and the others carry on; a job whose notification does not
+# arrive (lost message, wrong queue policy) has its status read directly
+# after a number of silent receives, and can be given a deadline.
+
+import collections
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class Job(object):
+    __slots__ = ('bucket', 'video', 'jobId', 'status', 'results', 'error',
+                 'submitted', 'completed', 'fetched')
+
+    def __init__(self, bucket, video):
+        self.bucket = bucket
+        self.video = video
+        self.jobId = None
+        self.status = 'PENDING'
+        self.results = None
+        self.error = None
+        self.submitted = None
+        self.completed = None
+        self.fetched = None
+
+    def __repr__(self):
+        return 'Job(s3://%s/%s, %s, %s)' % (self.bucket, self.video, self.jobId, self.status)
+
+
+def parse_notification(message):
+    """Return the Rekognition completion message wrapped in an SQS/SNS message, or None."""
+    try:
+        notification = json.loads(message['Body'])
+        return json.loads(notification['Message'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class JobOrchestrator(object):
+    """
+    rek / sqs are boto3 style clients (or local stand-ins exposing the same
+    calls). fetch_results(jobId) returns the results of a finished job; it is
+    called from worker threads. check_job(job) returns the JobStatus of a
+    job that has been silent for silentReceives receives; jobTimeout, in
+    seconds since submission, fails jobs that never finish.
+    fetchWaitSeconds caps the long poll while result fetches are running.
+    """
+
+    def __init__(self, rek, sqs, queueUrl, roleArn, topicArn, collectionId,
+                 fetch_results, maxJobs=20, fetchWorkers=4, waitSeconds=20,
+                 releaseVisibility=10, start_job=None, on_change=None,
+                 check_job=None, silentReceives=15, jobTimeout=None, fetchWaitSeconds=1):
+        self.rek = rek
+        self.sqs = sqs
+        self.queueUrl = queueUrl
+        self.roleArn = roleArn
+        self.topicArn = topicArn
+        self.collectionId = collectionId
+        self.fetch_results = fetch_results
+        self.maxJobs = maxJobs
+        self.fetchWorkers = fetchWorkers
+        self.waitSeconds = waitSeconds
+        self.fetchWaitSeconds = fetchWaitSeconds
+        # Seconds a foreign notification stays hidden once handed back. Zero
+        # would make our own long poll receive it again straight away.
+        self.releaseVisibility = releaseVisibility
+        self.start_job = start_job or self.start_face_search
+        self.on_change = on_change
+        self.check_job = check_job or self.face_search_status
+        self.silentReceives = silentReceives
+        self.jobTimeout = jobTimeout
+        self.jobs = {}
+        self.silent = {}
+        self.stats = collections.Counter()
+
+    def start_face_search(self, job):
+        response = self.rek.start_face_search(
+            Video={'S3Object': {'Bucket': job.bucket, 'Name': job.video}},
+            CollectionId=self.collectionId,
+            NotificationChannel={'RoleArn': self.roleArn, 'SNSTopicArn': self.topicArn})
+        return response['JobId']
+
+    def face_search_status(self, job):
+        return self.rek.get_face_search(JobId=job.jobId, MaxResults=1)['JobStatus']
+
+    def _changed(self, job):
+        if self.on_change:
+            self.on_change(job)
+
+    def _submit(self, job):
+        job.jobId = self.start_job(job)
+        job.status = 'IN_PROGRESS'
+        job.submitted = time.time()
+        self.jobs[job.jobId] = job
+        self.stats['started'] += 1
+        self._changed(job)
+
+    def attach(self, job):
+        """Track a job that was started earlier (e.g. by a previous run) without resubmitting it."""
+        job.status = 'IN_PROGRESS'
+        job.submitted = job.submitted or time.time()
+        self.jobs[job.jobId] = job
+        self.stats['attached'] += 1
+        return job
+
+    def poll(self, active, waitSeconds=None):
+        """One long poll of the queue; returns the jobs whose completion arrived."""
+        if waitSeconds is None:
+            waitSeconds = self.waitSeconds
+        response = self.sqs.receive_message(QueueUrl=self.queueUrl,
+                                            MessageAttributeNames=['ALL'],
+                                            MaxNumberOfMessages=10,
+                                            WaitTimeSeconds=waitSeconds)
+        self.stats['receives'] += 1
+        messages = response.get('Messages', [])
+        if not messages:
+            self.stats['empty_receives'] += 1
+        completed = []
+        for message in messages:
+            rekMessage = parse_notification(message)
+            jobId = rekMessage and str(rekMessage.get('JobId'))
+            if jobId not in self.jobs:
+                # Not ours: make it visible again for its owner
+                self.sqs.change_message_visibility(QueueUrl=self.queueUrl,
+                                                   ReceiptHandle=message['ReceiptHandle'],
+                                                   VisibilityTimeout=self.releaseVisibility)
+                self.stats['foreign'] += 1
+                continue
+            self.sqs.delete_message(QueueUrl=self.queueUrl,
+                                    ReceiptHandle=message['ReceiptHandle'])
+            job = active.pop(jobId, None)
+            if job is None:
+                # Duplicate delivery of a notification we already handled
+                self.stats['duplicates'] += 1
+                continue
+            job.status = rekMessage.get('Status', 'UNKNOWN')
+            job.completed = time.time()
+            self.stats['notifications'] += 1
+            completed.append(job)
+        completed.extend(self._check_silent(active))
+        return completed
+
+    def _check_silent(self, active):
+        """Jobs among active found finished or out of time without a notification."""
+        completed = []
+        now = time.time()
+        for jobId, job in list(active.items()):
+            if self.jobTimeout and now - job.submitted > self.jobTimeout:
+                job.status = 'TIMED_OUT'
+                job.error = 'No completion after %g seconds' % self.jobTimeout
+                self.stats['timed_out'] += 1
+            else:
+                self.silent[jobId] = self.silent.get(jobId, 0) + 1
+                if self.silent[jobId] < self.silentReceives:
+                    continue
+                self.silent[jobId] = 0
+                try:
+                    status = self.check_job(job)
+                except Exception:
+                    self.stats['check_errors'] += 1
+                    continue
+                self.stats['checked'] += 1
+                if status == 'IN_PROGRESS':
+                    continue
+                job.status = status
+                self.stats['found_by_check'] += 1
+            del active[jobId]
+            self.silent.pop(jobId, None)
+            job.completed = now
+            completed.append(job)
+        return completed
+
+    def _collect(self, fetching, block=False):
+        """Record the fetches that are done; with block, wait for at least one first."""
+        if block:
+            wait(fetching, return_when=FIRST_COMPLETED)
+        for future in [f for f in fetching if f.done()]:
+            job = fetching.pop(future)
+            try:
+                job.results = future.result()
+                job.status = 'FETCHED'
+                self.stats['fetched'] += 1
+            except Exception as e:
+                job.error = str(e)
+                job.status = 'FETCH_FAILED'
+            job.fetched = time.time()
+            self._changed(job)
+
+    def run(self, videos, attached=()):
+        """
+        videos: iterable of (bucket, key) pairs to analyse.
+        attached: Job objects with a jobId already started elsewhere.
+        Returns the list of Job objects in submission order.
+        """
+        pending = collections.deque(Job(bucket, video) for bucket, video in videos)
+        ordered = list(attached) + list(pending)
+        active = {}
+        for job in attached:
+            active[job.jobId] = self.attach(job)
+
+        fetching = {}
+        with ThreadPoolExecutor(max_workers=self.fetchWorkers) as pool:
+            while pending or active or fetching:
+                while pending and len(active) < self.maxJobs:
+                    job = pending.popleft()
+                    try:
+                        self._submit(job)
+                    except Exception as e:
+                        # LimitExceeded, missing video, throttling...: the rest goes on
+                        job.status = 'SUBMIT_FAILED'
+                        job.error = str(e)
+                        self.stats['submit_failed'] += 1
+                        self._changed(job)
+                        continue
+                    active[job.jobId] = job
+
+                # Nothing left to poll for: just wait for the fetches
+                self._collect(fetching, block=not active)
+                if active:
+                    waitSeconds = min(self.waitSeconds, self.fetchWaitSeconds) if fetching else self.waitSeconds
+                    for job in self.poll(active, waitSeconds):
+                        if job.status == 'SUCCEEDED':
+                            fetching[pool.submit(self.fetch_results, job.jobId)] = job
+                        elif not job.error:
+                            job.error = 'Job finished with status %s' % job.status
+                        self._changed(job)
+        return ordered
@@ -0,0 +1,106 @@
+# Batch drawing of detection boxes onto frames.
+#
+# boxes_to_pixels() converts any number of normalised boxes (one frame or a
+# whole chunk of frames) in one NumPy expression. render() paints the box
+# outlines and the label bands behind their captions as a handful of masks:
+# every rectangle only touches the four corners of a difference array and
+# two cumulative sums turn it into coverage, so a frame with dozens of
+# matches costs about the same as a frame with one.
+
+import cv2
+import numpy as np
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.5
+BAND_HEIGHT = 18
+
+
+def boxes_to_pixels(boxes, width, height):
+    """
+    (N, 4) Left, Top, Width, Height in [0, 1] -> (N, 4) int x0, y0, x1, y1
+    in pixels, clipped to the frame; x1/y1 are exclusive.
+    """
+    boxes = np.asarray(boxes, float).reshape(-1, 4)
+    scale = np.array([width, height, width, height], float)
+    corners = np.empty_like(boxes)
+    corners[:, :2] = boxes[:, :2]
+    corners[:, 2:] = boxes[:, :2] + boxes[:, 2:]
+    pixels = (corners * scale).astype(np.int64)
+    np.clip(pixels, 0, scale.astype(np.int64), out=pixels)
+    return pixels
+
+
+def coverage(shape, add, remove=None):
+    """
+    Number of rectangles in add (minus those in remove) covering each pixel.
+    Rectangles are x0, y0, x1, y1 rows with exclusive x1/y1.
+    """
+    height, width = shape[:2]
+    diff = np.zeros((height + 1, width + 1), np.int32)
+    for rects, sign in ((add, 1), (remove, -1)):
+        if rects is None or not len(rects):
+            continue
+        x0, y0, x1, y1 = np.asarray(rects).T
+        np.add.at(diff, (y0, x0), sign)
+        np.add.at(diff, (y0, x1), -sign)
+        np.add.at(diff, (y1, x0), -sign)
+        np.add.at(diff, (y1, x1), sign)
+    return diff.cumsum(0).cumsum(1)[:height, :width]
+
+
+def outline_mask(shape, pixels, thickness=3):
+    """Pixels on the outline of any box; overlapping boxes keep their own outlines."""
+    pixels = pixels[(pixels[:, 2] > pixels[:, 0]) & (pixels[:, 3] > pixels[:, 1])]
+    inner = pixels + np.array([thickness, thickness, -thickness, -thickness])
+    inner = inner[(inner[:, 2] > inner[:, 0]) & (inner[:, 3] > inner[:, 1])]
+    return coverage(shape, pixels, inner) > 0
+
+
+def label_bands(shape, pixels, bandHeight=BAND_HEIGHT):
+    """Band above each box (inside it when the box touches the top edge)."""
+    top = pixels[:, 1] - bandHeight
+    top = np.where(top < 0, pixels[:, 1], top)
+    bands = np.stack([pixels[:, 0], top, pixels[:, 2], np.minimum(top + bandHeight, shape[0])], axis=1)
+    return bands
+
+
+def render(image, pixels, labels=None, colors=None, thickness=3):
+    """
+    Draw boxes given as pixel rows of boxes_to_pixels() into image, in place.
+    colors is one BGR tuple per box (default green); labels, if given, are
+    written in white on a band of the box colour.
+    """
+    if not len(pixels):
+        return image
+    if colors is None:
+        colors = [(0, 255, 0)] * len(pixels)
+    colors = np.asarray(colors, np.uint8).reshape(-1, 3)
+    bands = label_bands(image.shape, pixels) if labels is not None else None
+    # only the area the boxes span is painted
+    extent = pixels if bands is None else np.concatenate([pixels, bands])
+    x0, y0 = extent[:, :2].min(axis=0)
+    x1, y1 = extent[:, 2:].max(axis=0)
+    area = image[y0:y1, x0:x1]
+    shift = np.array([x0, y0, x0, y0])
+    for color in np.unique(colors, axis=0):
+        selected = (colors == color).all(axis=1)
+        area[outline_mask(area.shape, pixels[selected] - shift, thickness)] = color
+        if bands is not None:
+            area[coverage(area.shape, bands[selected] - shift) > 0] = color
+    if labels is not None:
+        for (x0, y0, x1, y1), label in zip(bands, labels):
+            if label and y1 > y0:
+                cv2.putText(image, label, (int(x0) + 2, int(y1) - 4), FONT, FONT_SCALE,
+                            (255, 255, 255), 1, cv2.LINE_AA)
+    return image
+
+
+def frame_groups(ts):
+    """(ts, start, stop) for each run of equal timestamps in a sorted ts array."""
+    if not len(ts):
+        return
+    edges = np.flatnonzero(np.diff(ts)) + 1
+    starts = np.concatenate([[0], edges])
+    stops = np.concatenate([edges, [len(ts)]])
+    for start, stop in zip(starts, stops):
+        yield int(ts[start]), int(start), int(stop)
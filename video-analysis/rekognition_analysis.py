@@ -5,127 +5,171 @@
 
 # todo make this write pretty json file
 import boto3
+import functools
 import json
+import os
 import sys
 
+from compact_results import CompactBuilder
+from label_timeline import LabelTimeline
+from orchestrator import Job, JobOrchestrator
+from result_cache import cache_key
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'collection'))
+
 
 class VideoDetect:
     jobId = ''
-    rek = boto3.client('rekognition',region_name='eu-west-1')
 
     queueUrl = 'https://sqs.eu-west-1.amazonaws.com/382386535927/Rekognition'
     roleArn = 'arn:aws:iam::382386535927:role/ServiceToGiveRekognitionAccessToSNS'
     topicArn = 'arn:aws:sns:eu-west-1:382386535927:AmazonRekognitionRussel'
     bucket = 'verge.rekognition'
     video = 'russel/russell.mp4'
+    collectionId = 'russell'
 
-    def main(self):
+    def __init__(self, rek=None, sqs=None, s3=None, cache=None, inventoryPath=None):
+        # cache: a result_cache.ResultCache to reuse face searches, None for none
+        # inventoryPath: file keeping the collection inventory between runs
+        self.rek = rek or boto3.client('rekognition',region_name='eu-west-1')
+        self.sqs = sqs or boto3.client('sqs')
+        self.s3 = s3
+        self.cache = cache
+        self.inventoryPath = inventoryPath
 
-        jobFound = False
-        sqs = boto3.client('sqs')
-       
-
-        #=====================================
-        response = self.rek.start_face_search(Video={'S3Object':{'Bucket':self.bucket,'Name':self.video}},
-            CollectionId='russell',
-            NotificationChannel={'RoleArn':self.roleArn, 'SNSTopicArn':self.topicArn})
-        #=====================================
-        print('Start Job Id: ' + response['JobId'])
-        dotLine=0
-        while jobFound == False:
-            sqsResponse = sqs.receive_message(QueueUrl=self.queueUrl, MessageAttributeNames=['ALL'],
-                                          MaxNumberOfMessages=10)
-
-            if sqsResponse:
-                if 'Messages' not in sqsResponse:
-                    if dotLine<20:
-                        
-                        dotLine=dotLine+1
-                    else:
-                       
-                        dotLine=0    
-                    sys.stdout.flush()
-                    continue
-
-                for message in sqsResponse['Messages']:
-                    notification = json.loads(message['Body'])
-                    rekMessage = json.loads(notification['Message'])
-                    print(rekMessage['JobId'])
-                    print(rekMessage['Status'])
-                    if str(rekMessage['JobId']) == response['JobId']:
-                        print('Matching Job Found:' + rekMessage['JobId'])
-                        jobFound = True
-                        #=============================================
-                        self.GetResultsFaceSearchCollection(rekMessage['JobId'])
-                        #=============================================
-
-                        sqs.delete_message(QueueUrl=self.queueUrl,
-                                       ReceiptHandle=message['ReceiptHandle'])
-                    else:
-                        print("Job didn't match:" +
-                              str(rekMessage['JobId']) + ' : ' + str(response['JobId']))
-                    # Delete the unknown message. Consider sending to dead letter queue
-                    sqs.delete_message(QueueUrl=self.queueUrl,
-                                   ReceiptHandle=message['ReceiptHandle'])
+    def main(self):
+        for job in self.SearchFaces([(self.bucket, self.video)]):
+            print('Job ' + str(job.jobId) + ': ' + job.status)
+            if job.error:
+                print(job.error)
+            else:
+                print(json.dumps(job.results, sort_keys=True))
 
         print('done')
 
-    def GetResultsFaceSearchCollection(self, jobId):
+    def CollectionVersion(self):
+        from face_inventory import FaceInventory
+        if self.inventoryPath:
+            inventory = FaceInventory.load(self.collectionId, self.inventoryPath)
+        else:
+            inventory = FaceInventory(self.collectionId)
+        inventory.refresh(self.rek)
+        if self.inventoryPath:
+            inventory.save()
+        return inventory.version()
+
+    def ObjectEtag(self, bucket, key):
+        # the s3cmd client when one was given or ~/.s3cfg exists, boto3 otherwise
+        if self.s3 is None:
+            if os.path.exists(os.path.expanduser('~/.s3cfg')):
+                from s3util import get_s3
+                self.s3 = get_s3()
+            else:
+                self.s3 = boto3.client('s3')
+        if hasattr(self.s3, 'head_object'):
+            return self.s3.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+        from s3util import object_etag
+        return object_etag(self.s3, bucket, key)
+
+    def SearchFaces(self, videos, orchestrator=None, attached=()):
+        """
+        Face search for (bucket, key) pairs, in compact form. With a result
+        cache, videos whose ETag was already searched against the current
+        collection come from it as CACHED jobs and the rest are cached once
+        run. attached are Job objects started earlier, waited for without
+        resubmitting; they come first in the returned list. Results are
+        cached as each job is fetched, before the orchestrator's on_change
+        sees the job (which may release them).
+        """
+        videos = list(videos)
+        jobs = []
+        keys = {}
+        if self.cache is not None:
+            version = self.CollectionVersion()
+            for bucket, video in videos + [(job.bucket, job.video) for job in attached]:
+                keys[(bucket, video)] = cache_key(self.ObjectEtag(bucket, video), self.collectionId,
+                                                  version, 'FaceSearch')
+        for bucket, video in videos:
+            job = Job(bucket, video)
+            if self.cache is not None:
+                job.results = self.cache.get(keys[(bucket, video)])
+            if job.results is not None:
+                job.status = 'CACHED'
+            jobs.append(job)
+
+        if orchestrator is None:
+            orchestrator = JobOrchestrator(self.rek, self.sqs, self.queueUrl, self.roleArn, self.topicArn,
+                                           self.collectionId,
+                                           functools.partial(self.GetResultsFaceSearchCollection, compact=True))
+        if self.cache is not None:
+            orchestrator.on_change = functools.partial(self._cache_fetched, keys, orchestrator.on_change)
+        ran = orchestrator.run([(job.bucket, job.video) for job in jobs if job.status != 'CACHED'], attached)
+        started = iter(ran[len(attached):])
+        return ran[:len(attached)] + [job if job.status == 'CACHED' else next(started) for job in jobs]
+
+    def _cache_fetched(self, keys, on_change, job):
+        if job.status == 'FETCHED':
+            self.cache.put(keys[(job.bucket, job.video)], job.results)
+        if on_change:
+            on_change(job)
+
+    def GetResultsFaceSearchCollection(self, jobId, compact=False):
+        # compact=True returns the normalised schema of compact_results.py
         maxResults = 10
         paginationToken = ''
 
         finished = False
         results=list()
+        builder = CompactBuilder() if compact else None
         while finished == False:
             response = self.rek.get_face_search(JobId=jobId,
                                         MaxResults=maxResults,
                                         NextToken=paginationToken)
 
-            for personMatch in response['Persons']:
-                if ('Person' in personMatch):
-                    if 'Face' in personMatch['Person']:
-                        results.append({"TS": personMatch['Timestamp'],"boundingBox":personMatch['Person']['Face']['BoundingBox'],"personInfo":personMatch['Person']})
-
-                if ('FaceMatches' in personMatch):
-                    for faceMatch in personMatch['FaceMatches']:
-                        results.append({"TS": personMatch['Timestamp'],"boundingBox":faceMatch['Face']["BoundingBox"],"faceInfo":faceMatch['Face']})
-                        
-            
-            if 'NextToken' in response:
-                paginationToken = response['NextToken']
+            if builder is not None:
+                builder.add_response(response)
             else:
-                finished = True
-        
-        print json.dumps(results, sort_keys=True)  
-             
-    def GetResultsLabels(self, jobId):
-        maxResults = 10
-        paginationToken = ''
-        finished = False
-
-        while finished == False:
-            response = self.rek.get_label_detection(JobId=jobId,
-                                            MaxResults=maxResults,
-                                            NextToken=paginationToken,
-                                            SortBy='TIMESTAMP')
-
-            print(response['VideoMetadata']['Codec'])
-            print(str(response['VideoMetadata']['DurationMillis']))
-            print(response['VideoMetadata']['Format'])
-            print(response['VideoMetadata']['FrameRate'])
+                for personMatch in response['Persons']:
+                    if ('Person' in personMatch):
+                        if 'Face' in personMatch['Person']:
+                            results.append({"TS": personMatch['Timestamp'],"boundingBox":personMatch['Person']['Face']['BoundingBox'],"personInfo":personMatch['Person']})
 
-            for labelDetection in response['Labels']:
-                print(labelDetection['Label']['Name'])
-                print(labelDetection['Label']['Confidence'])
-                print(str(labelDetection['Timestamp']))
+                    if ('FaceMatches' in personMatch):
+                        for faceMatch in personMatch['FaceMatches']:
+                            results.append({"TS": personMatch['Timestamp'],"boundingBox":faceMatch['Face']["BoundingBox"],"faceInfo":faceMatch['Face']})
 
             if 'NextToken' in response:
                 paginationToken = response['NextToken']
             else:
                 finished = True
 
-
-
+        if builder is not None:
+            return builder.to_dict()
+        return results
+             
+    def GetResultsLabels(self, jobId, out='labels.jsonl', gap=1000):
+        # streams the hits into a label_timeline.LabelTimeline file at out
+        maxResults = 1000
+        paginationToken = ''
+        finished = False
+        timeline = LabelTimeline(out, gap)
+
+        try:
+            while finished == False:
+                response = self.rek.get_label_detection(JobId=jobId,
+                                                MaxResults=maxResults,
+                                                NextToken=paginationToken,
+                                                SortBy='TIMESTAMP')
+                timeline.add_response(response)
+
+                if 'NextToken' in response:
+                    paginationToken = response['NextToken']
+                else:
+                    finished = True
+        except BaseException:
+            timeline.abort()
+            raise
+        return timeline.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+# Match existing person detections against faces added to a collection later.
+#
+#   python research.py video.mp4 results.json --collection russell --out updated.json [--since 1540000000]
+#
+# Instead of a new start_face_search over the whole video, the person boxes
+# already in the results are grouped into tracks, the clearest detection of
+# each track is cropped from the video, and the crops are sent to
+# search_faces_by_image concurrently. Only matches against faces indexed
+# after --since (default: the modification time of the results file, per
+# the local face inventory) are kept; they are added to every detection of
+# the track, and the updated results are written in the compact schema.
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import cv2
+import numpy as np
+
+import frame_store
+import overlay
+from compact_results import CompactBuilder, CompactResults, detection_columns, from_data
+from extract import FrameSeeker
+from tracker import Tracker
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'collection'))
+
+
+def representatives(tracks, columns):
+    """(ts, row) of the highest-confidence detection of each track, in time order."""
+    picks = []
+    for track in tracks:
+        best = track.rows[int(np.argmax(np.nan_to_num(columns['Score'][track.rows], nan=-1.0)))]
+        picks.append((int(columns['TS'][best]), int(best), track))
+    return sorted(picks, key=lambda pick: pick[0])
+
+
+class ReSearcher(object):
+    def __init__(self, rek, collectionId, newFaces, workers=8, maxRate=5, threshold=80.0,
+                 maxFaces=10, margin=0.5, quality=90):
+        from index_faces import Throttle
+        self.rek = rek
+        self.collectionId = collectionId
+        self.newFaces = set(newFaces)
+        self.workers = workers
+        self.throttle = Throttle(maxRate)
+        self.threshold = threshold
+        self.maxFaces = maxFaces
+        self.margin = margin
+        self.quality = quality
+        self.calls = 0
+
+    def crops(self, vidcap, picks, boxes):
+        """JPEG bytes of each picked box, widened by margin on every side, decoded in time order."""
+        seeker = FrameSeeker(vidcap)
+        for ts, row, track in picks:
+            hasFrames, image = seeker.read(ts)
+            if not hasFrames:
+                continue
+            box = boxes[row]
+            grow = box[2:] * self.margin
+            widened = np.concatenate([box[:2] - grow, box[2:] + 2 * grow])
+            x0, y0, x1, y1 = overlay.boxes_to_pixels(widened, image.shape[1], image.shape[0])[0]
+            if x1 > x0 and y1 > y0:
+                yield track, frame_store.encode(image[y0:y1, x0:x1], self.quality)
+
+    def search(self, crop):
+        from index_faces import call_with_backoff
+        try:
+            response = call_with_backoff(self.rek.search_faces_by_image, self.throttle,
+                                         CollectionId=self.collectionId, Image={'Bytes': crop},
+                                         FaceMatchThreshold=self.threshold, MaxFaces=self.maxFaces)
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'InvalidParameterException':
+                return []       # no face found in the crop
+            raise
+        return [match for match in response['FaceMatches'] if match['Face']['FaceId'] in self.newFaces]
+
+    def run(self, vidcap, data):
+        """Updated results (compact dict) and the number of tracks that gained matches."""
+        data = from_data(data)
+        columns = detection_columns(data)
+        tracks = Tracker().build(data)
+        # nothing new in the collection: nothing to search
+        picks = representatives(tracks, columns) if self.newFaces else []
+
+        found = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            window = []
+            for track, crop in self.crops(vidcap, picks, columns['Box']):
+                window.append((track, pool.submit(self.search, crop)))
+                self.calls += 1
+                if len(window) >= self.workers * 4:
+                    track, future = window.pop(0)
+                    found[track.trackId] = future.result()
+            for track, future in window:
+                found[track.trackId] = future.result()
+
+        added = {}
+        for track in tracks:
+            for row in track.rows:
+                if found.get(track.trackId):
+                    added[int(row)] = found[track.trackId]
+
+        builder = CompactBuilder()
+        if isinstance(data, CompactResults):
+            similarities = [None if s is None else data.float(s) for s in data.records['Similarity']]
+        else:
+            similarities = itertools.repeat(None)
+        for i, (record, similarity) in enumerate(zip(data, similarities)):
+            if 'personInfo' in record:
+                builder.add_person(record['TS'], record['personInfo'])
+                for match in added.get(i, ()):
+                    builder.add_match(record['TS'], match['Face'], match['Similarity'])
+            else:
+                builder.add_match(record['TS'], record['faceInfo'], similarity)
+        return builder.to_dict(), sum(1 for matches in found.values() if matches)
+
+
+def main():
+    from face_inventory import FaceInventory
+
+    parser = argparse.ArgumentParser(description='Re-match stored person detections against new collection faces.')
+    parser.add_argument('video', help='local copy of the analysed video')
+    parser.add_argument('results', help='face search results (legacy or compact)')
+    parser.add_argument('--collection', default='russell')
+    parser.add_argument('--inventory', help='face inventory file (default: faces-<collection>.json)')
+    parser.add_argument('--since', type=float, help='unix time of the original analysis (default: results file mtime)')
+    parser.add_argument('--out', required=True, help='where to write the updated compact results')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--max-rate', type=float, default=5, help='search_faces_by_image calls per second')
+    parser.add_argument('--threshold', type=float, default=80.0, help='FaceMatchThreshold')
+    parser.add_argument('--region', default='eu-west-1')
+    args = parser.parse_args()
+
+    rek = boto3.client('rekognition', region_name=args.region)
+    inventory = FaceInventory.load(args.collection, args.inventory)
+    inventory.refresh(rek)
+    inventory.save()
+    since = args.since if args.since is not None else os.path.getmtime(args.results)
+    newFaces = inventory.added_since(since)
+    print('%d faces added to %s since %s' % (len(newFaces), args.collection, time.ctime(since)))
+
+    with open(args.results) as f:
+        data = json.load(f)
+    researcher = ReSearcher(rek, args.collection, newFaces, workers=args.workers, maxRate=args.max_rate,
+                            threshold=args.threshold)
+    results, matched = researcher.run(cv2.VideoCapture(args.video), data)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, separators=(',', ':'))
+    print('%d searches, %d tracks matched new faces' % (researcher.calls, matched))
+
+
+if __name__ == "__main__":
+    main()
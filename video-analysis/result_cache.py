@@ -0,0 +1,73 @@
+# Content-addressed cache of finished analyses.
+#
+# A result set is stored under a key made of the video's S3 ETag, the
+# CollectionId, the collection version (FaceInventory.version()) and the job
+# type, so the same video searched against an unchanged collection is never
+# analysed twice, while re-indexing the collection or uploading a new version
+# of the video misses naturally. Entries are compact JSON files in one
+# directory; reads refresh their modification time and put() evicts the
+# least recently used entries once the directory outgrows maxBytes.
+
+import hashlib
+import json
+import os
+import threading
+
+DEFAULT_DIR = os.path.expanduser('~/.cache/rekognition-results')
+
+
+def cache_key(etag, collectionId, collectionVersion, jobType):
+    parts = [etag.strip('"'), collectionId or '', collectionVersion or '', jobType]
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, directory=DEFAULT_DIR, maxBytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                results = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(path, None)
+        self.hits += 1
+        return results
+
+    def put(self, key, results):
+        path = self._path(key)
+        tmp = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(tmp, 'w') as f:
+            json.dump(results, f, separators=(',', ':'))
+        os.rename(tmp, path)
+        self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in maxBytes; returns how many."""
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    st = os.stat(os.path.join(self.directory, name))
+                    entries.append((st.st_mtime, st.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for _, size, name in sorted(entries):
+                if total <= self.maxBytes:
+                    break
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+                removed += 1
+            return removed
@@ -0,0 +1,101 @@
+# Random access into face search results by time and by person.
+#
+#   python result_index.py results.json --start 10:00 --end 10:30
+#   python result_index.py results.json --name russell.jpg
+#
+# ResultIndex keeps the record timestamps as one sorted array together with
+# the offset of each entry in the record store (the legacy list or
+# CompactResults), and for every matched ExternalImageId a posting list of
+# positions in that order. Time windows are two binary searches; person
+# queries are a binary search within the person's posting list.
+
+import argparse
+import json
+
+import numpy as np
+
+from compact_results import detection_columns, from_data
+
+
+def parse_time(value):
+    """'[[hh:]mm:]ss[.fff]' -> milliseconds; None stays None."""
+    if value is None:
+        return None
+    seconds = 0.0
+    for part in str(value).split(':'):
+        seconds = seconds * 60 + float(part)
+    return int(round(seconds * 1000))
+
+
+class ResultIndex(object):
+    def __init__(self, data, inventory=None):
+        self.data = from_data(data)
+        columns = detection_columns(self.data)
+        self.offsets = np.argsort(columns['TS'], kind='stable')
+        self.ts = columns['TS'][self.offsets]
+        self.boxes = columns['Box'][self.offsets]
+        names = [name or (inventory and inventory.resolve(faceId)) or faceId
+                 for name, faceId in zip(columns['Names'], columns['FaceIds'])]
+        face = columns['Face'][self.offsets]
+        self.postings = {}
+        self.postingTimes = {}
+        matches = np.flatnonzero(face >= 0)
+        if len(matches):
+            # group match positions by name; the stable sort keeps them in time order
+            keys, byFace = np.unique(np.array(names, object), return_inverse=True)
+            ids = byFace.reshape(-1)[face[matches]]
+            order = np.argsort(ids, kind='stable')
+            bounds = np.searchsorted(ids[order], np.arange(len(keys) + 1))
+            for k, key in enumerate(keys):
+                self.postings[key] = matches[order[bounds[k]:bounds[k + 1]]]
+                self.postingTimes[key] = self.ts[self.postings[key]]
+
+    def __len__(self):
+        return len(self.ts)
+
+    def window(self, start=None, end=None):
+        """Positions [lo, hi) of the records with start <= TS <= end."""
+        lo = 0 if start is None else int(np.searchsorted(self.ts, start, 'left'))
+        hi = len(self.ts) if end is None else int(np.searchsorted(self.ts, end, 'right'))
+        return lo, max(lo, hi)
+
+    def records(self, start=None, end=None):
+        """Records in the window, in time order."""
+        lo, hi = self.window(start, end)
+        return [self.data[int(i)] for i in self.offsets[lo:hi]]
+
+    def names(self, start=None, end=None):
+        """ExternalImageIds matched in the window."""
+        lo, hi = self.window(start, end)
+        return sorted(name for name, positions in self.postings.items()
+                      if np.searchsorted(positions, lo) < np.searchsorted(positions, hi))
+
+    def occurrences(self, name, start=None, end=None):
+        """Timestamps at which name was matched within the window."""
+        times = self.postingTimes.get(name)
+        if times is None:
+            return self.ts[:0]
+        lo = 0 if start is None else np.searchsorted(times, start, 'left')
+        hi = len(times) if end is None else np.searchsorted(times, end, 'right')
+        return times[lo:hi]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query face search results by time or person.')
+    parser.add_argument('results')
+    parser.add_argument('--start', help='[[hh:]mm:]ss[.fff]')
+    parser.add_argument('--end', help='[[hh:]mm:]ss[.fff]')
+    parser.add_argument('--name', help='ExternalImageId to list the matches of')
+    args = parser.parse_args()
+    with open(args.results) as f:
+        index = ResultIndex(json.load(f))
+    start, end = parse_time(args.start), parse_time(args.end)
+    if args.name:
+        print(json.dumps(index.occurrences(args.name, start, end).tolist()))
+    else:
+        lo, hi = index.window(start, end)
+        print('%d records, faces: %s' % (hi - lo, ', '.join(index.names(start, end)) or '-'))
+
+
+if __name__ == "__main__":
+    main()
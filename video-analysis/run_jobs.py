@@ -0,0 +1,192 @@
+# Run face searches for many videos.
+#
+#   python run_jobs.py --manifest videos.txt
+#   python run_jobs.py --prefix s3://verge.rekognition/russel/ --max-jobs 10
+#
+# A manifest lists one s3://bucket/key per line. Videos go through the job
+# orchestrator with at most --max-jobs searches running at once. Every job's
+# id, status and result file are written to a state file (--state) as they
+# change; running the same command again after a crash skips finished
+# videos, waits for jobs that are still running or fetches the ones that
+# finished meanwhile, and only submits what never got a job id. Queue URL,
+# role and topic ARNs and collection default to the VideoDetect settings.
+# --cache-dir reuses face searches of unchanged videos against an unchanged
+# collection across runs; --inventory keeps the collection inventory used
+# for that in a file instead of listing the whole collection every run.
+
+import argparse
+import json
+import os
+import threading
+import time
+
+import boto3
+
+from orchestrator import Job, JobOrchestrator
+from rekognition_analysis import VideoDetect
+from result_cache import ResultCache
+
+VIDEO_SUFFIXES = ('.mp4', '.mov', '.avi', '.mkv', '.m4v')
+DONE = ('FETCHED', 'CACHED')
+
+
+def read_manifest(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if not line.startswith('s3://'):
+                raise ValueError("Manifest lines must be s3://bucket/key: %r" % line)
+            bucket, _, key = line[5:].partition('/')
+            yield bucket, key
+
+
+def list_videos(url, s3=None):
+    from s3util import get_s3, iter_objects, split_s3_url
+    bucket, prefix = split_s3_url(url)
+    for obj in iter_objects(s3 or get_s3(), bucket, prefix, VIDEO_SUFFIXES):
+        yield bucket, obj['Key']
+
+
+class JobState(object):
+    """Job id, status and result file per video, rewritten as a whole on every change."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def name(bucket, video):
+        return 's3://%s/%s' % (bucket, video)
+
+    def get(self, bucket, video):
+        return self.entries.get(self.name(bucket, video), {})
+
+    def update(self, job, results=None):
+        with self.lock:
+            entry = self.entries.setdefault(self.name(job.bucket, job.video), {})
+            entry.update({'JobId': job.jobId, 'Status': job.status, 'Error': job.error, 'Updated': time.time()})
+            if results:
+                entry['Results'] = results
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.path)
+
+
+class JobRunner(object):
+    def __init__(self, detect, state, outDir, maxJobs=20, waitSeconds=20):
+        self.detect = detect
+        self.state = state
+        self.outDir = outDir
+        self.maxJobs = maxJobs
+        self.waitSeconds = waitSeconds
+
+    def result_path(self, job):
+        return os.path.join(self.outDir, job.bucket, job.video + '.json')
+
+    def save(self, job):
+        """State update for a job; finished results are written out and released."""
+        if job.status in DONE and job.results is not None:
+            path = self.result_path(job)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                json.dump(job.results, f, separators=(',', ':'))
+            job.results = None
+            self.state.update(job, path)
+        else:
+            self.state.update(job)
+
+    def fetch(self, job):
+        try:
+            job.results = self.detect.GetResultsFaceSearchCollection(job.jobId, compact=True)
+            job.status = 'FETCHED'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'FETCH_FAILED'
+        job.fetched = time.time()
+        self.save(job)
+
+    def resume(self, videos):
+        """Split videos into (to submit, to attach, finished); jobs that completed meanwhile are fetched here."""
+        submit, attached, finished = [], [], []
+        for bucket, video in videos:
+            entry = self.state.get(bucket, video)
+            job = Job(bucket, video)
+            job.jobId = entry.get('JobId')
+            if entry.get('Status') in DONE and os.path.exists(entry.get('Results') or ''):
+                job.status = entry['Status']
+                finished.append(job)
+                continue
+            if job.jobId and entry.get('Status') in ('IN_PROGRESS', 'SUCCEEDED', 'FETCH_FAILED'):
+                try:
+                    status = self.detect.rek.get_face_search(JobId=job.jobId, MaxResults=1)['JobStatus']
+                except Exception:
+                    status = None       # expired or unknown job id
+                if status == 'SUCCEEDED':
+                    job.status = status
+                    self.fetch(job)
+                    finished.append(job)
+                    continue
+                if status == 'IN_PROGRESS':
+                    attached.append(job)
+                    continue
+            submit.append((bucket, video))
+        return submit, attached, finished
+
+    def run(self, videos):
+        submit, attached, finished = self.resume(videos)
+        detect = self.detect
+        orchestrator = JobOrchestrator(detect.rek, detect.sqs, detect.queueUrl, detect.roleArn, detect.topicArn,
+                                       detect.collectionId,
+                                       lambda jobId: detect.GetResultsFaceSearchCollection(jobId, compact=True),
+                                       maxJobs=self.maxJobs, waitSeconds=self.waitSeconds, on_change=self.save)
+        jobs = detect.SearchFaces(submit, orchestrator, attached)
+        for job in jobs:
+            if job.status == 'CACHED':
+                self.save(job)
+        return finished + jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run Rekognition face searches for many videos.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', help='file with one s3://bucket/key per line')
+    source.add_argument('--prefix', help='s3://bucket/prefix to analyse every video under')
+    parser.add_argument('--state', default='jobs-state.json', help='job state file, reused to resume')
+    parser.add_argument('--out-dir', default='results', help='where result files are written')
+    parser.add_argument('--max-jobs', type=int, default=20, help='face searches running at once')
+    parser.add_argument('--collection', default=VideoDetect.collectionId)
+    parser.add_argument('--queue-url', default=VideoDetect.queueUrl)
+    parser.add_argument('--role-arn', default=VideoDetect.roleArn)
+    parser.add_argument('--topic-arn', default=VideoDetect.topicArn)
+    parser.add_argument('--region', default='eu-west-1')
+    parser.add_argument('--cache-dir', help='result cache directory (default: no cache)')
+    parser.add_argument('--inventory', help='collection inventory file for the result cache')
+    args = parser.parse_args()
+
+    detect = VideoDetect(rek=boto3.client('rekognition', region_name=args.region),
+                         sqs=boto3.client('sqs', region_name=args.region),
+                         cache=ResultCache(args.cache_dir) if args.cache_dir else None,
+                         inventoryPath=args.inventory)
+    detect.collectionId = args.collection
+    detect.queueUrl = args.queue_url
+    detect.roleArn = args.role_arn
+    detect.topicArn = args.topic_arn
+
+    videos = list(read_manifest(args.manifest) if args.manifest else list_videos(args.prefix, detect.s3))
+    runner = JobRunner(detect, JobState(args.state), args.out_dir, maxJobs=args.max_jobs)
+    jobs = runner.run(videos)
+    for job in jobs:
+        entry = runner.state.get(job.bucket, job.video)
+        print('%s %s %s' % (JobState.name(job.bucket, job.video), job.status, entry.get('Results') or job.error or ''))
+
+
+if __name__ == "__main__":
+    main()
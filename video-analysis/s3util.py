@@ -0,0 +1,50 @@
+# Access to the S3 client bundled in ../s3cmd
+
+import os
+import sys
+
+S3CMD_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 's3cmd'))
+if S3CMD_DIR not in sys.path:
+    sys.path.insert(0, S3CMD_DIR)
+
+from S3.Config import Config
+from S3.S3 import S3
+from S3.S3Uri import S3Uri
+
+DEFAULT_CONFIG = os.path.expanduser('~/.s3cfg')
+
+
+def get_s3(configfile=None, **options):
+    """
+    Return an S3 client. configfile defaults to ~/.s3cfg when it exists;
+    options override single Config settings (e.g. host_base for a local stub).
+    """
+    if configfile is None and os.path.exists(DEFAULT_CONFIG):
+        configfile = DEFAULT_CONFIG
+    cfg = Config(configfile)
+    for option, value in options.items():
+        cfg.update_option(option, value)
+    return S3(cfg)
+
+
+def split_s3_url(url):
+    """'s3://bucket/some/prefix' -> ('bucket', 'some/prefix')"""
+    uri = S3Uri(url)
+    if uri.type != 's3':
+        raise ValueError("Expected an s3:// URL, got '%s'" % url)
+    return uri.bucket(), uri.object()
+
+
+def iter_objects(s3, bucket, prefix='', suffixes=None):
+    """Yield listing entries under prefix, page by page, via bucket_list_streaming."""
+    for _, _, objects in s3.bucket_list_streaming(bucket, prefix=prefix, recursive=True):
+        for obj in objects:
+            if suffixes and not obj['Key'].lower().endswith(tuple(suffixes)):
+                continue
+            yield obj
+
+
+def object_etag(s3, bucket, key):
+    """ETag of an object, from a HEAD request."""
+    response = s3.object_info(S3Uri('s3://%s/%s' % (bucket, key)))
+    return response['headers']['etag'].strip('"')
@@ -0,0 +1,100 @@
+# Pick the frames worth sending to the Rekognition image APIs.
+#
+#   python scene_sampler.py video.mp4 --out frames/sampled [--threshold 0.2] [--mode archive]
+#
+# Instead of a frame every N seconds, every frame gets a cheap signature: it
+# is downscaled to a small grayscale thumbnail, split into a grid of blocks,
+# and each block contributes a brightness histogram, computed with NumPy
+# over the whole thumbnail at once. A frame is kept only when its signature
+# differs from the last kept frame by more than the threshold
+# (half the L1 distance of the normalised histograms, so 0..1). Static
+# footage then yields a handful of frames instead of one per interval.
+
+import argparse
+
+import cv2
+import numpy as np
+
+import frame_store
+
+
+def signatures(thumbs, grid=4, bins=16):
+    """
+    (N, H, W) uint8 thumbnails -> (N, grid * grid * bins) histograms, each
+    block normalised to sum to 1 / (grid * grid).
+    """
+    thumbs = np.asarray(thumbs)
+    n, height, width = thumbs.shape
+    rows = np.arange(height) * grid // height
+    columns = np.arange(width) * grid // width
+    block = rows[:, None] * grid + columns[None, :]
+    ids = (np.arange(n)[:, None, None] * grid * grid + block[None]) * bins + thumbs.astype(np.int64) * bins // 256
+    counts = np.bincount(ids.ravel(), minlength=n * grid * grid * bins).reshape(n, -1)
+    return counts / float(height * width)
+
+
+def distance(a, b):
+    """Half the L1 distance between signatures: 0 for identical, 1 for disjoint."""
+    return np.abs(a - b).sum(axis=-1) / 2.0
+
+
+class SceneSampler(object):
+    def __init__(self, threshold=0.2, size=(64, 36), grid=4, bins=16, step=1, maxInterval=None):
+        self.threshold = threshold
+        self.size = size
+        self.grid = grid
+        self.bins = bins
+        self.step = step
+        self.maxInterval = maxInterval
+        self.seen = 0
+        self.kept = 0
+
+    def sample(self, vidcap):
+        """
+        Yield (ts, image) for every kept frame, in a single sequential decode.
+        Each frame is judged as soon as it is decoded, so only the frame at
+        hand is ever held at full resolution.
+        """
+        fps = vidcap.get(cv2.CAP_PROP_FPS) or 25.0
+        frameNo = int(vidcap.get(cv2.CAP_PROP_POS_FRAMES))
+        anchor = anchorTime = None
+        while True:
+            if (frameNo % self.step) and vidcap.grab():
+                frameNo += 1
+                continue
+            hasFrames, image = vidcap.read()
+            if not hasFrames:
+                return
+            ts = int(round(frameNo * 1000.0 / fps))
+            frameNo += 1
+            self.seen += 1
+            thumb = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), self.size, interpolation=cv2.INTER_AREA)
+            sig = signatures(thumb[None], self.grid, self.bins)[0]
+            if anchor is None or distance(sig, anchor) > self.threshold or \
+                    (self.maxInterval is not None and ts - anchorTime >= self.maxInterval):
+                anchor, anchorTime = sig, ts
+                self.kept += 1
+                yield ts, image
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep only the frames where the scene changes.')
+    parser.add_argument('video')
+    parser.add_argument('--out', required=True, help='output directory, or file for --mode archive')
+    parser.add_argument('--mode', default='frames', choices=['frames', 'sheet', 'archive'])
+    parser.add_argument('--threshold', type=float, default=0.2, help='0..1 signature distance to keep a frame')
+    parser.add_argument('--step', type=int, default=1, help='only consider every n-th frame')
+    parser.add_argument('--max-interval', type=int, default=None, help='keep a frame at least every n ms')
+    parser.add_argument('--quality', type=int, default=None, help='JPEG quality')
+    args = parser.parse_args()
+
+    sampler = SceneSampler(args.threshold, step=args.step, maxInterval=args.max_interval)
+    sink = frame_store.open_sink(args.mode, args.out, args.quality)
+    for ts, image in sampler.sample(cv2.VideoCapture(args.video)):
+        sink.add(str(ts), image)
+    sink.close()
+    print('Kept %d of %d frames' % (sampler.kept, sampler.seen))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# Face tracks from face search results.
+#
+#   python tracker.py results.json [--max-gap 1000] [--min-iou 0.3] > tracks.json
+#
+# get_face_search reports every person detection on its own, per Timestamp.
+# The tracker walks the timestamps once and links each detection to a track:
+# first by the person Index the service assigned, then by overlap with the
+# last box of the tracks still open, using an IoU matrix computed in one
+# NumPy step over the candidates found in a coarse spatial grid. Face match
+# records belong to the person detection reported just before them at the
+# same timestamp and vote for the track's best-match ExternalImageId.
+
+import argparse
+import json
+from collections import defaultdict
+
+import numpy as np
+
+from compact_results import detection_columns, from_data
+
+
+class Track(object):
+    __slots__ = ('trackId', 'index', 'rows', 'ts', 'boxes', 'scores')
+
+    def __init__(self, trackId, index):
+        self.trackId = trackId
+        self.index = index
+        self.rows = []
+        self.ts = None
+        self.boxes = None
+        self.scores = None
+
+    @property
+    def start(self):
+        return int(self.ts[0])
+
+    @property
+    def end(self):
+        return int(self.ts[-1])
+
+    def to_dict(self):
+        return {'TrackId': self.trackId, 'Index': self.index, 'Start': self.start, 'End': self.end,
+                'ExternalImageId': self.scores and max(self.scores, key=self.scores.get),
+                'Scores': self.scores, 'TS': self.ts.tolist(), 'Boxes': self.boxes.round(6).tolist()}
+
+
+def iou_matrix(a, b):
+    """IoU of every box in a against every box in b; boxes are Left, Top, Width, Height rows."""
+    a = np.asarray(a, float).reshape(-1, 1, 4)
+    b = np.asarray(b, float).reshape(1, -1, 4)
+    width = np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    height = np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    inter = np.clip(width, 0, None) * np.clip(height, 0, None)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0.0)
+
+
+def grid_cells(boxes, cells):
+    """For each box, the grid cells (cells x cells over the unit square) it overlaps."""
+    boxes = np.asarray(boxes, float).reshape(-1, 4)
+    lo = (np.clip(boxes[:, :2], 0, 1 - 1e-9) * cells).astype(int)
+    hi = (np.clip(boxes[:, :2] + boxes[:, 2:], 0, 1 - 1e-9) * cells).astype(int)
+    return [[(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+            for (x0, y0), (x1, y1) in zip(lo.tolist(), hi.tolist())]
+
+
+def owners(columns):
+    """Row of the person detection each face match belongs to, -1 if none."""
+    ts = columns['TS']
+    isPerson = columns['Face'] < 0
+    last = np.maximum.accumulate(np.where(isPerson, np.arange(len(ts)), -1)) if len(ts) else ts
+    owner = np.where(isPerson, -1, last)
+    valid = (owner >= 0) & (ts[np.maximum(owner, 0)] == ts)
+    return np.where(valid, owner, -1)
+
+
+class Tracker(object):
+    def __init__(self, maxGap=1000, minIou=0.3, cells=16):
+        self.maxGap = maxGap
+        self.minIou = minIou
+        self.cells = cells
+
+    def build(self, data):
+        """Tracks for legacy or compact results, ordered by start time."""
+        columns = detection_columns(from_data(data))
+        ts, boxes = columns['TS'], columns['Box']
+        persons = np.flatnonzero(columns['Face'] < 0)
+        persons = persons[np.argsort(ts[persons], kind='stable')]
+        track = np.full(len(ts), -1, np.int64)
+
+        tracks = []
+        openTracks = {}         # trackId -> (last ts, last box)
+        byIndex = {}            # person Index -> open trackId
+        personTs = ts[persons]
+        edges = np.flatnonzero(np.diff(personTs)) + 1
+        for group in np.split(persons, edges) if len(persons) else ():
+            now = ts[group[0]]
+            for trackId in [t for t, (last, _) in openTracks.items() if now - last > self.maxGap]:
+                del openTracks[trackId]
+                if byIndex.get(tracks[trackId].index) == trackId:
+                    del byIndex[tracks[trackId].index]
+
+            claimed = set()
+            unmatched = []
+            for row in group:
+                trackId = byIndex.get(columns['Index'][row])
+                if trackId is not None and trackId not in claimed:
+                    track[row] = trackId
+                    claimed.add(trackId)
+                else:
+                    unmatched.append(row)
+
+            if unmatched and len(openTracks) > len(claimed):
+                self._match_iou(unmatched, boxes, openTracks, claimed, track)
+
+            for row in group:
+                if track[row] < 0:
+                    track[row] = len(tracks)
+                    tracks.append(Track(len(tracks), int(columns['Index'][row])))
+                trackId = track[row]
+                openTracks[trackId] = (now, boxes[row])
+                if tracks[trackId].index >= 0:
+                    byIndex[tracks[trackId].index] = trackId
+                tracks[trackId].rows.append(row)
+
+        owner = owners(columns)
+        votes = defaultdict(lambda: defaultdict(float))
+        for row in np.flatnonzero(owner >= 0):
+            name = columns['Names'][columns['Face'][row]] or columns['FaceIds'][columns['Face'][row]]
+            score = columns['Score'][row]
+            votes[int(track[owner[row]])][name] += 0.0 if np.isnan(score) else float(score)
+
+        for t in tracks:
+            rows = np.asarray(t.rows)
+            t.ts = ts[rows]
+            t.boxes = boxes[rows].astype(np.float32)
+            t.scores = dict(votes[t.trackId]) if t.trackId in votes else None
+            t.rows = rows
+        return tracks
+
+    def _match_iou(self, rows, boxes, openTracks, claimed, track):
+        free = [t for t in openTracks if t not in claimed]
+        grid = defaultdict(list)
+        for trackId, cells in zip(free, grid_cells([openTracks[t][1] for t in free], self.cells)):
+            for cell in cells:
+                grid[cell].append(trackId)
+        candidates = sorted(set(t for cells in grid_cells(boxes[rows], self.cells)
+                                for cell in cells for t in grid.get(cell, ())))
+        if not candidates:
+            return
+        iou = iou_matrix(boxes[rows], [openTracks[t][1] for t in candidates])
+        # greedy assignment, best overlaps first
+        i, j = np.nonzero(iou >= self.minIou)
+        order = np.argsort(-iou[i, j], kind='stable')
+        used = set()
+        for i, j in zip(i[order].tolist(), j[order].tolist()):
+            if i in used or candidates[j] in claimed:
+                continue
+            track[rows[i]] = candidates[j]
+            used.add(i)
+            claimed.add(candidates[j])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Link face search detections into tracks.')
+    parser.add_argument('results')
+    parser.add_argument('--max-gap', type=int, default=1000, help='milliseconds a track may go unseen')
+    parser.add_argument('--min-iou', type=float, default=0.3, help='overlap needed to continue a track')
+    args = parser.parse_args()
+    with open(args.results) as f:
+        data = json.load(f)
+    tracks = Tracker(args.max_gap, args.min_iou).build(data)
+    print(json.dumps([t.to_dict() for t in tracks]))
+
+
+if __name__ == "__main__":
+    main()